@@ -0,0 +1,118 @@
+import threading
+from multiprocessing import TimeoutError
+
+
+class GatheredResult(object):
+    """
+    The result of several calls made in a pool of threads, combined into one value once all of them finished.
+    It is used like the AsyncResult returned by apply_async, with get, wait, ready and successful, and can call
+    a callback with the combined value. No thread waits for the calls, every one of them reports when it
+    finishes, and the values are combined in the thread of the last one
+    """
+
+    def __init__(self, names, combine, callback=None):
+        """
+        :param names: The names of the calls to gather
+        :param combine: A function called with a dict with the value of every successful call and a dict with
+        the error of every failed one, both keyed by name, that returns the combined value
+        :param callback: An optional function called with the combined value, if it could be combined, in
+        the thread that combined it, so it should only hand the value over to another thread
+        """
+        self.pending = set(names)
+        self.combine = combine
+        self.callback = callback
+        self.values = dict()
+        self.errors = dict()
+        self.value = None
+        self.error = None
+        self.lock = threading.Lock()
+        self.event = threading.Event()
+        if not self.pending:
+            self.finish()
+
+    def run(self, name, function, *args):
+        """
+        Calls a function, catching its error. Meant to be the function run in the pool, so the callback of
+        apply_async is called even if the function fails
+        :param name: The name of the call
+        :param function: The function to call
+        :param args: The arguments of the function
+        :return: A tuple with the name, True and the value of the function, or the name, False and the error
+        """
+        try:
+            return name, True, function(*args)
+        except Exception as ex:
+            return name, False, ex
+
+    def run_part(self, name, function, *args):
+        """
+        Calls a function and records its answer, in the same thread. Meant to be the function run in the pool,
+        so answers are combined in a thread of the pool instead of the one that hands out its results
+        :param name: The name of the call
+        :param function: The function to call
+        :param args: The arguments of the function
+        """
+        self.set_part(self.run(name, function, *args))
+
+    def set_part(self, answer):
+        """
+        Records the answer of one of the calls, combining all of them if it was the last one. Meant to be
+        the callback of apply_async
+        :param answer: The tuple returned by run
+        """
+        name, succeeded, value = answer
+        with self.lock:
+            if succeeded:
+                self.values[name] = value
+            else:
+                self.errors[name] = value
+            self.pending.discard(name)
+            if self.pending:
+                return
+        self.finish()
+
+    def fail(self, error):
+        """
+        Ends with an error without waiting for the calls that are still pending
+        :param error: The exception raised by get
+        """
+        self.error = error
+        self.event.set()
+
+    def finish(self):
+        """
+        Combines the answers of all the calls and calls the callback
+        """
+        try:
+            self.value = self.combine(self.values, self.errors)
+        except Exception as ex:
+            self.fail(ex)
+            return
+        self.event.set()
+        if self.callback is not None:
+            self.callback(self.value)
+
+    def ready(self):
+        return self.event.is_set()
+
+    def wait(self, timeout=None):
+        self.event.wait(timeout)
+
+    def successful(self):
+        assert self.ready()
+        return self.error is None
+
+    def get(self, timeout=None):
+        """
+        Waits for the combined value
+        :param timeout: The maximum seconds to wait, forever by default
+        :return: The combined value
+        :raise TimeoutError: If the calls did not finish in time
+        :raise Exception: The error of the combination, or the one given to fail
+        """
+        self.wait(timeout)
+        if not self.ready():
+            raise TimeoutError
+        if self.error is not None:
+            raise self.error
+        return self.value
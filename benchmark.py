@@ -0,0 +1,729 @@
+import os
+import sys
+import cgi
+import copy
+import json
+import time
+import uuid
+import yaml
+import random
+import shutil
+import zipfile
+import argparse
+import resource
+import tempfile
+import threading
+import urlparse
+import SocketServer
+import BaseHTTPServer
+import multiprocessing
+from StringIO import StringIO
+from collections import deque
+
+import numpy
+from PIL import Image, ImageDraw
+
+from image_tagging import ImageTagger
+from imagga import ImaggaHelper
+from metrics import Metrics
+
+
+FIXTURES_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+
+def load_fixture(file_name):
+    """
+    Loads one of the JSON responses of the fixtures folder
+    :param file_name: The name of the fixture file
+    :return: The parsed JSON
+    """
+    with open(os.path.join(FIXTURES_FOLDER, file_name)) as fixture:
+        return json.load(fixture)
+
+
+class StandInHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    An HTTP server that answers every request in its own thread, like the real APIs answer concurrent requests
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class StandInRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Hands every request to the stand-in of the server. Connections are kept alive, so clients with
+    connection pools behave like they do with the real APIs
+    """
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately, without this delayed ACKs add 40 ms to every response
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        self.server.stand_in.respond(self)
+
+    def do_POST(self):
+        self.server.stand_in.respond(self)
+
+    def log_message(self, format, *args):
+        # Thousands of requests per run, the stand-in counts them instead
+        pass
+
+
+class StandIn(object):
+    """
+    A local HTTP server that imitates a tagging API, answering with responses built from the fixtures.
+    Metered requests, the ones that tag images, can be made slow, fail, be throttled or be rejected for their size:
+    - latency and jitter: seconds every request waits, plus a random part up to jitter
+    - error_rate: the ratio of requests answered with a 503
+    - requests_per_second: requests over this rate are answered with a 429 and a Retry-After header
+    - max_payload_bytes: requests with a bigger body are answered with a 413
+    """
+    NAME = None
+    # Seconds throttled clients are asked to wait
+    RETRY_AFTER = 1
+
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, requests_per_second=None, max_payload_bytes=None,
+                 seed=None):
+        """
+        :param latency: The seconds every metered request takes at least
+        :param jitter: The maximum random seconds added to the latency
+        :param error_rate: The ratio of metered requests that fail, from 0 to 1
+        :param requests_per_second: The maximum metered requests per second, None for no limit
+        :param max_payload_bytes: The maximum size of the body of a metered request, None for no limit
+        :param seed: The seed of the random latencies and errors, so runs can be repeated
+        """
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.requests_per_second = requests_per_second
+        self.max_payload_bytes = max_payload_bytes
+        self.random = random.Random(seed)
+        # The times of the metered requests of the last second
+        self.recent = deque()
+        self.counters = dict.fromkeys(['requests', 'throttled', 'rejected', 'failed'], 0)
+        self.lock = threading.Lock()
+        self.server = None
+
+    def start(self):
+        """
+        Starts serving in a daemon thread, on a free port of the loopback interface
+        :return: The stand-in itself
+        """
+        self.server = StandInHTTPServer(('127.0.0.1', 0), StandInRequestHandler)
+        self.server.stand_in = self
+        thread = threading.Thread(target=self.server.serve_forever, name='stand-in-%s' % self.NAME)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        """
+        Stops serving and closes the socket
+        """
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    @property
+    def url(self):
+        """
+        The URL the stand-in is served at, without a trailing slash
+        """
+        return 'http://127.0.0.1:%d' % self.server.server_address[1]
+
+    def stats(self):
+        """
+        Gets the counters of the metered requests
+        :return: A dict with the requests received and the ones throttled, rejected for their size or failed
+        """
+        with self.lock:
+            return dict(self.counters)
+
+    def respond(self, handler):
+        """
+        Answers a request, injecting the configured faults first if it is metered
+        :param handler: The request handler of the connection
+        """
+        parsed = urlparse.urlparse(handler.path)
+        length = int(handler.headers.getheader('Content-Length') or 0)
+        body = handler.rfile.read(length) if length else ''
+        answer = None
+        if self.is_metered(handler.command, parsed.path):
+            answer = self.inject_faults(len(body))
+        if answer is None:
+            answer = self.handle(handler.command, parsed.path, urlparse.parse_qs(parsed.query), handler.headers, body)
+        status, payload, headers = answer
+        data = json.dumps(payload)
+        handler.send_response(status)
+        handler.send_header('Content-Type', 'application/json')
+        handler.send_header('Content-Length', str(len(data)))
+        for name, value in headers.iteritems():
+            handler.send_header(name, value)
+        handler.end_headers()
+        handler.wfile.write(data)
+
+    def inject_faults(self, body_bytes):
+        """
+        Decides if a metered request fails, waiting the configured latency before answering it
+        :param body_bytes: The size of the request body
+        :return: A tuple with the status, the JSON body and the headers of the error, or None if the request
+        should be answered normally
+        """
+        with self.lock:
+            self.counters['requests'] += 1
+            if self.max_payload_bytes is not None and body_bytes > self.max_payload_bytes:
+                self.counters['rejected'] += 1
+                return self.error(413, 'The request body is over %s bytes' % self.max_payload_bytes)
+            if self.throttle():
+                self.counters['throttled'] += 1
+                return self.error(429, 'Too many requests', self.throttle_headers())
+            delay = self.latency + self.random.uniform(0, self.jitter)
+            failed = self.random.random() < self.error_rate
+        if delay:
+            time.sleep(delay)
+        if failed:
+            with self.lock:
+                self.counters['failed'] += 1
+            return self.error(503, 'The service is unavailable')
+        return None
+
+    def throttle(self):
+        """
+        Counts a request against the rate limit. Must be called with the lock held
+        :return: True if the request is over the limit
+        """
+        if self.requests_per_second is None:
+            return False
+        now = time.time()
+        while self.recent and now - self.recent[0] >= 1.0:
+            self.recent.popleft()
+        if len(self.recent) >= self.requests_per_second:
+            return True
+        self.recent.append(now)
+        return False
+
+    def throttle_headers(self):
+        """
+        Gets the headers of a throttled response
+        :return: A dict with the headers
+        """
+        return {'Retry-After': str(self.RETRY_AFTER)}
+
+    def error(self, status, message, headers=None):
+        """
+        Builds an error response in the format of the API
+        :param status: The HTTP status code
+        :param message: The description of the error
+        :param headers: An optional dict with extra headers
+        :return: A tuple with the status, the JSON body and the headers
+        """
+        return status, {'code': status, 'error': message}, headers or {}
+
+    def parse_form(self, headers, body):
+        """
+        Parses a multipart form
+        :param headers: The headers of the request
+        :param body: The body of the request
+        :return: A FieldStorage with the fields of the form
+        """
+        return cgi.FieldStorage(fp=StringIO(body), headers=headers,
+                                environ={'REQUEST_METHOD': 'POST',
+                                         'CONTENT_TYPE': headers.getheader('Content-Type'),
+                                         'CONTENT_LENGTH': str(len(body))})
+
+    def form_files(self, form):
+        """
+        Gets the files of a multipart form
+        :param form: A FieldStorage with the fields of the form
+        :return: A list with the fields that are files
+        """
+        return [field for field in form.list or [] if field.filename is not None]
+
+    def is_metered(self, method, path):
+        """
+        Decides if a request is subject to latency and faults
+        :param method: The HTTP method
+        :param path: The path of the URL
+        :return: True for the requests that tag images
+        """
+        return True
+
+    def handle(self, method, path, query, headers, body):
+        """
+        Answers a request like the API does
+        :param method: The HTTP method
+        :param path: The path of the URL
+        :param query: A dict with a list of values per query parameter
+        :param headers: The headers of the request
+        :param body: The body of the request
+        :return: A tuple with the status, the JSON body and the headers of the response
+        """
+        raise NotImplementedError
+
+
+class VisualRecognitionStandIn(StandIn):
+    """
+    Imitates the classify endpoint of Watson Visual Recognition, which gets the images in a zip file
+    """
+    NAME = 'VisualRecognition'
+
+    def __init__(self, **options):
+        super(VisualRecognitionStandIn, self).__init__(**options)
+        self.classifiers = [image['classifiers'] for image in load_fixture('dummy_vr_result.json')['images']]
+
+    def handle(self, method, path, query, headers, body):
+        if method != 'POST' or path != '/v3/classify':
+            return self.error(404, 'Not found')
+        images_file = self.parse_form(headers, body)['images_file']
+        # Watson names the images after the zip file they came in
+        zip_name = os.path.basename(images_file.filename)
+        archive = zipfile.ZipFile(StringIO(images_file.value))
+        images = list()
+        for name in archive.namelist():
+            if not name.endswith('/'):
+                images.append({'image': '%s/%s' % (zip_name, name),
+                               'classifiers': self.classifiers[len(images) % len(self.classifiers)]})
+        return 200, {'custom_classes': 0, 'images': images, 'images_processed': len(images)}, {}
+
+
+class ClarifaiStandIn(StandIn):
+    """
+    Imitates the token, info and tag endpoints of the Clarifai v1 API. Only tagging is metered
+    """
+    NAME = 'Clarifai'
+    MAX_BATCH_SIZE = 128
+
+    def __init__(self, **options):
+        super(ClarifaiStandIn, self).__init__(**options)
+        self.template = load_fixture('dummy_clarifai_result.json')
+
+    def throttle_headers(self):
+        # The Clarifai client waits what this header says before raising its throttled error
+        return {'Retry-After': str(self.RETRY_AFTER), 'X-Throttle-Wait-Seconds': str(self.RETRY_AFTER)}
+
+    def error(self, status, message, headers=None):
+        return status, {'status_code': 'ALL_ERROR', 'status_msg': message}, headers or {}
+
+    def is_metered(self, method, path):
+        return path == '/v1/tag/'
+
+    def handle(self, method, path, query, headers, body):
+        if path == '/v1/token/' and method == 'POST':
+            return 200, {'access_token': uuid.uuid4().hex, 'expires_in': 360000, 'scope': 'api_access',
+                         'token_type': 'Bearer'}, {}
+        if path == '/v1/info/':
+            # Sizes that never make the client resize the images
+            return 200, {'status_code': 'OK', 'status_msg': 'All images in request have completed successfully. ',
+                         'results': {'max_batch_size': self.MAX_BATCH_SIZE, 'min_image_size': 1,
+                                     'max_image_size': 100000, 'default_language': 'en', 'default_model': 'default',
+                                     'api_version': 0.1}}, {}
+        if path == '/v1/tag/' and method == 'POST':
+            form = self.parse_form(headers, body)
+            images = self.form_files(form)
+            # The client sends the local ids of all the images joined by commas, and they are echoed back
+            local_ids = form.getfirst('local_id', '').split(',') if 'local_id' in form else [''] * len(images)
+            if len(local_ids) != len(images):
+                return self.error(400, 'Number of local_ids must match data')
+            response = copy.deepcopy(self.template)
+            templates = self.template['results']
+            response['results'] = list()
+            for position, local_id in enumerate(local_ids):
+                result = copy.deepcopy(templates[position % len(templates)])
+                result['docid_str'] = uuid.uuid4().hex
+                result['docid'] = int(result['docid_str'], 16)
+                result['local_id'] = local_id
+                response['results'].append(result)
+            return 200, response, {}
+        return self.error(404, 'Not found')
+
+
+class ImaggaStandIn(StandIn):
+    """
+    Imitates the content and tagging endpoints of the Imagga v1 API
+    """
+    NAME = 'Imagga'
+
+    def __init__(self, **options):
+        super(ImaggaStandIn, self).__init__(**options)
+        self.template = load_fixture('dummy_imagga_result.json')
+
+    def error(self, status, message, headers=None):
+        return status, {'status': 'error', 'message': message}, headers or {}
+
+    def handle(self, method, path, query, headers, body):
+        if path == '/content' and method == 'POST':
+            uploaded = [{'id': uuid.uuid4().hex, 'filename': os.path.basename(field.filename)}
+                        for field in self.form_files(self.parse_form(headers, body))]
+            return 200, {'status': 'success', 'uploaded': uploaded}, {}
+        if path == '/tagging' and method == 'GET':
+            response = copy.deepcopy(self.template)
+            for result in response['results']:
+                result['image'] = query.get('content', [''])[0]
+            return 200, response, {}
+        return self.error(404, 'Not found')
+
+
+class GoogleVisionStandIn(StandIn):
+    """
+    Imitates the annotate endpoint of Google Cloud Vision, and serves the discovery document the client is
+    built from, pointing it to the stand-in. There is no Google fixture, labels are taken from the Clarifai one
+    """
+    NAME = 'GoogleVision'
+    ANNOTATE_PATH = '/v1/images:annotate'
+    DISCOVERY_PATH = '/discovery'
+
+    def __init__(self, **options):
+        super(GoogleVisionStandIn, self).__init__(**options)
+        self.labels = list()
+        for result in load_fixture('dummy_clarifai_result.json')['results']:
+            tag = result['result']['tag']
+            self.labels.append([{'mid': '/m/%s' % concept_id, 'description': label, 'score': score}
+                                for label, score, concept_id in zip(tag['classes'], tag['probs'], tag['concept_ids'])])
+
+    @property
+    def discovery_url(self):
+        """
+        The URL template of the discovery document, as expected by the discovery-url setting
+        """
+        return '%s%s/{api}/{apiVersion}' % (self.url, self.DISCOVERY_PATH)
+
+    def discovery_document(self):
+        """
+        Builds a discovery document with only the annotate method
+        :return: The document as a dict
+        """
+        return {
+            'kind': 'discovery#restDescription',
+            'discoveryVersion': 'v1',
+            'id': 'vision:v1',
+            'name': 'vision',
+            'version': 'v1',
+            'protocol': 'rest',
+            'rootUrl': self.url + '/',
+            'servicePath': '',
+            'baseUrl': self.url + '/',
+            'batchPath': 'batch',
+            'parameters': {'key': {'type': 'string', 'location': 'query'}},
+            'schemas': {
+                'BatchAnnotateImagesRequest': {'id': 'BatchAnnotateImagesRequest', 'type': 'object',
+                                               'properties': {'requests': {'type': 'array',
+                                                                           'items': {'type': 'object'}}}},
+                'BatchAnnotateImagesResponse': {'id': 'BatchAnnotateImagesResponse', 'type': 'object',
+                                                'properties': {'responses': {'type': 'array',
+                                                                             'items': {'type': 'object'}}}}
+            },
+            'resources': {'images': {'methods': {'annotate': {
+                'id': 'vision.images.annotate',
+                'path': self.ANNOTATE_PATH.lstrip('/'),
+                'httpMethod': 'POST',
+                'parameters': {},
+                'parameterOrder': [],
+                'request': {'$ref': 'BatchAnnotateImagesRequest'},
+                'response': {'$ref': 'BatchAnnotateImagesResponse'}
+            }}}}
+        }
+
+    def error(self, status, message, headers=None):
+        return status, {'error': {'code': status, 'message': message}}, headers or {}
+
+    def is_metered(self, method, path):
+        return path == self.ANNOTATE_PATH
+
+    def handle(self, method, path, query, headers, body):
+        if path.startswith(self.DISCOVERY_PATH) and method == 'GET':
+            return 200, self.discovery_document(), {}
+        if path == self.ANNOTATE_PATH and method == 'POST':
+            responses = list()
+            for position, request in enumerate(json.loads(body).get('requests', [])):
+                max_results = max([feature.get('maxResults', 10) for feature in request.get('features', [])] or [10])
+                labels = self.labels[position % len(self.labels)][:max_results]
+                responses.append({'labelAnnotations': labels})
+            return 200, {'responses': responses}, {}
+        return self.error(404, 'Not found')
+
+
+def make_images(folder, count, width=640, height=480, seed=0):
+    """
+    Fills a folder with synthetic JPEG images, all of them different so no cache can tell them apart
+    :param folder: The full path of the folder, created if it does not exist
+    :param count: The number of images
+    :param width: The width of the images in pixels
+    :param height: The height of the images in pixels
+    :param seed: The seed of the random shapes, the same seed makes the same images
+    :return: A list with the full paths of the images
+    """
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    paths = list()
+    for position in range(count):
+        generator = random.Random(seed * 1000003 + position)
+        image = Image.new('RGB', (width, height), tuple(generator.randint(0, 255) for channel in range(3)))
+        draw = ImageDraw.Draw(image)
+        for shape in range(20):
+            x, y = generator.randint(0, width), generator.randint(0, height)
+            box = [x, y, x + generator.randint(10, width // 2), y + generator.randint(10, height // 2)]
+            color = tuple(generator.randint(0, 255) for channel in range(3))
+            if generator.random() < 0.5:
+                draw.rectangle(box, fill=color)
+            else:
+                draw.ellipse(box, fill=color)
+        image_path = os.path.join(folder, 'image-%05d.jpg' % position)
+        image.save(image_path, 'JPEG', quality=90)
+        paths.append(image_path)
+    return paths
+
+
+def peak_rss():
+    """
+    Gets the peak resident memory of the current process
+    :return: The peak RSS in megabytes
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, OS X bytes
+    return peak / (1024.0 * 1024.0) if sys.platform == 'darwin' else peak / 1024.0
+
+
+class Benchmark(object):
+    """
+    Measures the tagger against the local stand-ins of all the APIs, so it runs without network and its results
+    only depend on the code and the configured behaviour of the stand-ins. Every path runs in its own process,
+    so its peak memory is not hidden by the paths that ran before. For every path it reports the images per
+    second, the p50 and p99 latency of the requests as seen by the tagger, and the peak RSS
+    """
+    PATHS = ['use_all', 'use_all_concurrent', 'visual_recognition', 'clarifai', 'imagga', 'google_vision']
+    # Quotas high enough for the client side rate limiter to stay out of the way, unless configured otherwise
+    GOOGLE_VISION_REQUESTS_PER_MINUTE = 1000000
+    GOOGLE_VISION_IMAGES_PER_MINUTE = 1000000
+
+    def __init__(self, stand_ins=None, quiet=True, **options):
+        """
+        :param stand_ins: An optional dict with the API name as key and its StandIn as value, to configure them
+        one by one. Missing ones are created with options
+        :param quiet: If true, what the tagger prints while a path runs is discarded
+        :param options: The options of the StandIn of every API not given in stand_ins
+        """
+        self.stand_ins = dict(stand_ins or {})
+        for stand_in_class in [VisualRecognitionStandIn, ClarifaiStandIn, ImaggaStandIn, GoogleVisionStandIn]:
+            if stand_in_class.NAME not in self.stand_ins:
+                self.stand_ins[stand_in_class.NAME] = stand_in_class(**options)
+        self.quiet = quiet
+        self.config_file = None
+        self.discovery_file = None
+
+    def start(self):
+        """
+        Starts all the stand-ins and writes a config file that points the clients to them
+        :return: The benchmark itself
+        """
+        for stand_in in self.stand_ins.itervalues():
+            stand_in.start()
+        # Read from a file like a bundled document would be, so every process does not download it
+        discovery_handle, self.discovery_file = tempfile.mkstemp(prefix='benchmark-', suffix='.json')
+        with os.fdopen(discovery_handle, 'w') as discovery_file:
+            json.dump(self.stand_ins['GoogleVision'].discovery_document(), discovery_file)
+        config = {
+            'visual-recognition': {'api-key': 'stand-in', 'url': self.stand_ins['VisualRecognition'].url},
+            'clarifai': {'client-id': 'stand-in', 'client-secret': 'stand-in',
+                         'base-url': self.stand_ins['Clarifai'].url},
+            'imagga': {'api-key': 'stand-in', 'api-secret': 'stand-in', 'endpoint': self.stand_ins['Imagga'].url},
+            'google-vision': {'api-key': 'stand-in', 'discovery-document': self.discovery_file,
+                              'requests-per-minute': self.GOOGLE_VISION_REQUESTS_PER_MINUTE,
+                              'images-per-minute': self.GOOGLE_VISION_IMAGES_PER_MINUTE}
+        }
+        config_handle, self.config_file = tempfile.mkstemp(prefix='benchmark-', suffix='.yml')
+        with os.fdopen(config_handle, 'w') as config_file:
+            yaml.safe_dump(config, config_file, default_flow_style=False)
+        return self
+
+    def stop(self):
+        """
+        Stops all the stand-ins and removes the config and discovery files
+        """
+        for stand_in in self.stand_ins.itervalues():
+            stand_in.stop()
+        for file_path in [self.config_file, self.discovery_file]:
+            if file_path and os.path.isfile(file_path):
+                os.remove(file_path)
+        self.config_file = None
+        self.discovery_file = None
+
+    def make_tagger(self, metrics=None):
+        """
+        Creates a tagger configured to use the stand-ins, without caches so every image is sent
+        :param metrics: Optional Metrics shared by the tagger and the Imagga helper
+        :return: The configured ImageTagger
+        """
+        options = dict(metrics=metrics) if metrics is not None else dict()
+        imagga_helper = ImaggaHelper(**options)
+        imagga_helper.configure_imagga_helper(self.config_file)
+        tagger = ImageTagger(imagga_helper=imagga_helper, **options)
+        tagger.configure_tagger(self.config_file)
+        return tagger
+
+    def record_latencies(self, tagger):
+        """
+        Times every attempt of every request the tagger makes, including the ones that are retried
+        :param tagger: The ImageTagger whose call guards are timed
+        :return: The list the latencies, in seconds, are appended to
+        """
+        latencies = list()
+
+        def timed(guard):
+            call = guard.call
+
+            def timed_call(function, args=(), kwargs=None, hedge=True):
+                def attempt(*attempt_args, **attempt_kwargs):
+                    started = time.time()
+                    try:
+                        return function(*attempt_args, **attempt_kwargs)
+                    finally:
+                        latencies.append(time.time() - started)
+                return call(attempt, args, kwargs, hedge)
+            guard.call = timed_call
+
+        for guard in [tagger.visual_recognition_guard, tagger.clarifai_guard, tagger.google_vision_guard,
+                      tagger.imagga_helper.guard]:
+            timed(guard)
+        return latencies
+
+    def run_path(self, path, folder):
+        """
+        Tags a folder with one of the paths of PATHS in the current process
+        :param path: The name of the path
+        :param folder: The full path of the folder with the images
+        :return: A dict with the measures of the run, including a snapshot of the metrics of every stage
+        """
+        metrics = Metrics()
+        tagger = self.make_tagger(metrics)
+        latencies = self.record_latencies(tagger)
+        processors = {
+            'use_all': lambda: tagger.use_all(folder),
+            'use_all_concurrent': lambda: tagger.use_all(folder, concurrent=True),
+            'visual_recognition': lambda: tagger.process_images_visual_recognition(folder),
+            'clarifai': lambda: tagger.process_images_clarifai(folder),
+            'imagga': lambda: tagger.imagga_helper.process_images(folder),
+            'google_vision': lambda: tagger.process_images_google_vision(folder)
+        }
+        images = len(tagger.scan(folder))
+        started = time.time()
+        data_frame = processors[path]()
+        seconds = time.time() - started
+        tagged = 0
+        if data_frame is not None:
+            tagged = int(data_frame.notnull().any(axis=1).sum())
+        return {
+            'path': path,
+            'images': images,
+            'tagged': tagged,
+            'seconds': seconds,
+            'images_per_second': images / seconds if seconds else 0.0,
+            'requests': len(latencies),
+            'p50': float(numpy.percentile(latencies, 50)) if latencies else None,
+            'p99': float(numpy.percentile(latencies, 99)) if latencies else None,
+            'peak_rss_mb': peak_rss(),
+            'metrics': metrics.snapshot()
+        }
+
+    def run_isolated(self, path, folder):
+        """
+        Runs a path in a child process, so its peak RSS is only its own
+        :param path: The name of the path
+        :param folder: The full path of the folder with the images
+        :return: A dict with the measures of the run
+        """
+        results = multiprocessing.Queue()
+
+        def run():
+            if self.quiet:
+                sys.stdout = open(os.devnull, 'w')
+            try:
+                results.put(self.run_path(path, folder))
+            except Exception as ex:
+                results.put({'path': path, 'error': str(ex)})
+
+        process = multiprocessing.Process(target=run, name='benchmark-%s' % path)
+        process.start()
+        result = results.get()
+        process.join()
+        return result
+
+    def run(self, folder, paths=PATHS):
+        """
+        Runs every path over a folder, one after another
+        :param folder: The full path of the folder with the images
+        :param paths: A list with the names of the paths to run
+        :return: A list with a dict of measures per path, including what the stand-ins counted
+        """
+        results = list()
+        for path in paths:
+            before = dict((name, stand_in.stats()) for name, stand_in in self.stand_ins.iteritems())
+            result = self.run_isolated(path, folder)
+            result['stand_ins'] = dict()
+            for name, stand_in in self.stand_ins.iteritems():
+                after = stand_in.stats()
+                result['stand_ins'][name] = dict((counter, after[counter] - before[name][counter])
+                                                 for counter in after)
+            results.append(result)
+        return results
+
+    def report(self, results):
+        """
+        Formats the results of run as a table
+        :param results: The list returned by run
+        :return: The table as a string
+        """
+        lines = ['{0:<20} {1:>7} {2:>7} {3:>9} {4:>10} {5:>9} {6:>9} {7:>10}'.format(
+            'path', 'images', 'tagged', 'seconds', 'images/s', 'p50 ms', 'p99 ms', 'peak MB')]
+        for result in results:
+            if 'error' in result:
+                lines.append('{0:<20} failed: {1}'.format(result['path'], result['error']))
+                continue
+            milliseconds = lambda value: '-' if value is None else '%.1f' % (value * 1000)
+            lines.append('{0:<20} {1:>7} {2:>7} {3:>9.2f} {4:>10.1f} {5:>9} {6:>9} {7:>10.1f}'.format(
+                result['path'], result['images'], result['tagged'], result['seconds'], result['images_per_second'],
+                milliseconds(result['p50']), milliseconds(result['p99']), result['peak_rss_mb']))
+        return '\n'.join(lines)
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description='Benchmarks the tagger against local stand-ins of the APIs')
+    parser.add_argument('--images', type=int, default=100, help='number of synthetic images')
+    parser.add_argument('--width', type=int, default=640, help='width of the images in pixels')
+    parser.add_argument('--height', type=int, default=480, help='height of the images in pixels')
+    parser.add_argument('--folder', help='folder with the images to use instead of synthetic ones')
+    parser.add_argument('--paths', default=','.join(Benchmark.PATHS),
+                        help='comma separated paths to run, from %s' % ', '.join(Benchmark.PATHS))
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds every request takes')
+    parser.add_argument('--jitter', type=float, default=0.0, help='maximum random seconds added to the latency')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='ratio of requests that fail with a 503')
+    parser.add_argument('--requests-per-second', type=float, help='requests per second before throttling')
+    parser.add_argument('--max-payload-bytes', type=int, help='maximum request body before a 413')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the images, latencies and errors')
+    parser.add_argument('--output', help='file to write the results to as JSON')
+    parser.add_argument('--verbose', action='store_true', help='show what the tagger prints')
+    options = parser.parse_args(arguments)
+
+    folder = options.folder
+    synthetic = folder is None
+    if synthetic:
+        folder = tempfile.mkdtemp(prefix='benchmark-images-')
+        make_images(folder, options.images, options.width, options.height, options.seed)
+    benchmark = Benchmark(quiet=not options.verbose, latency=options.latency, jitter=options.jitter,
+                          error_rate=options.error_rate, requests_per_second=options.requests_per_second,
+                          max_payload_bytes=options.max_payload_bytes, seed=options.seed).start()
+    try:
+        results = benchmark.run(folder, [path.strip() for path in options.paths.split(',') if path.strip()])
+    finally:
+        benchmark.stop()
+        if synthetic:
+            shutil.rmtree(folder)
+    print(benchmark.report(results))
+    if options.output:
+        with open(options.output, 'w') as output:
+            json.dump(results, output, indent=4, sort_keys=True)
+    return results
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,218 @@
+import time
+import sqlite3
+import threading
+
+from metrics import NULL_METRICS
+
+
+class ProviderBudgets(object):
+    """
+    Daily limits of every API, in tagging calls and in spend. A call is one image tagged, which is how the APIs
+    count their quotas and fees. Usage is kept in a SQLite database, so runs of the same day share the limits
+    if they use the same file. Days are UTC days
+    """
+    DEFAULT_DB_PATH = 'tagging_budgets.db'
+
+    def __init__(self, limits=None, db_path=DEFAULT_DB_PATH):
+        """
+        :param limits: A dict with the API name as key and a dict as value, with the optional calls and spend
+        allowed per day and the cost of a call. APIs that are not there have no limits
+        :param db_path: The file path of the SQLite database, created if it does not exist. :memory: keeps the
+        usage only while the budgets exist
+        """
+        self.limits = dict(limits or {})
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(db_path, check_same_thread=False)
+        with self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS usage ('
+                                    'api TEXT NOT NULL, '
+                                    'day TEXT NOT NULL, '
+                                    'calls INTEGER NOT NULL, '
+                                    'spend REAL NOT NULL, '
+                                    'PRIMARY KEY (api, day))')
+
+    def today(self):
+        return time.strftime('%Y-%m-%d', time.gmtime())
+
+    def usage(self, api):
+        """
+        Gets what an API used today
+        :param api: The name of the API
+        :return: A tuple with the calls made and the money spent
+        """
+        row = self.connection.execute('SELECT calls, spend FROM usage WHERE api = ? AND day = ?',
+                                      (api, self.today())).fetchone()
+        return tuple(row) if row else (0, 0.0)
+
+    def available(self, api):
+        """
+        Gets how many calls an API can still make today
+        :param api: The name of the API
+        :return: The number of calls, None if there is no limit
+        """
+        limit = self.limits.get(api, {})
+        calls, spend = self.usage(api)
+        available = list()
+        if limit.get('calls') is not None:
+            available.append(max(0, limit['calls'] - calls))
+        if limit.get('spend') is not None and limit.get('cost'):
+            # A tiny margin so float sums like 0.1 + 0.2 do not lose a whole call
+            available.append(max(0, int((limit['spend'] - spend) / limit['cost'] + 1e-9)))
+        return min(available) if available else None
+
+    def reserve(self, api, calls):
+        """
+        Takes as many calls as the budget of an API allows, up to the ones wanted, and records them as used
+        :param api: The name of the API
+        :param calls: The calls wanted
+        :return: The calls that can be made, from 0 to the ones wanted
+        """
+        with self.lock:
+            available = self.available(api)
+            granted = calls if available is None else min(calls, available)
+            if granted:
+                cost = self.limits.get(api, {}).get('cost') or 0.0
+                with self.connection:
+                    self.connection.execute('INSERT OR IGNORE INTO usage (api, day, calls, spend) VALUES (?, ?, 0, 0)',
+                                            (api, self.today()))
+                    self.connection.execute('UPDATE usage SET calls = calls + ?, spend = spend + ? '
+                                            'WHERE api = ? AND day = ?', (granted, granted * cost, api, self.today()))
+            return granted
+
+    def refund(self, api, calls):
+        """
+        Gives back calls reserved for an API that were not made, like the ones of a request that failed
+        :param api: The name of the API
+        :param calls: The calls to give back
+        """
+        if not calls:
+            return
+        with self.lock:
+            cost = self.limits.get(api, {}).get('cost') or 0.0
+            with self.connection:
+                self.connection.execute('UPDATE usage SET calls = MAX(0, calls - ?), spend = MAX(0, spend - ?) '
+                                        'WHERE api = ? AND day = ?', (calls, calls * cost, api, self.today()))
+
+    def close(self):
+        self.connection.close()
+
+
+class TaggingCascade(object):
+    """
+    Tags images with one API at a time instead of all of them. Every image goes to the first API of the order,
+    usually the cheapest or fastest one, and only goes on to the next one when its result is weak: too few tags,
+    or a best score below the threshold. APIs that ran out of budget are skipped, and the images they could
+    not take go on to the next API. Only calls that are actually made take budget, cached results are free and
+    calls that get no answer are given back
+    """
+    ORDER = ['Clarifai', 'GoogleVision', 'Imagga', 'VisualRecognition']
+    # A result is weak with fewer tags than this, or if its best score is below the minimum
+    MIN_TAGS = 3
+    MIN_TOP_SCORE = 0.9
+    # Scores of every API are divided by these to get the 0 to 1 range, like TagConsensus does
+    SCORE_SCALES = {
+        'Imagga': 100.0
+    }
+
+    def __init__(self, tagger, order=None, min_top_score=MIN_TOP_SCORE, min_tags=MIN_TAGS, budgets=None,
+                 score_scales=None, metrics=NULL_METRICS):
+        """
+        :param tagger: A configured ImageTagger, with an ImaggaHelper if Imagga is used
+        :param order: The names of the APIs in the order they are tried, ORDER by default
+        :param min_top_score: The best score, from 0 to 1, a result needs to not be weak
+        :param min_tags: The tags a result needs to not be weak
+        :param budgets: Optional ProviderBudgets with the daily limits of the APIs
+        :param score_scales: A dict with the API name as key and the maximum score as value, merged with
+        SCORE_SCALES
+        :param metrics: The Metrics that count the images sent to every API and the ones escalated from it
+        """
+        self.tagger = tagger
+        self.order = list(order or self.ORDER)
+        self.min_top_score = min_top_score
+        self.min_tags = min_tags
+        self.budgets = budgets
+        self.score_scales = dict(self.SCORE_SCALES)
+        self.score_scales.update(score_scales or {})
+        self.metrics = metrics
+        # The API whose result was kept for every image of the last run, None for the ones no API was sure of
+        self.resolved = dict()
+
+    def is_weak(self, api, tags):
+        """
+        Tells if a result is not good enough to stop at it
+        :param api: The name of the API
+        :param tags: The list of tuples with the tags found and their scores, None if the image got no result
+        :return: True if the image should go on to the next API
+        """
+        if not tags or len(tags) < self.min_tags:
+            return True
+        top_score = max(float(score) for tag, score in tags) / self.score_scales.get(api, 1.0)
+        return top_score < self.min_top_score
+
+    def iter_cascade(self, folder):
+        """
+        Tags the folder going down the APIs, yielding the tags of every image and API as soon as they are found.
+        An image can get tags from several APIs, the last one is the one that resolved it, if any
+        :param folder: The folder containing images to be tagged, or a catalog built by scan
+        :return: A generator of tuples with the image name, the API name and the list of tuples with the tags found
+        """
+        catalog = self.tagger.scan(folder) if isinstance(folder, basestring) else list(folder)
+        iterators = self.tagger.api_iterators()
+        self.resolved = dict((image.name, None) for image in catalog)
+        pending = catalog
+        for api in self.order:
+            if not pending:
+                break
+            if api not in iterators:
+                continue
+            found = dict()
+            uncached = list()
+            for image in pending:
+                cached_tags = self.tagger.get_api_cached_tags(api, image)
+                if cached_tags is not None:
+                    found[image.name] = cached_tags
+                else:
+                    uncached.append(image)
+            allowed = len(uncached) if self.budgets is None else self.budgets.reserve(api, len(uncached))
+            if uncached and not allowed:
+                print('{0} has no budget left today, skipping it'.format(api))
+            sending, waiting = uncached[:allowed], uncached[allowed:]
+            for image in pending:
+                if image.name in found:
+                    yield image.name, api, found[image.name]
+            if sending:
+                for image_name, api_name, tags in iterators[api](sending):
+                    found[image_name] = tags
+                    yield image_name, api_name, tags
+            if self.budgets is not None:
+                # Images the API gave no answer for were not tagged, their calls failed or were never made
+                self.budgets.refund(api, len([image for image in sending if image.name not in found]))
+            # The images this API answered for from its cache or was asked about, in their order
+            sent_names = set(image.name for image in sending)
+            tried = [image for image in pending if image.name in found or image.name in sent_names]
+            pending = list()
+            for image in tried:
+                if self.is_weak(api, found.get(image.name)):
+                    pending.append(image)
+                else:
+                    self.resolved[image.name] = api
+            self.metrics.increment('cascade_images', len(tried), api)
+            self.metrics.increment('cascade_escalated', len(pending), api)
+            # Images over the budget go on as they are, after the ones that were weak
+            pending.extend(waiting)
+
+    def use_cascade(self, folder):
+        """
+        Tags the folder going down the APIs, like use_all but calling only the APIs every image needs
+        :param folder: The folder containing images to be tagged, or a catalog built by scan
+        :return: A DataFrame with a column per API of the order, with the tags found by the APIs that were
+        called for every image and NaN for the others
+        """
+        import pandas
+        results = dict((api, dict()) for api in self.order)
+        for image_name, api, tags in self.iter_cascade(folder):
+            results[api][image_name] = tags
+        sorted_names = sorted(self.resolved)
+        with self.metrics.timer('data_frame'):
+            return pandas.concat([pandas.Series(results[api], index=sorted_names, name=api) for api in self.order],
+                                 axis=1)
@@ -0,0 +1,257 @@
+import os
+import sys
+import json
+import time
+import argparse
+import multiprocessing
+
+from image_tagging import ImageTagger
+from imagga import ImaggaHelper
+from result_cache import ResultCache
+from manifest import Manifest
+from scanner import ImageScanner, CatalogImage
+
+
+APIS = ['VisualRecognition', 'Clarifai', 'Imagga', 'GoogleVision']
+# Images given to a worker at a time, enough to fill the batches of every API
+CHUNK_SIZE = 100
+
+# The tagger of every worker process, created once by init_worker so clients and connections are reused
+worker_tagger = None
+worker_apis = None
+
+
+def iter_directory(folder, file_types=ImageScanner.IMAGE_FILE_TYPES):
+    """
+    Finds the images of a directory tree
+    :param folder: The full path of the folder
+    :param file_types: The file extensions considered images
+    :return: A generator of tuples with the path and the name of every image, the name being relative to the folder
+    """
+    for image in ImageScanner(file_types).iter_images(folder):
+        yield image.path, image.name
+
+
+def iter_manifest(manifest_file):
+    """
+    Reads the images listed in a JSONL manifest, one per line. A line can be a JSON string with the path,
+    or an object with a path and an optional name, the path being the name by default. Blank lines are skipped
+    :param manifest_file: An open file with the manifest
+    :return: A generator of tuples with the path and the name of every image
+    """
+    for line_number, line in enumerate(manifest_file, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            entry = json.loads(line)
+        except ValueError as ex:
+            print >> sys.stderr, 'Skipping line {0} of the manifest, it is not JSON. More info {1}'.format(
+                line_number, str(ex))
+            continue
+        if isinstance(entry, basestring):
+            yield entry, entry
+        elif isinstance(entry, dict) and entry.get('path'):
+            yield entry['path'], entry.get('name') or entry['path']
+        else:
+            print >> sys.stderr, 'Skipping line {0} of the manifest, it has no path'.format(line_number)
+
+
+def iter_chunks(entries, chunk_size=CHUNK_SIZE):
+    """
+    Groups entries in lists, without reading more of them than needed for the next list
+    :param entries: An iterable
+    :param chunk_size: The maximum length of every list
+    :return: A generator of lists
+    """
+    chunk = list()
+    for entry in entries:
+        chunk.append(entry)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = list()
+    if chunk:
+        yield chunk
+
+
+def init_worker(config_file, apis, cache_db=None, manifest_db=None, verbose=False, dedup_distance=None):
+    """
+    Creates the clients of a worker process. Every worker has its own, connections cannot be shared
+    between processes
+    :param config_file: The file path to the config YAML file
+    :param apis: A list with the names of the APIs to use
+    :param cache_db: The path of a ResultCache database shared by all the workers, if any
+    :param manifest_db: The path of a Manifest database shared by all the workers, if any
+    :param verbose: If false, what the clients print is discarded
+    :param dedup_distance: If given, near duplicates within this Hamming distance in a chunk are tagged only once
+    """
+    global worker_tagger, worker_apis
+    if not verbose:
+        sys.stdout = open(os.devnull, 'w')
+    result_cache = ResultCache(cache_db) if cache_db else None
+    manifest = Manifest(manifest_db) if manifest_db else None
+    imagga_helper = None
+    if 'Imagga' in apis:
+        imagga_helper = ImaggaHelper(result_cache=result_cache, manifest=manifest)
+        imagga_helper.configure_imagga_helper(config_file)
+    deduplicator = None
+    if dedup_distance is not None:
+        # Needs Pillow, only imported when asked for
+        from dedup import ImageDeduplicator
+        deduplicator = ImageDeduplicator(max_distance=dedup_distance)
+    worker_tagger = ImageTagger(imagga_helper=imagga_helper, result_cache=result_cache, manifest=manifest,
+                                deduplicator=deduplicator)
+    worker_tagger.configure_tagger(config_file)
+    worker_apis = apis
+
+
+def tag_chunk(entries):
+    """
+    Tags a chunk of images with the tagger of the worker, all the APIs at the same time
+    :param entries: A list of tuples with the path and the name of every image
+    :return: A list with a dict per image, with its name, path and the tags found by every API, or an error
+    """
+    catalog = list()
+    results = list()
+    for image_path, image_name in entries:
+        if not os.path.isfile(image_path):
+            results.append({'image': image_name, 'path': image_path, 'error': 'The image does not exist'})
+            continue
+        catalog.append(CatalogImage(image_path, image_name, os.path.getsize(image_path),
+                                    image_path.split('.')[-1].lower()))
+    tags = dict((image.name, dict()) for image in catalog)
+    try:
+        for image_name, api, image_tags in worker_tagger.iter_all(catalog, worker_apis):
+            tags[image_name][api] = [list(tag) for tag in image_tags]
+    except Exception as ex:
+        # The images of this chunk get whatever was tagged before the failure
+        print >> sys.stderr, 'A chunk of {0} images failed. More info {1}'.format(len(entries), str(ex))
+    for image in catalog:
+        results.append({'image': image.name, 'path': image.path, 'tags': tags[image.name]})
+    return results
+
+
+class Progress(object):
+    """
+    Shows the images processed and the throughput on a single line of a terminal
+    """
+
+    def __init__(self, stream=sys.stderr, enabled=True):
+        """
+        :param stream: Where the progress is written
+        :param enabled: If false nothing is shown
+        """
+        self.stream = stream
+        self.enabled = enabled
+        self.started = time.time()
+        self.images = 0
+        self.errors = 0
+
+    def update(self, images, errors=0):
+        """
+        Counts processed images and shows the totals so far
+        :param images: The number of images just processed
+        :param errors: How many of them could not be processed
+        """
+        self.images += images
+        self.errors += errors
+        if self.enabled:
+            self.stream.write('\r' + self.status())
+            self.stream.flush()
+
+    def status(self):
+        """
+        Formats the totals so far
+        :return: A line with the images processed, the errors and the images per second
+        """
+        seconds = max(time.time() - self.started, 1e-6)
+        return '{0} images, {1} errors, {2:.1f} images/s, {3:.0f} s'.format(
+            self.images, self.errors, self.images / seconds, seconds)
+
+    def finish(self):
+        """
+        Ends the progress line
+        """
+        if self.enabled:
+            self.stream.write('\r' + self.status() + '\n')
+            self.stream.flush()
+
+
+def parse_arguments(arguments=None):
+    parser = argparse.ArgumentParser(
+        description='Tags a directory tree or a JSONL manifest of images with several APIs, '
+                    'sharding the images across worker processes')
+    parser.add_argument('source', help='a directory to scan for images, or a JSONL manifest with one image per '
+                                       'line, as a path string or an object with path and optional name')
+    parser.add_argument('-o', '--output', default='-', help='the JSONL file results are streamed to, - for stdout')
+    parser.add_argument('-c', '--config', default='config.yml', help='the YAML file with the API credentials')
+    parser.add_argument('-w', '--workers', type=int, default=multiprocessing.cpu_count(),
+                        help='the number of worker processes, the number of cores by default')
+    parser.add_argument('--apis', default=','.join(APIS),
+                        help='comma separated APIs to use, from %s' % ', '.join(APIS))
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE, help='images given to a worker at a time')
+    parser.add_argument('--cache-db', help='a result cache database shared by the workers')
+    parser.add_argument('--manifest-db', help='a tagging manifest database, so interrupted runs resume')
+    parser.add_argument('--dedup-distance', type=int,
+                        help='tag only one image of every group of near duplicates in a chunk, those whose '
+                             'perceptual hashes differ in at most this many bits, and copy its tags to the others')
+    parser.add_argument('--append', action='store_true', help='append to the output file instead of replacing it')
+    parser.add_argument('--quiet', action='store_true', help='do not show the progress')
+    parser.add_argument('--verbose', action='store_true', help='show what the API clients print')
+    options = parser.parse_args(arguments)
+    options.apis = [api.strip() for api in options.apis.split(',') if api.strip()]
+    unknown = [api for api in options.apis if api not in APIS]
+    if unknown or not options.apis:
+        parser.error('unknown APIs %s, choose from %s' % (', '.join(unknown), ', '.join(APIS)))
+    if options.workers < 1 or options.chunk_size < 1:
+        parser.error('workers and chunk size must be positive')
+    if options.dedup_distance is not None and options.dedup_distance < 0:
+        parser.error('the dedup distance cannot be negative')
+    if not os.path.isfile(options.config):
+        parser.error('the config file %s does not exist' % options.config)
+    if not os.path.exists(options.source):
+        parser.error('%s does not exist' % options.source)
+    return options
+
+
+def main(arguments=None):
+    options = parse_arguments(arguments)
+    manifest_file = None
+    if os.path.isdir(options.source):
+        entries = iter_directory(options.source)
+    else:
+        manifest_file = open(options.source)
+        entries = iter_manifest(manifest_file)
+
+    if options.output == '-':
+        output = sys.stdout
+    else:
+        output = open(options.output, 'a' if options.append else 'w')
+    progress = Progress(enabled=not options.quiet)
+    pool = multiprocessing.Pool(processes=options.workers, initializer=init_worker,
+                                initargs=(options.config, options.apis, options.cache_db, options.manifest_db,
+                                          options.verbose, options.dedup_distance))
+    try:
+        # Chunks are written as soon as any worker finishes one, in whatever order they finish
+        for results in pool.imap_unordered(tag_chunk, iter_chunks(entries, options.chunk_size)):
+            for result in results:
+                output.write(json.dumps(result, sort_keys=True) + '\n')
+            output.flush()
+            progress.update(len(results), sum(1 for result in results if 'error' in result))
+        pool.close()
+    except BaseException:
+        # Interrupted or failed, the chunks being tagged are lost
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        progress.finish()
+        if output is not sys.stdout:
+            output.close()
+        if manifest_file is not None:
+            manifest_file.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
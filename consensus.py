@@ -0,0 +1,170 @@
+import numpy
+import pandas
+from result_store import TagStore
+
+
+def normalize_tag(tag):
+    """
+    Normalizes a tag so the same label written differently by each API is counted once
+    :param tag: The tag as returned by an API
+    :return: The tag in lower case, with underscores and hyphens as spaces and no repeated spaces
+    """
+    return u' '.join(tag.lower().replace(u'_', u' ').replace(u'-', u' ').split())
+
+
+class TagConsensus(object):
+    """
+    Combines the tags found by every API into a consensus per image. Tags are normalized into a shared
+    vocabulary and scores into the 0 to 1 range, then every image and tag gets:
+    - consensus: the mean of the best score of every API that tagged the image, 0 for APIs that missed the tag
+    - agreement: the ratio of APIs that tagged the image and found the tag
+    - votes: the number of APIs that found the tag
+    Everything is computed with numpy over the columns of a TagStore, without looping over images
+    """
+    # Scores of every API are divided by these to get the 0 to 1 range, Imagga confidences go up to 100
+    SCORE_SCALES = {
+        'Imagga': 100.0
+    }
+
+    def __init__(self, store, synonyms=None, score_scales=None):
+        """
+        :param store: A TagStore with the results of the APIs
+        :param synonyms: An optional dict that maps normalized tags to the tag they should be counted as
+        :param score_scales: A dict with the API name as key and the maximum score as value, merged with SCORE_SCALES
+        """
+        self.store = store
+        # normalize_tag applies the synonyms, so they are normalized before any is known
+        self.synonyms = dict()
+        self.synonyms = dict((self.normalize_tag(tag), self.normalize_tag(synonym))
+                             for tag, synonym in (synonyms or {}).items())
+        self.score_scales = dict(self.SCORE_SCALES)
+        self.score_scales.update(score_scales or {})
+        self.vocabulary = list()
+        self.compute()
+
+    @classmethod
+    def from_data_frame(cls, data_frame, synonyms=None, score_scales=None):
+        """
+        Builds the consensus of a DataFrame returned by use_all
+        :param data_frame: The DataFrame with the API names as columns and lists of tuples with the tags as cells
+        :param synonyms: An optional dict that maps normalized tags to the tag they should be counted as
+        :param score_scales: A dict with the API name as key and the maximum score as value
+        :return: The consensus
+        """
+        return cls(TagStore().add_data_frame(data_frame), synonyms, score_scales)
+
+    def normalize_tag(self, tag):
+        """
+        Normalizes a tag and replaces it by its synonym, if it has one
+        :param tag: The tag as returned by an API
+        :return: The tag as counted in the vocabulary
+        """
+        tag = normalize_tag(tag)
+        return self.synonyms.get(tag, tag)
+
+    def build_vocabulary(self):
+        """
+        Maps the tags of the store to the shared vocabulary. Only the distinct tags are looped over
+        :return: An array with the vocabulary code of every tag code of the store
+        """
+        codes = dict()
+        tag_map = numpy.empty(len(self.store.tags), dtype=numpy.int64)
+        for tag_code, tag in enumerate(self.store.tags):
+            tag = self.normalize_tag(tag)
+            if tag not in codes:
+                codes[tag] = len(self.vocabulary)
+                self.vocabulary.append(tag)
+            tag_map[tag_code] = codes[tag]
+        return tag_map
+
+    def compute(self):
+        """
+        Computes the best score of every image, tag and API and the consensus of every image and tag
+        """
+        image_column, api_column, tag_column, score_column = self.store.columns()
+        tags = self.build_vocabulary()[tag_column]
+        images = image_column.astype(numpy.int64)
+        apis = api_column.astype(numpy.int64)
+        scales = numpy.array([self.score_scales.get(api, 1.0) for api in self.store.apis], dtype=numpy.float32)
+        scores = numpy.clip(score_column / scales[apis], 0, 1)
+        apis_count = max(1, len(self.store.apis))
+        vocabulary_size = max(1, len(self.vocabulary))
+
+        # An API may return the same normalized tag twice for an image, keep its best score
+        pair_keys = images * vocabulary_size + tags
+        triples, triple_rows = numpy.unique(pair_keys * apis_count + apis, return_inverse=True)
+        self.api_scores = numpy.zeros(len(triples), dtype=numpy.float32)
+        numpy.maximum.at(self.api_scores, triple_rows, scores)
+        self.api_codes = triples % apis_count
+        pairs, pair_rows = numpy.unique(triples // apis_count, return_inverse=True)
+        self.triple_pairs = pair_rows
+        self.image_codes = pairs // vocabulary_size
+        self.tag_codes = pairs % vocabulary_size
+
+        # APIs that tagged an image count for all of its tags, even the ones they did not find
+        image_apis = numpy.unique(images * apis_count + apis) // apis_count
+        providers = numpy.bincount(image_apis, minlength=len(self.store.images))[self.image_codes]
+        self.votes = numpy.bincount(pair_rows, minlength=len(pairs))
+        providers = numpy.maximum(providers, 1).astype(numpy.float32)
+        self.consensus = (numpy.bincount(pair_rows, weights=self.api_scores, minlength=len(pairs)) /
+                          providers).astype(numpy.float32)
+        self.agreement = (self.votes / providers).astype(numpy.float32)
+
+    def to_data_frame(self):
+        """
+        Builds a long format DataFrame with the consensus of every image and tag, sorted by image and tag
+        :return: A DataFrame with image, tag, consensus, agreement and votes columns
+        """
+        return pandas.DataFrame({
+            'image': pandas.Categorical.from_codes(self.image_codes, self.store.images),
+            'tag': pandas.Categorical.from_codes(self.tag_codes, self.vocabulary),
+            'consensus': self.consensus,
+            'agreement': self.agreement,
+            'votes': self.votes
+        }, columns=['image', 'tag', 'consensus', 'agreement', 'votes'])
+
+    def top_tags(self, k=5, min_agreement=0.0):
+        """
+        Gets the best tags of every image by consensus, ties broken by agreement
+        :param k: The maximum number of tags per image
+        :param min_agreement: The minimum agreement ratio a tag needs to be considered
+        :return: A DataFrame like to_data_frame with a rank column, sorted by image and rank
+        """
+        selected = numpy.flatnonzero(self.agreement >= min_agreement)
+        # lexsort uses the last key as the primary one
+        order = selected[numpy.lexsort((-self.agreement[selected], -self.consensus[selected],
+                                        self.image_codes[selected]))]
+        images = self.image_codes[order]
+        # The rank is the position of a row minus the position of the first row of its image
+        starts = numpy.flatnonzero(numpy.r_[True, images[1:] != images[:-1]])
+        ranks = numpy.arange(len(images)) - numpy.repeat(starts, numpy.diff(numpy.r_[starts, len(images)]))
+        kept = ranks < k
+        data_frame = self.to_data_frame().iloc[order[kept]].reset_index(drop=True)
+        data_frame['rank'] = ranks[kept] + 1
+        return data_frame
+
+    def provider_matrices(self):
+        """
+        Builds a sparse image by tag matrix of scores for every API. Needs scipy
+        :return: A dict with the API name as key and a scipy CSR matrix as value, rows are image codes of the
+        store and columns are positions in the vocabulary
+        """
+        # Only needed by sparse matrix users, so it is not a requirement
+        from scipy import sparse
+        shape = (len(self.store.images), len(self.vocabulary))
+        images = self.image_codes[self.triple_pairs]
+        tags = self.tag_codes[self.triple_pairs]
+        matrices = dict()
+        for api_code, api in enumerate(self.store.apis):
+            rows = self.api_codes == api_code
+            matrices[api] = sparse.csr_matrix((self.api_scores[rows], (images[rows], tags[rows])), shape=shape)
+        return matrices
+
+    def consensus_matrix(self):
+        """
+        Builds a sparse image by tag matrix of consensus scores. Needs scipy
+        :return: A scipy CSR matrix, rows are image codes of the store and columns are positions in the vocabulary
+        """
+        from scipy import sparse
+        shape = (len(self.store.images), len(self.vocabulary))
+        return sparse.csr_matrix((self.consensus, (self.image_codes, self.tag_codes)), shape=shape)
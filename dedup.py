@@ -0,0 +1,156 @@
+from multiprocessing.pool import ThreadPool
+from PIL import Image
+
+
+def hamming_distance(first_hash, second_hash):
+    """
+    Counts the bits that differ between two hashes
+    :param first_hash: An integer hash
+    :param second_hash: Another integer hash
+    :return: The number of different bits
+    """
+    return bin(first_hash ^ second_hash).count('1')
+
+
+class BKTree(object):
+    """
+    A Burkhard-Keller tree of integer hashes, which finds the hashes within a Hamming distance of another one
+    without comparing it with all of them. Every node keeps its children by their distance to it, and the
+    triangle inequality tells which children can be skipped
+    """
+
+    def __init__(self):
+        # Every node is a list with the hash, the item and a dict of children keyed by distance
+        self.root = None
+        self.size = 0
+
+    def add(self, item_hash, item):
+        """
+        Adds a hash
+        :param item_hash: The integer hash
+        :param item: What is returned when the hash is found
+        """
+        self.size += 1
+        node = [item_hash, item, dict()]
+        if self.root is None:
+            self.root = node
+            return
+        parent = self.root
+        while True:
+            distance = hamming_distance(item_hash, parent[0])
+            child = parent[2].get(distance)
+            if child is None:
+                parent[2][distance] = node
+                return
+            parent = child
+
+    def search(self, item_hash, max_distance):
+        """
+        Finds the hashes within a distance of another one
+        :param item_hash: The integer hash to look for
+        :param max_distance: The maximum Hamming distance
+        :return: A list of tuples with the distance and the item of every hash found, nearest first
+        """
+        found = list()
+        pending = [self.root] if self.root is not None else []
+        while pending:
+            node = pending.pop()
+            distance = hamming_distance(item_hash, node[0])
+            if distance <= max_distance:
+                found.append((distance, node[1]))
+            for child_distance, child in node[2].iteritems():
+                if distance - max_distance <= child_distance <= distance + max_distance:
+                    pending.append(child)
+        return sorted(found, key=lambda result: result[0])
+
+    def __len__(self):
+        return self.size
+
+
+class ImageDeduplicator(object):
+    """
+    Finds near duplicate images, like burst shots, resized copies or images encoded again, so only one image
+    of every group is sent to the APIs and its tags are given to the others. Images are compared by their
+    difference hash, which compares the brightness of neighbouring pixels of a tiny grayscale copy and does
+    not change when an image is scaled or compressed
+    """
+    # A hash of 8 x 8 bits, and the bits two images can differ in to be considered the same
+    HASH_SIZE = 8
+    MAX_DISTANCE = 6
+    CONCURRENCY = 4
+
+    def __init__(self, max_distance=MAX_DISTANCE, hash_size=HASH_SIZE, concurrency=CONCURRENCY):
+        """
+        :param max_distance: The maximum Hamming distance between the hashes of duplicates, 0 only groups
+        images with the same hash
+        :param hash_size: The side of the hash, which has hash_size * hash_size bits
+        :param concurrency: The number of threads decoding images
+        """
+        self.max_distance = max_distance
+        self.hash_size = hash_size
+        self.concurrency = concurrency
+
+    def image_hash(self, image_path):
+        """
+        Calculates the difference hash of an image
+        :param image_path: The full path of the image
+        :return: The hash as an integer, None if the image cannot be read
+        """
+        try:
+            image = Image.open(image_path)
+            # JPEG images are decoded at a fraction of their size, which is much faster and enough for the hash
+            image.draft('L', (self.hash_size * 4, self.hash_size * 4))
+            image = image.convert('L').resize((self.hash_size + 1, self.hash_size), Image.ANTIALIAS)
+        except (IOError, ValueError) as ex:
+            print('Could not hash {0}, it will not be deduplicated. More info {1}'.format(image_path, str(ex)))
+            return None
+        pixels = list(image.getdata())
+        image_hash = 0
+        for row in range(self.hash_size):
+            offset = row * (self.hash_size + 1)
+            for column in range(self.hash_size):
+                image_hash = image_hash << 1 | (pixels[offset + column] > pixels[offset + column + 1])
+        return image_hash
+
+    def deduplicate(self, catalog):
+        """
+        Groups the near duplicates of a catalog. Images are taken in catalog order, and an image is a duplicate
+        of the nearest earlier image of another group within max_distance, so groups do not drift away from
+        their first image
+        :param catalog: A list of CatalogImage
+        :return: A tuple with the list of CatalogImage to tag, one per group, and a dict with the name of every
+        duplicate as key and the name of the image tagged in its place as value
+        """
+        catalog = list(catalog)
+        pool = ThreadPool(processes=self.concurrency)
+        try:
+            hashes = pool.map(self.image_hash, [image.path for image in catalog])
+        finally:
+            pool.close()
+            pool.join()
+        tree = BKTree()
+        representatives = list()
+        duplicates = dict()
+        for image, image_hash in zip(catalog, hashes):
+            if image_hash is not None:
+                found = tree.search(image_hash, self.max_distance)
+                if found:
+                    duplicates[image.name] = found[0][1]
+                    continue
+                tree.add(image_hash, image.name)
+            representatives.append(image)
+        return representatives, duplicates
+
+    def propagate(self, data_frame, duplicates):
+        """
+        Gives every duplicate the row of the image tagged in its place
+        :param data_frame: A DataFrame with a row per tagged image, indexed by image name
+        :param duplicates: The dict of duplicates returned by deduplicate
+        :return: A DataFrame with a row per image, duplicates included, sorted by name
+        """
+        if not duplicates:
+            return data_frame
+        names = sorted(set(data_frame.index) | set(duplicates))
+        propagated = data_frame.reindex([duplicates.get(name, name) for name in names])
+        propagated.index = names
+        return propagated
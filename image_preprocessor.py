@@ -0,0 +1,97 @@
+import os
+import tempfile
+from PIL import Image
+from result_cache import content_hash
+
+
+class ImagePreprocessor(object):
+    """
+    Downscales and recompresses images before they are sent to the tagging APIs, which do not need
+    full resolution originals to find labels. Reduced images are stored in a cache folder keyed by the
+    content hash of the original and the settings used, so every API with the same settings reuses them
+    """
+    DEFAULT_CACHE_DIR = 'preprocessed_images'
+    # Maximum edge in pixels and JPEG quality used when an API has no settings of its own
+    DEFAULT_MAX_EDGE = 1024
+    DEFAULT_QUALITY = 85
+    # Google recommends 640 x 480 for label detection, bigger images do not improve results
+    DEFAULT_SETTINGS = {
+        'VisualRecognition': (1024, 85),
+        'Clarifai': (1024, 85),
+        'Imagga': (1024, 85),
+        'GoogleVision': (640, 85)
+    }
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, settings=None):
+        """
+        :param cache_dir: The folder where reduced images are stored, created if it does not exist
+        :param settings: A dict with the API name as key and a tuple with the maximum edge and the JPEG
+        quality as value, merged with DEFAULT_SETTINGS
+        """
+        self.cache_dir = cache_dir
+        self.settings = dict(self.DEFAULT_SETTINGS)
+        self.settings.update(settings or {})
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def settings_for(self, api):
+        """
+        Returns the settings used for an API
+        :param api: The name of the API
+        :return: A tuple with the maximum edge and the JPEG quality
+        """
+        return self.settings.get(api, (self.DEFAULT_MAX_EDGE, self.DEFAULT_QUALITY))
+
+    def prepare(self, image_path, api, image_hash=None):
+        """
+        Returns the path of the image that should be sent to an API, reducing it first if needed. Images
+        already within the maximum edge, images that cannot be read and images that would not get smaller
+        are sent as they are
+        :param image_path: The full path of the original image
+        :param api: The name of the API the image is sent to
+        :param image_hash: The content hash of the original image, calculated if not given
+        :return: The path of the reduced image or the original path
+        """
+        max_edge, quality = self.settings_for(api)
+        image_hash = image_hash or content_hash(image_path)
+        reduced_path = os.path.join(self.cache_dir, '%s_%s_%s.jpg' % (image_hash, max_edge, quality))
+        if os.path.isfile(reduced_path):
+            return reduced_path
+        # An empty marker means the original was already good enough
+        original_marker = reduced_path + '.original'
+        if os.path.isfile(original_marker):
+            return image_path
+
+        try:
+            image = Image.open(image_path)
+            if max(image.size) <= max_edge:
+                self.mark_original(original_marker)
+                return image_path
+            if image.mode not in ('RGB', 'L'):
+                image = image.convert('RGB')
+            image.thumbnail((max_edge, max_edge), Image.LANCZOS)
+            # Write to a temporary file first, other threads may be preparing the same image
+            descriptor, temporary_path = tempfile.mkstemp(suffix='.jpg', dir=self.cache_dir)
+            try:
+                with os.fdopen(descriptor, 'wb') as reduced_file:
+                    image.save(reduced_file, 'JPEG', quality=quality, optimize=True)
+            except IOError:
+                os.remove(temporary_path)
+                raise
+        except IOError as ex:
+            print('Could not reduce image {0}, sending the original. More info {1}'.format(image_path, str(ex)))
+            return image_path
+
+        if os.path.getsize(temporary_path) >= os.path.getsize(image_path):
+            os.remove(temporary_path)
+            self.mark_original(original_marker)
+            return image_path
+        os.rename(temporary_path, reduced_path)
+        return reduced_path
+
+    def mark_original(self, marker_path):
+        """
+        Leaves an empty marker so the original of an image is not opened again next time
+        :param marker_path: The path of the marker
+        """
+        open(marker_path, 'w').close()
@@ -1,24 +1,30 @@
 
 import os
+import re
 import yaml
 import json
 import zipfile
-import pandas
+import hashlib
 import simplejson
 import ntpath
 import base64
 import time
+import tempfile
+import threading
+import Queue
 
-from httplib2 import HttpLib2Error
+from multiprocessing.pool import ThreadPool
+from multiprocessing import TimeoutError
 
-from googleapiclient import discovery
-from googleapiclient.errors import HttpError
-
-from oauth2client.client import GoogleCredentials
-
-from watson_developer_cloud import VisualRecognitionV3, WatsonException
-from clarifai.client import ClarifaiApi
+# The clients of every API and pandas are imported when they are first needed, so processes that only use
+# some of the APIs, like the workers of the command line, start without loading the others
 from imagga import ImaggaHelper
+from result_cache import content_hash
+from scanner import ImageScanner
+from rate_limiter import RateLimiter
+from resilience import CallGuard
+from metrics import NULL_METRICS
+from async_results import GatheredResult
 
 
 class ImageTagger(object):
@@ -33,16 +39,72 @@ class ImageTagger(object):
     CLARIFAI_CLIENT_ID = ''
     CLARIFAI_CLIENT_SECRET = ''
     GOOGLE_VISION_DISCOVERY_URL='https://{api}.googleapis.com/$discovery/rest?version={apiVersion}'
+    # Where the downloaded discovery documents are kept, so they are only requested once
+    GOOGLE_VISION_DISCOVERY_CACHE = os.path.join(tempfile.gettempdir(), 'image-tagging-discovery')
     IMAGE_FILE_TYPES = ['png', 'jpg', 'jpeg', 'gif']
+    # Visual Recognition does not accept GIF images inside zip files
+    VISUAL_RECOGNITION_FILE_TYPES = ['png', 'jpg', 'jpeg']
+    VISUAL_RECOGNITION_VERSION = '2016-05-20'
+    VISUAL_RECOGNITION_THRESHOLD = 0.1
+    # Visual Recognition accepts zip files of up to 20 images and 5 MB
+    VISUAL_RECOGNITION_ZIP_IMAGES = 20
+    VISUAL_RECOGNITION_ZIP_BYTES = 5 * 1024 * 1024
+    VISUAL_RECOGNITION_CONCURRENCY = 4
+    VISUAL_RECOGNITION_RETRIES = 2
+    # Clarifai accepts up to 128 images per request, smaller batches spread better over the threads
+    CLARIFAI_BATCH_SIZE = 32
+    CLARIFAI_CONCURRENCY = 4
+    GOOGLE_VISION_MAX_RESULTS = 5
+    # Google rejects requests with more than 16 images or over 10 MB, keep some margin
+    GOOGLE_VISION_BATCH_IMAGES = 10
+    GOOGLE_VISION_BATCH_BYTES = 8 * 1024 * 1024
+    # Default quotas of a Google Cloud project, can be changed in the config file
+    GOOGLE_VISION_REQUESTS_PER_MINUTE = 1800
+    GOOGLE_VISION_IMAGES_PER_MINUTE = 1800
+    # Seconds after which a slow Google request is sent again, None never sends it twice
+    GOOGLE_VISION_HEDGE_AFTER = None
+    # Results of iter_all waiting for the consumer, APIs pause when there are more
+    ITER_ALL_BUFFER = 1000
+    # Threads of the pool shared by the *_async methods
+    ASYNC_CONCURRENCY = 8
 
-    def __init__(self, imagga_helper=None):
-        self.data_frame = pandas.DataFrame()
+    def __init__(self, imagga_helper=None, result_cache=None, preprocessor=None, manifest=None, metrics=NULL_METRICS,
+                 deduplicator=None):
+        self.data_frame = None
         self.images_names = list()
         self.apis = ['VisualRecognition', 'Clarifai', 'Imagga', 'GoogleVision']
         self.visual_recognition = None
         self.clarifai = None
         self.google_vision_service = None
+        self.google_vision_rate_limiter = RateLimiter(self.GOOGLE_VISION_REQUESTS_PER_MINUTE,
+                                                      self.GOOGLE_VISION_IMAGES_PER_MINUTE)
+        # Optional Metrics with the time spent in every stage and the counters of every API
+        self.metrics = metrics
+        # Retries with backoff and circuit breakers for the calls to every API
+        # The errors of the clients are added when they are configured
+        self.visual_recognition_guard = CallGuard('VisualRecognition', retries=self.VISUAL_RECOGNITION_RETRIES,
+                                                  metrics=metrics)
+        self.clarifai_guard = CallGuard('Clarifai', metrics=metrics)
+        self.google_vision_guard = CallGuard('GoogleVision', hedge_after=self.GOOGLE_VISION_HEDGE_AFTER,
+                                             metrics=metrics)
         self.configured = False
+        # An optional ResultCache shared by all APIs, so the same image is never tagged twice
+        self.result_cache = result_cache
+        # An optional ImagePreprocessor that reduces images before they are sent
+        self.preprocessor = preprocessor
+        # An optional Manifest that records the images already tagged, so reruns only send new or changed ones
+        self.manifest = manifest
+        # An optional ImageDeduplicator, so only one image of every group of near duplicates is tagged by use_all
+        # and iter_all, and the others get its tags
+        self.deduplicator = deduplicator
+        # Finds the images of a folder once for all the APIs
+        self.scanner = ImageScanner(self.IMAGE_FILE_TYPES)
+        # The httplib2 connections of every thread calling Google
+        self.google_vision_connections = threading.local()
+        # Created by the first *_async call, and shared by all of them
+        self.async_pool = None
+        self.async_callback_pool = None
+        self.async_pool_lock = threading.Lock()
         if imagga_helper:
             self.imagga_helper = imagga_helper
 
@@ -60,16 +122,40 @@ class ImageTagger(object):
             self.CLARIFAI_CLIENT_ID = config['clarifai']['client-id']
             self.CLARIFAI_CLIENT_SECRET = config['clarifai']['client-secret']
             self.GOOGLE_VISION_SECRET = config['google-vision']['api-key']
+            # Quotas are optional, the defaults of a Google Cloud project are used otherwise
+            if 'requests-per-minute' in config['google-vision'] or 'images-per-minute' in config['google-vision']:
+                self.google_vision_rate_limiter = RateLimiter(
+                    config['google-vision'].get('requests-per-minute', self.GOOGLE_VISION_REQUESTS_PER_MINUTE),
+                    config['google-vision'].get('images-per-minute', self.GOOGLE_VISION_IMAGES_PER_MINUTE))
+            if config['google-vision'].get('hedge-after'):
+                self.google_vision_guard.hedge_after = float(config['google-vision']['hedge-after'])
+            # Endpoints are optional, they point the clients to other servers like the benchmark stand-ins
+            if config['google-vision'].get('discovery-url'):
+                self.GOOGLE_VISION_DISCOVERY_URL = config['google-vision']['discovery-url']
+            if config['google-vision'].get('discovery-cache'):
+                self.GOOGLE_VISION_DISCOVERY_CACHE = config['google-vision']['discovery-cache']
             if self.VISUAL_RECOGNITION_KEY:
-                self.visual_recognition = VisualRecognitionV3('2016-05-20', api_key=self.VISUAL_RECOGNITION_KEY)
+                from watson_developer_cloud import VisualRecognitionV3, WatsonException, WatsonInvalidArgument
+                self.visual_recognition_guard.add_errors(transient_errors=(WatsonException,),
+                                                         permanent_errors=(WatsonInvalidArgument,),
+                                                         status_parser=self.visual_recognition_status)
+                visual_recognition_options = dict(api_key=self.VISUAL_RECOGNITION_KEY)
+                if config['visual-recognition'].get('url'):
+                    visual_recognition_options['url'] = config['visual-recognition']['url']
+                self.visual_recognition = VisualRecognitionV3(self.VISUAL_RECOGNITION_VERSION,
+                                                              **visual_recognition_options)
             if self.CLARIFAI_CLIENT_ID and self.CLARIFAI_CLIENT_SECRET:
-                self.clarifai = ClarifaiApi(app_id=self.CLARIFAI_CLIENT_ID, app_secret=self.CLARIFAI_CLIENT_SECRET)
+                from clarifai.client import ClarifaiApi
+                from clarifai.client.client import ApiError, ApiClientError, ApiBadRequestError, ApiThrottledError
+                self.clarifai_guard.add_errors(transient_errors=(ApiError, ApiThrottledError),
+                                               permanent_errors=(ApiClientError, ApiBadRequestError))
+                clarifai_options = dict(app_id=self.CLARIFAI_CLIENT_ID, app_secret=self.CLARIFAI_CLIENT_SECRET)
+                if config['clarifai'].get('base-url'):
+                    clarifai_options['base_url'] = config['clarifai']['base-url']
+                self.clarifai = ClarifaiApi(**clarifai_options)
             if self.GOOGLE_VISION_SECRET:
-                self.google_vision_service = discovery.build('vision',
-                                                             'v1',
-                                                             developerKey=self.GOOGLE_VISION_SECRET,
-                                                             discoveryServiceUrl=self.GOOGLE_VISION_DISCOVERY_URL
-                                                             )
+                self.google_vision_service = self.build_google_vision_service(
+                    config['google-vision'].get('discovery-document'))
 
             if self.visual_recognition and self.clarifai and self.google_vision_service:
                 self.configured = True
@@ -78,68 +164,238 @@ class ImageTagger(object):
             print('Could not find config file')
             return False
 
+    def build_google_vision_service(self, discovery_document=None):
+        """
+        Creates the Google Vision client from a discovery document read from a file, instead of requesting it
+        every time a process starts
+        :param discovery_document: The path of the discovery document, like one bundled with the application. If
+        not given, the document at GOOGLE_VISION_DISCOVERY_URL is used, downloaded only the first time
+        :return: The Google Vision service
+        """
+        from googleapiclient import discovery
+        if not discovery_document:
+            discovery_document = self.cache_google_vision_discovery()
+        with open(discovery_document) as fd:
+            content = fd.read()
+        return discovery.build_from_document(content, developerKey=self.GOOGLE_VISION_SECRET)
+
+    def cache_google_vision_discovery(self):
+        """
+        Downloads the discovery document at GOOGLE_VISION_DISCOVERY_URL to GOOGLE_VISION_DISCOVERY_CACHE, unless
+        it was already downloaded. Remove the file to download it again
+        :return: The path of the cached document
+        """
+        url = self.GOOGLE_VISION_DISCOVERY_URL.replace('{api}', 'vision').replace('{apiVersion}', 'v1')
+        cached_file = os.path.join(self.GOOGLE_VISION_DISCOVERY_CACHE, hashlib.sha1(url).hexdigest() + '.json')
+        if os.path.isfile(cached_file):
+            return cached_file
+        import httplib2
+        from googleapiclient.errors import HttpError
+        response, content = httplib2.Http().request(url)
+        if response.status != 200:
+            raise HttpError(response, content, uri=url)
+        if not os.path.isdir(self.GOOGLE_VISION_DISCOVERY_CACHE):
+            try:
+                os.makedirs(self.GOOGLE_VISION_DISCOVERY_CACHE)
+            except OSError:
+                # Created by another process in the meantime
+                pass
+        # Written aside and renamed, so processes starting at the same time never read half a document
+        handle, temporary_file = tempfile.mkstemp(dir=self.GOOGLE_VISION_DISCOVERY_CACHE, suffix='.tmp')
+        with os.fdopen(handle, 'w') as fd:
+            fd.write(content)
+        os.rename(temporary_file, cached_file)
+        return cached_file
+
     def process_images_visual_recognition(self, folder_name=None, store_results=False):
         """
-        Processes the specified image folder using the Visual Recognition API
-        :param folder_name: The complete path where the images are
+        Processes the specified image folder using the Visual Recognition API. Images are sent as zip files,
+        each one within the limits of images and bytes of the API, written to a private temporary file and
+        uploaded in parallel. A chunk that fails is retried on its own
+        :param folder_name: The complete path where the images are, or a catalog built by scan
         :param store_results: Indicates if obtained response should be stored as JSON file
         :return: A DataFrame containing the available data
         """
         data_frame = None
-        self.images_names = list()
-        # We can send a zip file to Visual Recognition, so let's try
-        zf = zipfile.ZipFile("sample-images.zip", "w")
-        for dirname, subdirs, files in os.walk(folder_name):
-            for filename in files:
-                if isinstance(filename, str) and filename.endswith(('.jpeg', '.jpg', '.png')):
-                    self.images_names.append(filename)
-                    zf.write(os.path.join(dirname, filename), arcname=filename)
-        zf.close()
         # Check we have the client API instance
         if self.visual_recognition:
-            with open('sample-images.zip', 'rb') as image_file:
-                try:
-                    results = simplejson.dumps(self.visual_recognition.classify(images_file=image_file,
-                                                                                threshold=0.1),
-                                               indent=4,
-                                               skipkeys=True,
-                                               sort_keys=True)
-                except WatsonException as ex:
-                    print('An error occured trying to get data from VisualReconginitio. More info {0}'.format(str(ex)))
-                    return data_frame
-                if store_results:
-                    fd = open('visual_recognition_classifications_results.json', 'w')
-                    fd.write(results)
-                    fd.close()
+            # Keep the names local, APIs may be running concurrently on the same instance
+            images_names = list()
+            responses = list() if store_results else None
             # Generate a dict with a list of tuples with all tags found per image
-            vr_results = dict()
+            vr_results = dict((image_name, tags) for image_name, api, tags
+                              in self.iter_visual_recognition(folder_name, images_names, responses))
+
+            if store_results:
+                # Merge the responses of all chunks as if it was only one
+                merged = {'images': [image for response in responses for image in response.get('images', [])],
+                          'images_processed': sum(response.get('images_processed', 0) for response in responses)}
+                # Written as it is encoded, the whole document is never built as a string
+                with open('visual_recognition_classifications_results.json', 'w') as fd:
+                    simplejson.dump(merged, fd, indent=4, skipkeys=True, sort_keys=True)
+
+            self.images_names = images_names
+            import pandas
+            with self.metrics.timer('data_frame', 'VisualRecognition'):
+                data_series = pandas.Series(vr_results, index=images_names, name='VisualRecognition')
+                data_frame = pandas.DataFrame(data_series, index=images_names, columns=['VisualRecognition'])
+        return data_frame
+
+    def iter_visual_recognition(self, folder_name=None, images_names=None, responses=None):
+        """
+        Tags the specified image folder using the Visual Recognition API, yielding the tags of the images
+        as soon as each chunk is tagged. Cached tags come first
+        :param folder_name: The complete path where the images are, or a catalog built by scan
+        :param images_names: An optional list that gets the names of all the images found, tagged or not
+        :param responses: An optional list that gets the raw responses of the API
+        :return: A generator of tuples with the image name, the API name and the list of tuples with the tags found
+        """
+        # Check we have the client API instance
+        if not self.visual_recognition:
+            return
+        images_names = images_names if images_names is not None else list()
+        # Split the images to be sent in chunks, as tuples of path, name and content hash
+        chunks = list()
+        chunk = list()
+        chunk_bytes = 0
+        for image in self.catalog(folder_name):
+            # Images of other types get no tags, but they are still part of the results
+            images_names.append(image.name)
+            if image.type not in self.VISUAL_RECOGNITION_FILE_TYPES:
+                continue
+            image_hash, cached_tags = self.get_cached_tags('VisualRecognition', image.path)
+            if cached_tags is not None:
+                yield image.name, 'VisualRecognition', cached_tags
+                continue
+            image_path = self.prepare_image('VisualRecognition', image.path, image_hash)
+            # Images are stored without compression, so the zip is as big as the images
+            image_bytes = image.size if image_path == image.path else os.path.getsize(image_path)
+            if chunk and (len(chunk) >= self.VISUAL_RECOGNITION_ZIP_IMAGES or
+                          chunk_bytes + image_bytes > self.VISUAL_RECOGNITION_ZIP_BYTES):
+                chunks.append(chunk)
+                chunk = list()
+                chunk_bytes = 0
+            chunk.append((image_path, image.name, image_hash))
+            chunk_bytes += image_bytes
+        if chunk:
+            chunks.append(chunk)
+
+        if chunks:
+            pool = ThreadPool(processes=min(len(chunks), self.VISUAL_RECOGNITION_CONCURRENCY))
             try:
-                vr_data = json.loads(results.decode('string-escape').strip('"'))
-                if 'images' in vr_data.keys():
-                    # print(vr_data)
-                    for image in vr_data['images']:
-                        tags_found = []
-                        if 'image' in image.keys():
-                            image_name = self.path_leaf(image['image'])
-                            if 'classifiers' in image.keys():
-                                for tag in image['classifiers'][0]['classes']:
-                                    if 'class' and 'score' in tag.keys():
-                                        tag_found = (tag['class'], tag['score'])
-                                        tags_found.append(tag_found)
-                                vr_results[image_name] = tags_found
+                for chunk_results, response in pool.imap_unordered(self.tag_visual_recognition_chunk, chunks):
+                    if response and responses is not None:
+                        responses.append(response)
+                    for image_name, tags in chunk_results.iteritems():
+                        yield image_name, 'VisualRecognition', tags
+            finally:
+                # Chunks not sent yet are dropped if the consumer stopped early
+                pool.terminate()
+                pool.join()
+
+    def visual_recognition_status(self, exception):
+        """
+        Gets the HTTP status code of a Visual Recognition error. The client only tells it in the message of
+        its errors, so throttling and server errors are retried while other client errors fail fast
+        :param exception: The error raised by the client
+        :return: The status code as an int, or None if the message does not tell it
+        """
+        message = str(exception)
+        if message.startswith('Unauthorized') or 'invalid-api-key' in message:
+            return 401
+        code = re.search(r'Code: (\d{3})\b', message)
+        return int(code.group(1)) if code else None
+
+    def tag_visual_recognition_chunk(self, chunk):
+        """
+        Zips a chunk of images into a private temporary file and sends it to Visual Recognition, retrying
+        up to VISUAL_RECOGNITION_RETRIES times if it fails. The zip file is removed afterwards
+        :param chunk: A list of tuples with the path, name and content hash of every image
+        :return: A tuple with a dict with a list of tuples with all tags found per image name, and the raw
+        response, or None as response if the chunk could not be tagged
+        """
+        vr_results = dict()
+        chunk_hashes = dict((image_name, image_hash) for image_path, image_name, image_hash in chunk)
+        # Every chunk gets its own file, so neither concurrent chunks nor concurrent runs overwrite each other
+        with tempfile.NamedTemporaryFile(prefix='visual-recognition-', suffix='.zip') as zip_file:
+            zip_name = os.path.basename(zip_file.name)
+            # The names actually written into the archive, the ones the service answers with
+            archived_names = dict()
+            with self.metrics.timer('encode', 'VisualRecognition'):
+                zf = zipfile.ZipFile(zip_file, 'w')
+                for image_path, image_name, image_hash in chunk:
+                    zf.write(image_path, arcname=image_name)
+                    archived_names[zf.infolist()[-1].filename] = image_name
+                zf.close()
+            zip_bytes = zip_file.tell()
+
+            def classify():
+                # Every attempt sends the zip from the start
+                zip_file.seek(0)
+                self.metrics.increment('bytes_sent', zip_bytes, 'VisualRecognition')
+                return self.visual_recognition.classify(images_file=zip_file,
+                                                        threshold=self.VISUAL_RECOGNITION_THRESHOLD)
+
+            response = None
+            try:
+                response = self.visual_recognition_guard.call(classify, hedge=False)
+            except Exception as ex:
+                # Only this chunk is lost, the others are still tagged
+                print('An error occured trying to get data from VisualReconginitio. More info {0}'.format(str(ex)))
+        if response is None:
+            return vr_results, None
+        self.count_response_bytes('VisualRecognition', response)
+
+        with self.metrics.timer('parse', 'VisualRecognition'):
+            try:
+                for image in response.get('images', []):
+                    tags_found = []
+                    if 'image' in image:
+                        image_name = self.match_archived_name(image['image'], zip_name, archived_names)
+                        if image_name is None:
+                            print('Visual Recognition answered for {0}, which was not sent in this chunk'.format(
+                                image['image']))
+                            continue
+                        if 'classifiers' in image:
+                            for tag in image['classifiers'][0]['classes']:
+                                if 'class' in tag and 'score' in tag:
+                                    tags_found.append((tag['class'], tag['score']))
+                            vr_results[image_name] = tags_found
             except Exception as ex:
                 print 'COULD NOT LOAD:', ex
-            data_series = pandas.Series(vr_results, index=self.images_names, name='VisualRecognition')
-            data_frame = pandas.DataFrame(data_series, index=self.images_names, columns=['VisualRecognition'])
+        self.checkpoint('VisualRecognition', [(chunk_hashes[image_name], tags)
+                                              for image_name, tags in vr_results.iteritems()])
+        return vr_results, response
 
-        # Removed generated zip file
-        os.remove('sample-images.zip')
-        return data_frame
+    def match_archived_name(self, returned_name, zip_name, archived_names):
+        """
+        Finds the image a name answered by Visual Recognition belongs to. The service names images after
+        the zip file they came in, which may come with the folders of the uploaded file, followed by the
+        name written into the archive, which may include subfolders
+        :param returned_name: The name answered by the service
+        :param zip_name: The file name of the zip file sent
+        :param archived_names: A dict with the image name of every name written into the archive
+        :return: The image name, or None if the name does not belong to any image of the archive
+        """
+        returned_name = returned_name.replace('\\', '/')
+        marker = zip_name + '/'
+        if marker in returned_name:
+            returned_name = returned_name.split(marker, 1)[1]
+        if returned_name in archived_names:
+            return archived_names[returned_name]
+        # Otherwise the longest archived name it ends with, so sub/a.jpg is not taken for a.jpg
+        matches = [archived_name for archived_name in archived_names
+                   if returned_name.endswith('/' + archived_name)]
+        if matches:
+            return archived_names[max(matches, key=len)]
+        return None
 
     def process_images_clarifai(self, folder_name=None):
         """
-        Processes the specified image folder using the Clarifai API
-        :param folder_name: The complete path where the images are
+        Processes the specified image folder using the Clarifai API. Images are sent in batches of
+        CLARIFAI_BATCH_SIZE over a pool of CLARIFAI_CONCURRENCY threads, and files are only open while
+        their batch is being sent
+        :param folder_name: The complete path where the images are, or a catalog built by scan
         :return: A DataFrame containing the available data
         """
         data_frame = None
@@ -147,171 +403,718 @@ class ImageTagger(object):
         if self.clarifai:
             # Generate a dict with a list of tuples with all tags found per image
             clarifai_results = dict()
+            # Keep the names local, APIs may be running concurrently on the same instance
+            images_names = list()
             try:
-                open_files = []
-                # Generate a dict with a list of tuples with all tags found per image
-                clarifai_results = dict()
-                self.images_names = list()
-                if os.path.isdir(folder_name):
-                    # Get the images if the exist and if they are in the supported types
-                    images = [filename for filename in os.listdir(folder_name)
-                              if os.path.isfile(os.path.join(folder_name, filename)) and
-                              filename.split('.')[-1].lower() in self.IMAGE_FILE_TYPES]
-
-                    for iterator, image_file in enumerate(images):
-                        image_path = os.path.join(folder_name, image_file)
-                        self.images_names.append(self.path_leaf(image_path))
-                        image_file = open(image_path, 'rb')
-                        image = (image_file, self.path_leaf(image_path))
-                        open_files.append(image)
-
-                    # Call Clarifai API
-                    clarifai_data = self.clarifai.tag_images(open_files)
-
-                    if 'results' in clarifai_data.keys():
-                        # print(vr_data)
-                        for iterator, image in enumerate(clarifai_data['results']):
-                            tags_found = []
-                            if 'result' in image.keys():
-                                image_name = self.images_names[iterator]
-                                # Try to get the tags obtained
-                                result = image['result']
-                                if result:
-                                    if 'tag' in result.keys():
-                                        tags = image['result']['tag']['classes']
-                                        list_tags = []
-                                        probs = image['result']['tag']['probs']
-                                        if tags and probs:
-                                            list_tags = zip(tags, probs)
-                                            clarifai_results[image_name] = list_tags
+                for image_name, api, tags in self.iter_clarifai(folder_name, images_names):
+                    clarifai_results[image_name] = tags
             except Exception as ex:
                 print ('COULD NOT LOAD, reason {0}'.format(str(ex)))
-            sorted_names = sorted(self.images_names)
-            data_series = pandas.Series(clarifai_results, index=sorted_names, name='Clarifai')
-            data_frame = pandas.DataFrame(data_series, index=sorted_names, columns=['Clarifai'])
+            self.images_names = images_names
+            sorted_names = sorted(images_names)
+            import pandas
+            with self.metrics.timer('data_frame', 'Clarifai'):
+                data_series = pandas.Series(clarifai_results, index=sorted_names, name='Clarifai')
+                data_frame = pandas.DataFrame(data_series, index=sorted_names, columns=['Clarifai'])
             return data_frame
 
+    def iter_clarifai(self, folder_name=None, images_names=None):
+        """
+        Tags the specified image folder using the Clarifai API, yielding the tags of the images as soon as
+        each batch is tagged. Cached tags come first
+        :param folder_name: The complete path where the images are, or a catalog built by scan
+        :param images_names: An optional list that gets the names of all the images found, tagged or not
+        :return: A generator of tuples with the image name, the API name and the list of tuples with the tags found
+        """
+        # Check we have the client API instance
+        if not self.clarifai:
+            return
+        images_names = images_names if images_names is not None else list()
+
+        # Split the images to be sent in batches, as tuples of path, name and content hash
+        batches = list()
+        batch = list()
+        for image in self.catalog(folder_name):
+            images_names.append(image.name)
+            image_hash, cached_tags = self.get_cached_tags('Clarifai', image.path)
+            if cached_tags is not None:
+                yield image.name, 'Clarifai', cached_tags
+                continue
+            image_path = self.prepare_image('Clarifai', image.path, image_hash)
+            batch.append((image_path, image.name, image_hash))
+            if len(batch) == self.CLARIFAI_BATCH_SIZE:
+                batches.append(batch)
+                batch = list()
+        if batch:
+            batches.append(batch)
+
+        # Call Clarifai API, unless all images were cached
+        if batches:
+            pool = ThreadPool(processes=min(len(batches), self.CLARIFAI_CONCURRENCY))
+            try:
+                for batch_results in pool.imap_unordered(self.tag_clarifai_batch, batches):
+                    for image_name, tags in batch_results.iteritems():
+                        yield image_name, 'Clarifai', tags
+            finally:
+                # Batches not sent yet are dropped if the consumer stopped early
+                pool.terminate()
+                pool.join()
+
+    def tag_clarifai_batch(self, batch):
+        """
+        Sends a batch of images to Clarifai. The files are opened just before the request and closed right after
+        :param batch: A list of tuples with the path, name and content hash of every image
+        :return: A dict with a list of tuples with all tags found per image name
+        """
+        clarifai_results = dict()
+        batch_names = [image_name for image_path, image_name, image_hash in batch]
+        batch_hashes = dict((image_name, image_hash) for image_path, image_name, image_hash in batch)
+        open_files = []
+        sent_bytes = []
+
+        def tag_images():
+            # Every attempt sends the files from the start
+            for image_file, image_name in open_files:
+                image_file.seek(0)
+            self.metrics.increment('bytes_sent', sum(sent_bytes), 'Clarifai')
+            return self.clarifai.tag_images(open_files, local_ids=batch_names)
+
+        try:
+            for image_path, image_name, image_hash in batch:
+                open_files.append((open(image_path, 'rb'), image_name))
+                if self.metrics.enabled:
+                    sent_bytes.append(os.fstat(open_files[-1][0].fileno()).st_size)
+            clarifai_data = self.clarifai_guard.call(tag_images, hedge=False)
+        except Exception as ex:
+            print ('COULD NOT LOAD {0} images from Clarifai, reason {1}'.format(len(batch), str(ex)))
+            return clarifai_results
+        finally:
+            for image_file, image_name in open_files:
+                image_file.close()
+        self.count_response_bytes('Clarifai', clarifai_data)
+
+        with self.metrics.timer('parse', 'Clarifai'):
+            for iterator, image in enumerate(clarifai_data.get('results', [])):
+                # Clarifai echoes the local id of an image when it has one, otherwise results
+                # come in the same order the images of this batch were sent
+                image_name = image.get('local_id')
+                if not image_name and iterator < len(batch_names):
+                    image_name = batch_names[iterator]
+                if image_name not in batch_hashes:
+                    continue
+                # Try to get the tags obtained
+                result = image.get('result')
+                if result and 'tag' in result.keys():
+                    tags = result['tag']['classes']
+                    probs = result['tag']['probs']
+                    if tags and probs:
+                        list_tags = zip(tags, probs)
+                        clarifai_results[image_name] = list_tags
+        self.checkpoint('Clarifai', [(batch_hashes[image_name], tags)
+                                     for image_name, tags in clarifai_results.iteritems()])
+        return clarifai_results
+
     def process_images_google_vision(self, folder_name=None):
         """
         Iterates over the specified folder and returns the combined response from calling Google Cloud Vision API
-        using only LABEL detection and 5 maximum per image. Since it looks like Google does not like sending more
-        than 10 images per Request, we have to make sure we process every batch of 10 images until finished
-        :param folder_name: The full path to the folder with images to be processed
+        using only LABEL detection and 5 maximum per image. Google limits both the images and the bytes per request,
+        so images are sent in batches bounded by GOOGLE_VISION_BATCH_IMAGES and GOOGLE_VISION_BATCH_BYTES, as fast
+        as the rate limiter allows. Each batch is encoded, sent and reduced to its tags before the next one is read,
+        so memory does not grow with the size of the folder
+        :param folder_name: The full path to the folder with images to be processed, or a catalog built by scan
         :return: A DataFrame containing the available data
         """
-        data_frame = None
-        responses = []
-        self.images_names = list()
+        # Keep the names local, APIs may be running concurrently on the same instance
+        all_images_names = list()
+        # Generate a dict with a list of tuples with all tags found per image
+        google_results = dict((image_name, tags) for image_name, api, tags
+                              in self.iter_google_vision(folder_name, all_images_names))
+        self.images_names = all_images_names
+        sorted_names = sorted(all_images_names)
+        import pandas
+        with self.metrics.timer('data_frame', 'GoogleVision'):
+            data_series = pandas.Series(google_results, index=sorted_names, name='GoogleVision')
+            data_frame = pandas.DataFrame(data_series, index=sorted_names, columns=['GoogleVision'])
+        return data_frame
+
+    def iter_google_vision(self, folder_name=None, images_names=None):
+        """
+        Tags the specified image folder using Google Cloud Vision API, yielding the tags of the images as soon
+        as each batch is tagged. Cached tags come first
+        :param folder_name: The full path to the folder with images to be processed, or a catalog built by scan
+        :param images_names: An optional list that gets the names of all the images found, tagged or not
+        :return: A generator of tuples with the image name, the API name and the list of tuples with the tags found
+        """
         # Check if specified folder exists
-        if os.path.isdir(folder_name):
-            # Get the images if the exist and if they are in the supported types
-            images = [filename for filename in os.listdir(folder_name)
-                      if os.path.isfile(os.path.join(folder_name, filename)) and
-                      filename.split('.')[-1].lower() in self.IMAGE_FILE_TYPES]
-
-            payload = {}
-            payload['requests'] = []
-            # Create a list to associate responses with images
-            images_names = list()
-            for iterator, image_file in enumerate(images):
-                image_path = os.path.join(folder_name, image_file)
-                images_names.append(self.path_leaf(image_path))
-                self.images_names.append(self.path_leaf(image_path))
-                with open(image_path, 'rb') as image:
-                    image_content = base64.b64encode(image.read())
-                    image_payload = {}
-                    image_payload['image'] = {}
-                    image_payload['image']['content'] = image_content.decode('UTF-8')
-                    image_payload['features'] = [{
-                                'type': 'LABEL_DETECTION',
-                                'maxResults': 5
-                    }]
-                    payload['requests'].append(image_payload)
-
-                    # Need to check if we have reached 10 images, meaning we must send a request,
-                    # Google does not like more than 10 images (more or less) per request
-                    if (iterator + 1) % 10 == 0:
-                        service_request = self.google_vision_service.images().annotate(body=payload)
-                        payload = {}
-                        payload['requests'] = []
-                        try:
-                            response = service_request.execute()
-                            intermediate = response['responses']
-                            merged = zip(images_names, intermediate)
-                            response['responses'] = []
-                            for element in merged:
-                                image_labeled = {}
-                                image_labeled[element[0]] = element[1]
-                                response['responses'].append(image_labeled)
-                            responses.append(response)
-                            images_names = list()
-                            # Add one second delay before making another request
-                            time.sleep(5)
-                        except (HttpError, HttpLib2Error) as ex:
-                            print('The following error occurred trying to label images with Google {0}'.format(str(ex)))
-                            continue
+        if isinstance(folder_name, basestring) and not os.path.isdir(folder_name):
+            raise ValueError('The input directory does not exist: %s' % folder_name)
+        images_names = images_names if images_names is not None else list()
 
-            # This is just in case images were less than 10 or the remaining of more than any multiple of 10
-            service_request = self.google_vision_service.images().annotate(body=payload)
-            try:
-                response = service_request.execute()
-                intermediate = response['responses']
-                merged = zip(images_names, intermediate)
-                response['responses'] = []
-                for element in merged:
-                    image_labeled = dict()
-                    image_labeled[element[0]] = element[1]
-                    response['responses'].append(image_labeled)
-                responses.append(response)
-            except (HttpError, HttpLib2Error) as ex:
-                print('The following error occurred trying to label images with Google {0}'.format(str(ex)))
+        # The images of the batch being built, as tuples of path, name and content hash
+        batch = list()
+        batch_bytes = 0
+        for image in self.catalog(folder_name):
+            image_name = image.name
+            images_names.append(image_name)
+            image_hash, cached_tags = self.get_cached_tags('GoogleVision', image.path)
+            if cached_tags is not None:
+                yield image_name, 'GoogleVision', cached_tags
+                continue
+            image_path = self.prepare_image('GoogleVision', image.path, image_hash)
+            # Base64 turns every 3 bytes into 4, so the request size is known without reading the image.
+            # Send what we have if this image does not fit in the current request, an image bigger
+            # than the limit goes alone in its own request
+            image_bytes = image.size if image_path == image.path else os.path.getsize(image_path)
+            encoded_bytes = 4 * ((image_bytes + 2) // 3)
+            if batch and (len(batch) >= self.GOOGLE_VISION_BATCH_IMAGES or
+                          batch_bytes + encoded_bytes > self.GOOGLE_VISION_BATCH_BYTES):
+                for image_name_tagged, tags in self.tag_google_vision_batch(batch).iteritems():
+                    yield image_name_tagged, 'GoogleVision', tags
+                batch = list()
+                batch_bytes = 0
+            batch.append((image_path, image_name, image_hash))
+            batch_bytes += encoded_bytes
 
-            finally:
-                # Iterate the responses and construct one single dictionary with one response key only
-                final_response = dict()
-                final_response['responses'] = []
-                for partial in responses:
-                    labels = partial['responses']
-                    final_response['responses'].append(labels)
-                google_results = dict()
-                # Process the dictionary and get the DataFrame with results
-                for tagged_responses in final_response['responses']:
+        # Send the remaining images, nothing is left to send if all of them were cached
+        if batch:
+            for image_name_tagged, tags in self.tag_google_vision_batch(batch).iteritems():
+                yield image_name_tagged, 'GoogleVision', tags
+
+    def tag_google_vision_batch(self, batch):
+        """
+        Encodes a batch of images, sends it to Google Cloud Vision and reduces the response to the tags found.
+        Neither the payload nor the response outlive this call
+        :param batch: A list of tuples with the path, name and content hash of every image
+        :return: A dict with a list of tuples with all tags found per image name
+        """
+        payload = {}
+        payload['requests'] = []
+        for image_path, image_name, image_hash in batch:
+            with self.metrics.timer('read', 'GoogleVision'):
+                with open(image_path, 'rb') as image:
+                    image_content = image.read()
+            with self.metrics.timer('encode', 'GoogleVision'):
+                image_content = base64.b64encode(image_content)
+            image_payload = {}
+            image_payload['image'] = {}
+            image_payload['image']['content'] = image_content.decode('UTF-8')
+            image_payload['features'] = [{
+                        'type': 'LABEL_DETECTION',
+                        'maxResults': self.GOOGLE_VISION_MAX_RESULTS
+            }]
+            payload['requests'].append(image_payload)
+
+        images_names = [image_name for image_path, image_name, image_hash in batch]
+        response = self.annotate_google_vision_batch(payload, images_names)
+        google_results = dict()
+        tagged = list()
+        if response:
+            with self.metrics.timer('parse', 'GoogleVision'):
+                for (image_path, image_name, image_hash), image_response in zip(batch, response['responses']):
+                    image_response = image_response[image_name]
+                    if 'error' in image_response:
+                        # Left untagged and out of the cache and the manifest, so it is sent again next time
+                        print('Google could not label {0}. More info {1}'.format(image_name, image_response['error']))
+                        continue
                     tags_found = []
-                    # Get the labels
-                    for image_tagged in tagged_responses:
-                        # Get the labels for this image
-                        labels = image_tagged.values()
-                        for label in labels[0]['labelAnnotations']:
-                            tag_found = (label['description'], label['score'])
-                            tags_found.append(tag_found)
-                        google_results[image_tagged.keys()[0]] = tags_found
-
-                sorted_names = sorted(self.images_names)
-                data_series = pandas.Series(google_results, index=sorted_names, name='GoogleVision')
-                data_frame = pandas.DataFrame(data_series, index=sorted_names, columns=['GoogleVision'])
-                return data_frame
+                    # Get the labels for this image, there are none if Google found nothing
+                    for label in image_response.get('labelAnnotations', []):
+                        tag_found = (label['description'], label['score'])
+                        tags_found.append(tag_found)
+                    google_results[image_name] = tags_found
+                    tagged.append((image_hash, tags_found))
+        self.checkpoint('GoogleVision', tagged)
+        return google_results
 
-        else:
-            raise ValueError('The input directory does not exist: %s' % folder_name)
+    def annotate_google_vision_batch(self, payload, images_names):
+        """
+        Sends one batch of images to Google Cloud Vision, waiting first for the rate limiter if needed. Failed
+        requests are retried with backoff, throttled ones after the time Google asks for
+        :param payload: The request body with one request per image
+        :param images_names: The names of the images in the same order as the requests
+        :return: The response, with every image response keyed by its name, or None if the request failed
+        """
+        service_request = self.google_vision_service.images().annotate(body=payload)
+
+        def annotate():
+            # Retries count for the quota too
+            self.google_vision_rate_limiter.acquire(len(images_names))
+            if self.metrics.enabled:
+                self.metrics.increment('bytes_sent', service_request.body_size, 'GoogleVision')
+            return service_request.execute(http=self.google_vision_http())
 
-    def use_all(self, folder):
+        try:
+            response = self.google_vision_guard.call(annotate)
+        except Exception as ex:
+            print('The following error occurred trying to label images with Google {0}'.format(str(ex)))
+            return None
+        self.count_response_bytes('GoogleVision', response)
+        intermediate = response['responses']
+        merged = zip(images_names, intermediate)
+        response['responses'] = []
+        for element in merged:
+            image_labeled = dict()
+            image_labeled[element[0]] = element[1]
+            response['responses'].append(image_labeled)
+        return response
+
+    def google_vision_http(self):
+        """
+        Gets the HTTP client Google requests are sent with in the current thread. httplib2 connections cannot
+        be shared between threads, and Google is called from several at the same time by hedged requests and by
+        concurrent *_async calls
+        :return: The httplib2.Http of the current thread
+        """
+        http = getattr(self.google_vision_connections, 'http', None)
+        if http is None:
+            import httplib2
+            http = self.google_vision_connections.http = httplib2.Http()
+        return http
+
+    def use_all(self, folder, concurrent=False, timeout=None):
         """
-        :param folder: The folder containing images to be tagged
         A wrapper that will use all available APIs
+        :param folder: The folder containing images to be tagged
+        :param concurrent: If true, all APIs are called at the same time instead of one after another
+        :param timeout: Only used when concurrent, the maximum seconds to wait for each API. Can be a number
+        or a dict with the API name as key. An API that fails or does not answer in time gets an empty column
         :return: A DataFrame with all available data
         """
         results = None
         if self.configured and os.path.isdir(folder):
-            vr_df = self.process_images_visual_recognition(folder)
-            cr_df = self.process_images_clarifai(folder)
-            im_df = self.imagga_helper.process_images(folder)
-            gv_df = self.process_images_google_vision(folder)
-            # Merge both dataframes into one
-            data_frames = [vr_df, cr_df, im_df, gv_df]
-            results = pandas.concat(data_frames, axis=1)
+            # Every API gets the same images, found in a single pass
+            catalog, duplicates = self.deduplicate(self.scan(folder))
+            processors = [('VisualRecognition', self.process_images_visual_recognition),
+                          ('Clarifai', self.process_images_clarifai),
+                          ('Imagga', self.imagga_helper.process_images),
+                          ('GoogleVision', self.process_images_google_vision)]
+            if concurrent:
+                data_frames = self.process_concurrently(processors, catalog, timeout)
+            else:
+                data_frames = [process(catalog) for api, process in processors]
+            # Merge all dataframes into one
+            import pandas
+            with self.metrics.timer('data_frame'):
+                results = pandas.concat(data_frames, axis=1)
+                if duplicates:
+                    results = self.deduplicator.propagate(results, duplicates)
 
         return results
 
+    def process_concurrently(self, processors, folder, timeout=None):
+        """
+        Calls every API processor at the same time, each one in its own thread, and waits for them until
+        their deadline is reached
+        :param processors: A list of tuples with the API name and the method that processes a folder
+        :param folder: The folder containing images to be tagged, or a catalog built by scan
+        :param timeout: The maximum seconds to wait for each API, as a number or a dict with the API name as key
+        :return: A list of DataFrames, one per API, in the same order as the processors
+        """
+        pool = ThreadPool(processes=len(processors))
+        started = time.time()
+        pending = [(api, pool.apply_async(process, (folder,))) for api, process in processors]
+        # Threads of APIs that timed out cannot be killed, so just let them finish on their own
+        pool.close()
+        data_frames = []
+        for api, async_result in pending:
+            api_timeout = timeout.get(api) if isinstance(timeout, dict) else timeout
+            data_frame = None
+            try:
+                if api_timeout is None:
+                    data_frame = async_result.get()
+                else:
+                    # All APIs started at the same time, so the deadline is relative to that moment
+                    data_frame = async_result.get(max(0, started + api_timeout - time.time()))
+            except TimeoutError:
+                print('{0} did not answer in time, its results will be empty'.format(api))
+            except Exception as ex:
+                print('{0} failed, its results will be empty. More info {1}'.format(api, str(ex)))
+            if data_frame is None:
+                import pandas
+                data_frame = pandas.DataFrame(columns=[api])
+            data_frames.append(data_frame)
+
+        return data_frames
+
+    def get_async_pool(self):
+        """
+        Gets the pool of the *_async methods, creating it on first use along with the single thread that runs
+        their callbacks
+        :return: A ThreadPool with ASYNC_CONCURRENCY threads
+        """
+        with self.async_pool_lock:
+            if self.async_pool is None:
+                self.async_pool = ThreadPool(processes=self.ASYNC_CONCURRENCY)
+                self.async_callback_pool = ThreadPool(processes=1)
+            return self.async_pool
+
+    def get_async_callback(self, callback):
+        """
+        Wraps the callback of an *_async method so it runs in the callback thread of the tagger, instead of
+        the thread of the pool that hands out every result, which it would block
+        :param callback: A function called with the value of the call, or None
+        :return: A function that only queues the callback, or None if there is no callback
+        """
+        if callback is None:
+            return None
+        self.get_async_pool()
+        callback_pool = self.async_callback_pool
+        return lambda value: callback_pool.apply_async(callback, (value,))
+
+    def close(self):
+        """
+        Stops the pools of the *_async methods, if they were created, and the workers of the Imagga helper.
+        Calls still running in the pools of the *_async methods are abandoned
+        """
+        with self.async_pool_lock:
+            if self.async_pool is not None:
+                self.async_pool.terminate()
+                self.async_callback_pool.terminate()
+                self.async_pool = None
+                self.async_callback_pool = None
+        if getattr(self, 'imagga_helper', None) is not None:
+            self.imagga_helper.close()
+
+    def process_images_visual_recognition_async(self, folder_name=None, store_results=False, callback=None):
+        """
+        Starts processing a folder with the Visual Recognition API in a thread of the shared pool, and
+        returns without waiting for it
+        :param folder_name: The complete path where the images are, or a catalog built by scan
+        :param store_results: Indicates if obtained responses should be stored as JSON file
+        :param callback: An optional function called with the DataFrame when it is ready, in the callback
+        thread shared by all the *_async methods, so it must not block
+        :return: An AsyncResult whose get returns the DataFrame of process_images_visual_recognition
+        """
+        return self.get_async_pool().apply_async(self.process_images_visual_recognition,
+                                                 (folder_name, store_results),
+                                                 callback=self.get_async_callback(callback))
+
+    def process_images_clarifai_async(self, folder_name=None, callback=None):
+        """
+        Starts processing a folder with the Clarifai API in a thread of the shared pool, and returns without
+        waiting for it
+        :param folder_name: The complete path where the images are, or a catalog built by scan
+        :param callback: An optional function called with the DataFrame when it is ready, in the callback
+        thread shared by all the *_async methods, so it must not block
+        :return: An AsyncResult whose get returns the DataFrame of process_images_clarifai
+        """
+        return self.get_async_pool().apply_async(self.process_images_clarifai, (folder_name,),
+                                                 callback=self.get_async_callback(callback))
+
+    def process_images_imagga_async(self, folder_name, base_url=None, store_results=False, callback=None):
+        """
+        Starts processing a folder with the Imagga API of the helper in a thread of the shared pool, and
+        returns without waiting for it
+        :param folder_name: The complete path where the images are, or a catalog built by scan
+        :param base_url: If the folder is already served over HTTP, the URL it is served at
+        :param store_results: Indicates if obtained responses should be stored as JSON file
+        :param callback: An optional function called with the DataFrame when it is ready, in the callback
+        thread shared by all the *_async methods, so it must not block
+        :return: An AsyncResult whose get returns the DataFrame of the process_images of ImaggaHelper
+        """
+        return self.get_async_pool().apply_async(self.imagga_helper.process_images,
+                                                 (folder_name, base_url, store_results),
+                                                 callback=self.get_async_callback(callback))
+
+    def process_images_google_vision_async(self, folder_name=None, callback=None):
+        """
+        Starts processing a folder with Google Cloud Vision in a thread of the shared pool, and returns
+        without waiting for it
+        :param folder_name: The full path to the folder with images to be processed, or a catalog built by scan
+        :param callback: An optional function called with the DataFrame when it is ready, in the callback
+        thread shared by all the *_async methods, so it must not block
+        :return: An AsyncResult whose get returns the DataFrame of process_images_google_vision
+        """
+        return self.get_async_pool().apply_async(self.process_images_google_vision, (folder_name,),
+                                                 callback=self.get_async_callback(callback))
+
+    def use_all_async(self, folder, callback=None):
+        """
+        Starts tagging a folder with all the APIs at the same time, in threads of the shared pool, and returns
+        without waiting for them. The folder is scanned and deduplicated once in the pool, then every API is
+        processed in the pool too, and the DataFrames are merged in the thread of the last one to finish, so
+        no thread is kept waiting
+        :param folder: The folder containing images to be tagged
+        :param callback: An optional function called with the merged DataFrame when it is ready, in the
+        callback thread shared by all the *_async methods, so it must not block
+        :return: A GatheredResult whose get returns the DataFrame of use_all. An API that fails gets an
+        empty column, and the result is None if the tagger is not configured or the folder does not exist
+        """
+        callback = self.get_async_callback(callback)
+        if not self.configured or not os.path.isdir(folder):
+            return GatheredResult([], lambda values, errors: None, callback)
+        processors = [('VisualRecognition', self.process_images_visual_recognition),
+                      ('Clarifai', self.process_images_clarifai),
+                      ('Imagga', self.imagga_helper.process_images),
+                      ('GoogleVision', self.process_images_google_vision)]
+
+        def merge(data_frames, errors):
+            for api, error in errors.iteritems():
+                print('{0} failed, its results will be empty. More info {1}'.format(api, str(error)))
+            import pandas
+            columns = list()
+            for api, process in processors:
+                data_frame = data_frames.get(api)
+                columns.append(data_frame if data_frame is not None else pandas.DataFrame(columns=[api]))
+            with self.metrics.timer('data_frame'):
+                results = pandas.concat(columns, axis=1)
+                if scanned['duplicates']:
+                    results = self.deduplicator.propagate(results, scanned['duplicates'])
+            return results
+
+        gathered = GatheredResult([api for api, process in processors], merge, callback)
+        pool = self.get_async_pool()
+        # The duplicates found when scanning, kept until the DataFrames are merged
+        scanned = dict()
+
+        def scan(folder):
+            return self.deduplicate(self.scan(folder))
+
+        def start_processors(folder):
+            # Run in the pool, like the processors, and not as a callback of the pool
+            name, succeeded, value = gathered.run('scan', scan, folder)
+            if not succeeded:
+                gathered.fail(value)
+                return
+            catalog, scanned['duplicates'] = value
+            for api, process in processors:
+                pool.apply_async(gathered.run_part, (api, process, catalog))
+
+        pool.apply_async(start_processors, (folder,))
+        return gathered
+
+    def iter_all(self, folder, apis=None):
+        """
+        Tags the folder with all the available APIs at the same time, yielding the tags of every image and API
+        as soon as they are available, so consumers can start working before the whole folder is tagged
+        :param folder: The folder containing images to be tagged, or a catalog built by scan
+        :param apis: An optional list with the names of the APIs to use, all the available ones by default
+        :return: A generator of tuples with the image name, the API name and the list of tuples with the tags found
+        """
+        iterators = self.api_iterators()
+        apis = [api for api in (apis or self.apis) if api in iterators]
+        catalog, duplicates = self.deduplicate(self.scan(folder) if isinstance(folder, basestring) else folder)
+        # The duplicates of every image tagged in their place
+        copies = dict()
+        for duplicate, image_name in duplicates.iteritems():
+            copies.setdefault(image_name, list()).append(duplicate)
+        # Bounded, so APIs faster than the consumer wait for it instead of piling up results
+        records = Queue.Queue(maxsize=self.ITER_ALL_BUFFER)
+        finished = object()
+        # Set when the consumer stops iterating, so the APIs stop sending images
+        stopped = threading.Event()
+
+        def put(record):
+            while not stopped.is_set():
+                try:
+                    records.put(record, timeout=0.1)
+                    return
+                except Queue.Full:
+                    pass
+
+        def produce(api):
+            iterator = iterators[api](catalog)
+            try:
+                for record in iterator:
+                    if stopped.is_set():
+                        break
+                    put(record)
+            except Exception as ex:
+                print('{0} failed, no more results will come from it. More info {1}'.format(api, str(ex)))
+            finally:
+                # Lets the API drop what it did not send yet
+                if hasattr(iterator, 'close'):
+                    iterator.close()
+                put(finished)
+
+        for api in apis:
+            producer = threading.Thread(target=produce, args=(api,), name='iter-all-%s' % api)
+            producer.daemon = True
+            producer.start()
+        running = len(apis)
+        try:
+            while running:
+                record = records.get()
+                if record is finished:
+                    running -= 1
+                else:
+                    yield record
+                    image_name, api, tags = record
+                    for duplicate in copies.get(image_name, []):
+                        yield duplicate, api, tags
+        finally:
+            stopped.set()
+
+    def store_all(self, folder, apis=None):
+        """
+        Tags the folder with all the available APIs at the same time, storing the results as they come in a
+        TagStore instead of DataFrames with lists of tuples, which is much lighter for big folders
+        :param folder: The folder containing images to be tagged
+        :param apis: An optional list with the names of the APIs to use, all the available ones by default
+        :return: A TagStore with all available data
+        """
+        from result_store import TagStore
+        return TagStore().add_records(self.iter_all(folder, apis))
+
+    def scan(self, folder):
+        """
+        Finds the images of a folder and its subfolders, so the same catalog can be given to every API
+        :param folder: The folder containing images to be tagged
+        :return: A list of CatalogImage
+        """
+        with self.metrics.timer('scan'):
+            return self.scanner.scan(folder)
+
+    def deduplicate(self, catalog):
+        """
+        Leaves only one image of every group of near duplicates, if there is a deduplicator
+        :param catalog: A list of CatalogImage
+        :return: A tuple with the list of CatalogImage to tag and a dict with the name of every duplicate as key
+        and the name of the image tagged in its place as value
+        """
+        if self.deduplicator is None:
+            return list(catalog), dict()
+        with self.metrics.timer('dedup'):
+            catalog, duplicates = self.deduplicator.deduplicate(catalog)
+        self.metrics.increment('duplicates', len(duplicates))
+        return catalog, duplicates
+
+    def catalog(self, folder_name):
+        """
+        Gets the images to be tagged by an API
+        :param folder_name: The full path of a folder, scanned lazily, or a catalog built by scan
+        :return: An iterable of CatalogImage
+        """
+        if isinstance(folder_name, basestring):
+            return self.scanner.iter_images(folder_name)
+        return folder_name
+
+    def api_iterators(self):
+        """
+        Returns the methods that tag a folder image by image for every configured API
+        :return: A dict with the API name as key and the method as value
+        """
+        iterators = dict()
+        if self.visual_recognition:
+            iterators['VisualRecognition'] = self.iter_visual_recognition
+        if self.clarifai:
+            iterators['Clarifai'] = self.iter_clarifai
+        if getattr(self, 'imagga_helper', None) and self.imagga_helper.configured:
+            iterators['Imagga'] = self.imagga_helper.iter_folder
+        if self.google_vision_service:
+            iterators['GoogleVision'] = self.iter_google_vision
+        return iterators
+
+    def request_params(self, api):
+        """
+        Returns the request parameters that change the response of an API, these are part of the cache key
+        :param api: The name of the API
+        :return: A dict with the parameters
+        """
+        params = {
+            'VisualRecognition': {'version': self.VISUAL_RECOGNITION_VERSION,
+                                  'threshold': self.VISUAL_RECOGNITION_THRESHOLD},
+            'Clarifai': {},
+            'GoogleVision': {'type': 'LABEL_DETECTION',
+                             'maxResults': self.GOOGLE_VISION_MAX_RESULTS}
+        }
+        params = dict(params[api])
+        # Reduced images may get different tags than the originals
+        if self.preprocessor:
+            params['preprocess'] = list(self.preprocessor.settings_for(api))
+        return params
+
+    def prepare_image(self, api, image_path, image_hash=None):
+        """
+        Returns the path of the image to be sent to an API, reduced by the preprocessor if there is one
+        :param api: The name of the API
+        :param image_path: The full path of the original image
+        :param image_hash: The content hash of the original image, if already known
+        :return: The path of the image to send
+        """
+        if not self.preprocessor:
+            return image_path
+        return self.preprocessor.prepare(image_path, api, image_hash)
+
+    def get_cached_tags(self, api, image_path):
+        """
+        Looks for the tags of an image in the manifest and in the result cache, if there are any
+        :param api: The name of the API
+        :param image_path: The full path of the image
+        :return: A tuple with the content hash of the image and the list of cached tags, or None as tags
+        if they are not cached
+        """
+        if self.result_cache is None and self.manifest is None:
+            return None, None
+        params = self.request_params(api)
+        cached_tags = None
+        if self.manifest is not None:
+            # Unchanged images are not read again to get their hash
+            image_hash = self.manifest.image_hash(image_path)
+            cached_tags = self.manifest.get(image_hash, api, params)
+        else:
+            image_hash = content_hash(image_path)
+        if cached_tags is None and self.result_cache is not None:
+            cached_tags = self.result_cache.get(image_hash, api, params)
+            if cached_tags is not None and self.manifest is not None:
+                self.manifest.checkpoint(api, [(image_hash, cached_tags)], params)
+        if cached_tags is not None:
+            self.metrics.increment('cache_hits', api=api)
+            # JSON has no tuples, restore them
+            cached_tags = [tuple(tag) for tag in cached_tags]
+        else:
+            self.metrics.increment('cache_misses', api=api)
+        return image_hash, cached_tags
+
+    def get_api_cached_tags(self, api, image):
+        """
+        Looks for the tags of an image already found by any API, Imagga included, without calling it
+        :param api: The name of the API
+        :param image: A CatalogImage
+        :return: The list of tuples with the cached tags, None if they are not cached
+        """
+        if api == 'Imagga':
+            imagga_helper = getattr(self, 'imagga_helper', None)
+            if imagga_helper is None:
+                return None
+            image_hash, tag_result = imagga_helper.get_cached_result(image.path)
+            return imagga_helper.parse_tags(tag_result) if tag_result is not None else None
+        image_hash, cached_tags = self.get_cached_tags(api, image.path)
+        return cached_tags
+
+    def set_cached_tags(self, api, image_hash, tags):
+        """
+        Stores the tags of an image in the result cache, if there is one
+        :param api: The name of the API
+        :param image_hash: The content hash of the image
+        :param tags: The list of tuples with the tags found
+        """
+        if self.result_cache is not None and image_hash:
+            self.result_cache.set(image_hash, api, tags, self.request_params(api))
+
+    def checkpoint(self, api, tagged):
+        """
+        Stores the tags of a batch in the result cache and in the manifest, if there are any. The manifest
+        records the whole batch at once, so an interrupted run resumes after the last finished batch
+        :param api: The name of the API
+        :param tagged: A list of tuples with the content hash of every image and the list of tuples with its tags
+        """
+        self.metrics.increment('images', len(tagged), api)
+        for image_hash, tags in tagged:
+            self.set_cached_tags(api, image_hash, tags)
+        if self.manifest is not None:
+            self.manifest.checkpoint(api, tagged, self.request_params(api))
+
+    def count_response_bytes(self, api, response):
+        """
+        Counts the bytes received from an API. The SDKs return the responses already parsed, so they are
+        serialized again to get their size, only when metrics are enabled
+        :param api: The name of the API
+        :param response: The parsed response
+        """
+        if self.metrics.enabled:
+            self.metrics.increment('bytes_received', len(json.dumps(response)), api)
+
     def path_leaf(self, path):
         """
         A simple helper function that returns the last path (the file) of a path
@@ -1,10 +1,17 @@
 import os
 import yaml
 import json
+import codecs
 import requests
-import pandas
+import urllib
+import threading
+from multiprocessing.pool import ThreadPool
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
-from simplejson import JSONDecodeError
+from result_cache import content_hash
+from scanner import ImageScanner
+from resilience import CallGuard, TransientError
+from metrics import NULL_METRICS
 
 
 class ImaggaHelper(object):
@@ -17,9 +24,37 @@ class ImaggaHelper(object):
     IMAGGA_API_SECRET = ''
     ENDPOINT = 'https://api.imagga.com/v1'
     IMAGGA_FILE_TYPES = ['png', 'jpg', 'jpeg', 'gif']
+    # Number of images uploaded and tagged at the same time
+    IMAGGA_CONCURRENCY = 4
+    # Imagga keeps uploaded content for 24 hours, stay a bit below that
+    CONTENT_ID_TTL = 23 * 60 * 60
+    # Seconds after which a slow tagging request is sent again, None never sends it twice
+    IMAGGA_HEDGE_AFTER = None
 
-    def __init__(self):
+    def __init__(self, result_cache=None, concurrency=IMAGGA_CONCURRENCY, content_cache=None, preprocessor=None,
+                 manifest=None, metrics=NULL_METRICS):
         self.auth = None
+        # An optional ResultCache, so the same image is never tagged twice
+        self.result_cache = result_cache
+        # An optional ResultCache that maps image content hashes to content IDs, so the same image
+        # is never uploaded twice while Imagga still has it. Can be the same instance as result_cache
+        self.content_cache = content_cache
+        # An optional ImagePreprocessor that reduces images before they are uploaded
+        self.preprocessor = preprocessor
+        # An optional Manifest that records the images already tagged, so reruns only send new or changed ones
+        self.manifest = manifest
+        self.concurrency = concurrency
+        # Optional Metrics with the time spent in every stage and the counters of the API
+        self.metrics = metrics
+        # Retries with backoff and a circuit breaker for every request
+        self.guard = CallGuard('Imagga', hedge_after=self.IMAGGA_HEDGE_AFTER, metrics=metrics)
+        # Finds the images of a folder and its subfolders in a single pass
+        self.scanner = ImageScanner(self.IMAGGA_FILE_TYPES)
+        # Keep-alive connections reused by every request, so images do not pay a handshake each
+        self.session = self.create_session()
+        # Workers that upload and tag images, created by the first call and shared by all of them
+        self.pool = None
+        self.pool_lock = threading.Lock()
         self.configured = False
         self.apis = ['VisualRecognition', 'Clarifai', 'Imagga', 'GoogleVision']
         self.images_names = list()
@@ -36,6 +71,15 @@ class ImaggaHelper(object):
             # Get config data
             self.IMAGGA_API_KEY = config['imagga']['api-key']
             self.IMAGGA_API_SECRET = config['imagga']['api-secret']
+            if config['imagga'].get('concurrency'):
+                self.concurrency = int(config['imagga']['concurrency'])
+                self.session = self.create_session()
+                # The next call creates a pool with the new number of workers
+                self.close()
+            if config['imagga'].get('hedge-after'):
+                self.guard.hedge_after = float(config['imagga']['hedge-after'])
+            if config['imagga'].get('endpoint'):
+                self.ENDPOINT = config['imagga']['endpoint'].rstrip('/')
             if self.IMAGGA_API_KEY and self.IMAGGA_API_KEY:
                 self.auth = HTTPBasicAuth(self.IMAGGA_API_KEY, self.IMAGGA_API_SECRET)
                 self.configured = True
@@ -43,6 +87,39 @@ class ImaggaHelper(object):
         else:
             return False
 
+    def create_session(self):
+        """
+        Creates a requests session whose connection pool is big enough for all the concurrent requests
+        :return: The new session
+        """
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.concurrency)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
+    def get_pool(self):
+        """
+        Gets the pool of workers that upload and tag images, creating it on first use. It is shared by every
+        call, so batches tagged one after another, like the ones of the tagging service, do not start threads
+        :return: A ThreadPool with as many workers as the concurrency of the helper
+        """
+        with self.pool_lock:
+            if self.pool is None:
+                self.pool = ThreadPool(processes=self.concurrency)
+            return self.pool
+
+    def close(self):
+        """
+        Stops the pool of workers, if it was created, once the images sent to it are tagged. A later call
+        creates it again
+        """
+        with self.pool_lock:
+            pool, self.pool = self.pool, None
+        if pool is not None:
+            pool.close()
+            pool.join()
+
     def upload_image(self, image_path):
         """
         Uploads an image to the Imagga API so it can be processed afterwards
@@ -56,21 +133,29 @@ class ImaggaHelper(object):
         with open(image_path, 'rb') as image_file:
             filename = image_file.name
 
-            # Upload the multipart-encoded image with a POST
-            # request to the /content endpoint
-            content_response = requests.post(
-                '%s/content' % self.ENDPOINT,
-                auth=self.auth,
-                files={filename: image_file})
+            def upload():
+                # Every attempt sends the file from the start
+                image_file.seek(0)
+                if self.metrics.enabled:
+                    self.metrics.increment('bytes_sent', os.fstat(image_file.fileno()).st_size, 'Imagga')
+                # Upload the multipart-encoded image with a POST
+                # request to the /content endpoint
+                return self.read_response(self.session.post(
+                    '%s/content' % self.ENDPOINT,
+                    auth=self.auth,
+                    files={filename: image_file}))
 
             # Example /content response:
             # {'status': 'success',
             #  'uploaded': [{'id': '8aa6e7f083c628407895eb55320ac5ad',
             #                'filename': 'example_image.jpg'}]}
             try:
-                uploaded_files = content_response.json()['uploaded']
-            except JSONDecodeError:
-                import pudb; pudb.set_trace()
+                uploaded_files = self.guard.call(upload, hedge=False).get('uploaded')
+            except Exception as ex:
+                print('Could not upload {0} to Imagga. More info {1}'.format(image_path, str(ex)))
+                return None
+            if not uploaded_files:
+                print('Imagga did not accept {0}'.format(image_path))
                 return None
 
             # Get the content id of the uploaded file
@@ -83,7 +168,7 @@ class ImaggaHelper(object):
         Calls the Imagga tagging API endpoint and returns the results
         :param image: Can be a URL or the content ID from uploading the image
         :param verbose: If true it includes the origin of the tagging procedure
-        :return: The JSON response from the tagging call
+        :return: The JSON response from the tagging call, None if it failed
         """
         # Using the content id and the content parameter,
         # make a GET request to the /tagging endpoint to get
@@ -92,10 +177,12 @@ class ImaggaHelper(object):
             'content': image,
             'verbose': verbose,
         }
-        tagging_response = requests.get(
-            '%s/tagging' % self.ENDPOINT,
-            auth=self.auth,
-            params=tagging_query)
+
+        def tag():
+            return self.read_response(self.session.get(
+                '%s/tagging' % self.ENDPOINT,
+                auth=self.auth,
+                params=tagging_query))
 
         # In case we want to save to file the results with a decent format
         # with open('results.json', 'w') as out:
@@ -105,111 +192,277 @@ class ImaggaHelper(object):
         #                    indent=4,
         #                    separators=(',', ': '))
 
-        return tagging_response.json()
+        try:
+            return self.guard.call(tag)
+        except Exception as ex:
+            print('Could not tag {0} with Imagga. More info {1}'.format(image, str(ex)))
+            return None
+
+    def read_response(self, response):
+        """
+        Gets the JSON body of an Imagga response, turning throttling, server errors and responses that are
+        not JSON, like the error pages of proxies, into transient errors so they are retried
+        :param response: The response of the request
+        :return: The JSON body
+        """
+        if self.metrics.enabled:
+            self.metrics.increment('bytes_received', len(response.content), 'Imagga')
+        if response.status_code in CallGuard.TRANSIENT_STATUSES:
+            retry_after = getattr(response, 'headers', {}).get('Retry-After')
+            raise TransientError('Imagga answered with status %s' % response.status_code,
+                                 self.guard.parse_retry_after(retry_after))
+        try:
+            return response.json()
+        except ValueError:
+            raise TransientError('Imagga answered with status %s and a body that is not JSON' % response.status_code)
 
-    def tag_folder(self, folder_path):
+    def tag_folder(self, folder_path, base_url=None):
         """
-        Iterates over the images found in the specified path and calls Imagga API for each image
+        Iterates over the images found in the specified path and calls Imagga API for each image. Images are
+        uploaded and tagged by a pool of workers, so the upload of an image overlaps with the tagging of others
         :param folder_path: The full path of the folder to extract and process images from
-        :param verbose: If true it includes the origin of the tagging procedure
-        :return: The JSON response from the tagging call
+        :param base_url: If the folder is already served over HTTP, the URL it is served at. Images are then
+        tagged by URL and never uploaded
+        :return: A dict with the JSON response from the tagging call of every image, keyed by image name
         """
-        results = {}
-        # Check if specified folder exists
-        if os.path.isdir(folder_path):
-            # Get the images if the exist and if they are in the supported types
-            images = [filename for filename in os.listdir(folder_path)
-                      if os.path.isfile(os.path.join(folder_path, filename)) and
-                      filename.split('.')[-1].lower() in self.IMAGGA_FILE_TYPES]
-
-            images_count = len(images)
-            for iterator, image_file in enumerate(images):
-                image_path = os.path.join(folder_path, image_file)
-                print('[%s / %s] %s uploading' %
-                      (iterator + 1, images_count, image_path))
-
-                content_id = self.upload_image(image_path)
-                if content_id:
-                    tag_result = self.tag_image(content_id, True)
-                    results[image_file] = tag_result
-                    print('[%s / %s] %s tagged' %
-                          (iterator + 1, images_count, image_path))
+        return dict(self.iter_tag_results(folder_path, base_url))
+
+    def iter_tag_results(self, folder_path, base_url=None):
+        """
+        Tags the images found in the specified path, yielding the response of every image as soon as it is tagged
+        :param folder_path: The full path of the folder to extract and process images from, or a catalog built
+        by ImageScanner.scan
+        :param base_url: If the folder is already served over HTTP, the URL it is served at
+        :return: A generator of tuples with the image name and the JSON response from the tagging call
+        """
+        if isinstance(folder_path, basestring):
+            # Check if specified folder exists
+            if not os.path.isdir(folder_path):
+                raise ValueError('The input directory does not exist: %s' % folder_path)
+            with self.metrics.timer('scan', 'Imagga'):
+                images = self.scanner.scan(folder_path)
         else:
-            raise ValueError('The input directory does not exist: %s' % folder_path)
-        response = json.dumps(results, ensure_ascii=False, indent=4).encode('utf-8')
-        return response
+            # Catalogs shared with other APIs may have images of types Imagga does not take
+            images = [image for image in folder_path if image.type in self.IMAGGA_FILE_TYPES]
+
+        images_count = len(images)
+        names = dict((image.path, image.name) for image in images)
+        jobs = list()
+        for iterator, image in enumerate(images):
+            image_url = None
+            if base_url:
+                image_url = '%s/%s' % (base_url.rstrip('/'), urllib.quote(image.name))
+            jobs.append((image.path, iterator + 1, images_count, image_url))
+        # Set if the consumer stops early, the pool is shared so the images not started yet are skipped instead
+        stopped = threading.Event()
+
+        def upload_and_tag(job):
+            if stopped.is_set():
+                return job[0], None
+            return self.upload_and_tag_image(*job)
+
+        try:
+            for image_path, tag_result in self.get_pool().imap_unordered(upload_and_tag, jobs):
+                if tag_result is not None:
+                    yield names[image_path], tag_result
+        finally:
+            stopped.set()
 
-    def tag_folder(self, folder_path):
+    def iter_folder(self, folder_path, base_url=None):
         """
-        Iterates over the images found in the specified path and calls Imagga API for each image
+        Tags the images found in the specified path, yielding the tags of every image as soon as it is tagged
         :param folder_path: The full path of the folder to extract and process images from
-        :param verbose: If true it includes the origin of the tagging procedure
-        :return: The JSON string response from the tagging call
+        :param base_url: If the folder is already served over HTTP, the URL it is served at
+        :return: A generator of tuples with the image name, the API name and the list of tuples with the tags found
+        """
+        for image_name, tag_result in self.iter_tag_results(folder_path, base_url):
+            tags_found = self.parse_tags(tag_result)
+            if tags_found:
+                yield image_name, 'Imagga', tags_found
+
+    def parse_tags(self, tag_result):
+        """
+        Gets the tags found in the response of the tagging call
+        :param tag_result: The JSON response from the tagging call
+        :return: A list of tuples with the tag and its confidence
+        """
+        tags_found = []
+        with self.metrics.timer('parse', 'Imagga'):
+            if 'results' in tag_result.keys():
+                # Try to get the tags obtained
+                results = tag_result['results']
+                if results:
+                    for tags in results:
+                        # Get the tags for this image
+                        labels = tags['tags']
+                        for label in labels:
+                            tag_found = (label['tag'], label['confidence'])
+                            tags_found.append(tag_found)
+        return tags_found
+
+    def tag_urls(self, urls):
+        """
+        Tags images already served over HTTP, without uploading them
+        :param urls: A list with the URLs of the images
+        :return: A dict with the JSON response from the tagging call of every image, keyed by URL
         """
         results = {}
-        # Check if specified folder exists
-        if os.path.isdir(folder_path):
-            # Get the images if the exist and if they are in the supported types
-            images = [filename for filename in os.listdir(folder_path)
-                      if os.path.isfile(os.path.join(folder_path, filename)) and
-                      filename.split('.')[-1].lower() in self.IMAGGA_FILE_TYPES]
-
-            images_count = len(images)
-            for iterator, image_file in enumerate(images):
-                image_path = os.path.join(folder_path, image_file)
-                print('[%s / %s] %s uploading' %
-                      (iterator + 1, images_count, image_path))
-
-                content_id = self.upload_image(image_path)
-                if content_id:
-                    tag_result = self.tag_image(content_id, True)
-                    results[image_file] = tag_result
-                    print('[%s / %s] %s tagged' %
-                          (iterator + 1, images_count, image_path))
+        tagged = self.get_pool().imap_unordered(lambda url: (url, self.tag_image(url, True)), urls)
+        for url, tag_result in tagged:
+            if tag_result is not None:
+                results[url] = tag_result
+        return results
+
+    def upload_and_tag_image(self, image_path, position=1, total=1, image_url=None):
+        """
+        Uploads an image and tags it, unless its tags are already cached. The upload is skipped as well when
+        Imagga still has the image from a previous upload or when the image URL is given
+        :param image_path: The full path of the image
+        :param position: The position of the image in the folder, only used to report progress
+        :param total: The number of images in the folder, only used to report progress
+        :param image_url: The URL the image is served at, if any
+        :return: A tuple with the image path and the JSON response from the tagging call, None if it failed
+        """
+        image_hash, tag_result = self.get_cached_result(image_path)
+        if tag_result is not None:
+            print('[%s / %s] %s already tagged' % (position, total, image_path))
+            return image_path, tag_result
+        if image_hash is None and (self.content_cache is not None or self.preprocessor):
+            image_hash = content_hash(image_path)
+
+        tag_result = None
+        if image_url:
+            tag_result = self.tag_image(image_url, True)
+        else:
+            content_id, reused = self.get_content_id(image_path, image_hash, position, total)
+            if content_id:
+                tag_result = self.tag_image(content_id, True)
+                if reused and (tag_result is None or 'results' not in tag_result):
+                    # Imagga may have dropped the content before it expired here, upload it again
+                    self.content_cache.set(image_hash, 'ImaggaContent', None, self.request_params())
+                    content_id, reused = self.get_content_id(image_path, image_hash, position, total)
+                    tag_result = self.tag_image(content_id, True) if content_id else None
+        if tag_result is not None:
+            # Only successful responses are worth caching
+            if self.result_cache is not None and 'results' in tag_result:
+                self.result_cache.set(image_hash, 'Imagga', tag_result, self.request_params())
+            if self.manifest is not None and 'results' in tag_result:
+                self.manifest.checkpoint('Imagga', [(image_hash, tag_result)], self.request_params())
+            if 'results' in tag_result:
+                self.metrics.increment('images', api='Imagga')
+            print('[%s / %s] %s tagged' % (position, total, image_path))
+        return image_path, tag_result
+
+    def get_cached_result(self, image_path):
+        """
+        Looks for the response of the tagging call of an image in the manifest and in the result cache, if
+        there are any
+        :param image_path: The full path of the image
+        :return: A tuple with the content hash of the image, None if there is nowhere to look, and the cached
+        JSON response, or None as response if it is not cached
+        """
+        if self.manifest is None and self.result_cache is None:
+            return None, None
+        tag_result = None
+        if self.manifest is not None:
+            # Unchanged images are not read again to get their hash
+            image_hash = self.manifest.image_hash(image_path)
+            tag_result = self.manifest.get(image_hash, 'Imagga', self.request_params())
         else:
-            raise ValueError('The input directory does not exist: %s' % folder_path)
-        response = json.dumps(results, ensure_ascii=False, indent=4).encode('utf-8')
-        return response
+            image_hash = content_hash(image_path)
+        if tag_result is None and self.result_cache is not None:
+            tag_result = self.result_cache.get(image_hash, 'Imagga', self.request_params())
+        self.metrics.increment('cache_hits' if tag_result is not None else 'cache_misses', api='Imagga')
+        return image_hash, tag_result
+
+    def get_content_id(self, image_path, image_hash=None, position=1, total=1):
+        """
+        Gets the content ID of an image, uploading it only if Imagga does not have it already
+        :param image_path: The full path of the image
+        :param image_hash: The content hash of the image, calculated if not given
+        :param position: The position of the image in the folder, only used to report progress
+        :param total: The number of images in the folder, only used to report progress
+        :return: A tuple with the content ID and a flag indicating if it comes from a previous upload
+        """
+        if self.content_cache is not None:
+            image_hash = image_hash or content_hash(image_path)
+            content_id = self.content_cache.get(image_hash, 'ImaggaContent', self.request_params(),
+                                                ttl=self.CONTENT_ID_TTL)
+            if content_id:
+                print('[%s / %s] %s already uploaded' % (position, total, image_path))
+                return content_id, True
+        print('[%s / %s] %s uploading' % (position, total, image_path))
+        upload_path = image_path
+        if self.preprocessor:
+            upload_path = self.preprocessor.prepare(image_path, 'Imagga', image_hash)
+        content_id = self.upload_image(upload_path)
+        if content_id and self.content_cache is not None:
+            self.content_cache.set(image_hash, 'ImaggaContent', content_id, self.request_params())
+        return content_id, False
+
+    def request_params(self):
+        """
+        Returns the request parameters that change the response of the API, these are part of the cache keys
+        :return: A dict with the parameters
+        """
+        params = {'verbose': True}
+        # Reduced images may get different tags than the originals
+        if self.preprocessor:
+            params['preprocess'] = list(self.preprocessor.settings_for('Imagga'))
+        return params
+
+    def store_results(self, results, file_path='imagga_tagging_results.json'):
+        """
+        Writes the responses of the tagging calls to a JSON file, as they are encoded
+        :param results: A dict with the JSON response of every image, like the one returned by tag_folder
+        :param file_path: The path of the file, replaced if it exists
+        """
+        with codecs.open(file_path, 'w', encoding='utf-8') as fd:
+            json.dump(results, fd, ensure_ascii=False, indent=4, sort_keys=True)
 
-    def process_images(self, folder_name):
+    def process_images(self, folder_name, base_url=None, store_results=False):
         """
         Processes the specified image folder using the Imagga API
         :param folder_name: The complete path where the images are
+        :param base_url: If the folder is already served over HTTP, the URL it is served at, so images
+        are tagged by URL instead of being uploaded
+        :param store_results: Indicates if obtained responses should be stored as JSON file
         :return: A DataFrame containing the available data
         """
         data_frame = None
         # Check we have the client API instance
         if self.configured:
-            # Generate a dict with a list of tuples with all tags found per image
+            # The names of the images of this call only, the helper may process several folders
+            images_names = list()
+            imagga_results = dict()
             try:
                 # Generate a dict with a list of tuples with all tags found per image
                 intermediate_results = dict()
                 try:
-                    intermediate_results = json.loads(self.tag_folder(folder_path=folder_name))
+                    intermediate_results = self.tag_folder(folder_path=folder_name, base_url=base_url)
+                    if isinstance(intermediate_results, basestring):
+                        # Responses serialized somewhere else, like a file of a previous run
+                        intermediate_results = json.loads(intermediate_results)
                 except:
                     print('Could process any image from specified folder using Imagga API')
                     return None
+                if store_results:
+                    self.store_results(intermediate_results)
 
-                imagga_results = dict()
                 for image_name, contents in intermediate_results.iteritems():
-                    tags_found = []
-                    self.images_names.append(image_name)
-                    if 'results' in contents.keys():
-                        # Try to get the tags obtained
-                        results = contents['results']
-                        if results:
-                            for tags in results:
-                                # Get the tags for this image
-                                labels = tags['tags']
-                                for label in labels:
-                                    tag_found = (label['tag'], label['confidence'])
-                                    tags_found.append(tag_found)
-                                    imagga_results[image_name] = tags_found
+                    images_names.append(image_name)
+                    tags_found = self.parse_tags(contents)
+                    if tags_found:
+                        imagga_results[image_name] = tags_found
             except Exception as ex:
                 print ('COULD NOT LOAD, reason {0}'.format(str(ex)))
-            sorted_names = sorted(self.images_names)
-            data_series = pandas.Series(imagga_results, index=sorted_names, name='Imagga')
-            data_frame = pandas.DataFrame(data_series, index=sorted_names, columns=['Imagga'])
+            sorted_names = sorted(images_names)
+            self.images_names = sorted_names
+            # Imported here so the helper can be used without pandas, like the workers of the command line do
+            import pandas
+            with self.metrics.timer('data_frame', 'Imagga'):
+                data_series = pandas.Series(imagga_results, index=sorted_names, name='Imagga')
+                data_frame = pandas.DataFrame(data_series, index=sorted_names, columns=['Imagga'])
             return data_frame
 
         return data_frame
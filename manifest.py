@@ -0,0 +1,130 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+from result_cache import content_hash
+
+
+class Manifest(object):
+    """
+    Keeps track of the images of the folders being tagged and of the APIs that already tagged them, in a
+    SQLite database. Every image is recorded with its path, size, modification time and content hash, so an
+    unchanged image is recognized by a stat call without reading it again. Results are checkpointed once per
+    batch, keyed by content hash, API and request parameters, so a run that dies halfway resumes where it
+    stopped and reruns only send new or changed images.
+    Unlike the ResultCache entries never expire, the manifest is the record of the work already done
+    """
+    DEFAULT_DB_PATH = 'tagging_manifest.db'
+
+    def __init__(self, db_path=DEFAULT_DB_PATH):
+        """
+        :param db_path: The file path of the SQLite database, created if it does not exist
+        """
+        self.db_path = db_path
+        # The same manifest is shared by APIs running in different threads
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(db_path, check_same_thread=False)
+        with self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS images ('
+                                    'path TEXT PRIMARY KEY, '
+                                    'size INTEGER NOT NULL, '
+                                    'mtime REAL NOT NULL, '
+                                    'hash TEXT NOT NULL)')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS results ('
+                                    'hash TEXT NOT NULL, '
+                                    'api TEXT NOT NULL, '
+                                    'params TEXT NOT NULL, '
+                                    'value TEXT NOT NULL, '
+                                    'completed REAL NOT NULL, '
+                                    'PRIMARY KEY (hash, api, params))')
+
+    def image_hash(self, image_path):
+        """
+        Gets the content hash of an image, reading the image only if it is new or its size or modification
+        time changed since it was recorded
+        :param image_path: The full path of the image
+        :return: The hexadecimal content hash
+        """
+        image_path = os.path.abspath(image_path)
+        stat = os.stat(image_path)
+        with self.lock:
+            row = self.connection.execute('SELECT size, mtime, hash FROM images WHERE path = ?',
+                                          (image_path,)).fetchone()
+        if row and row[0] == stat.st_size and row[1] == stat.st_mtime:
+            return row[2]
+        image_hash = content_hash(image_path)
+        with self.lock:
+            with self.connection:
+                self.connection.execute('INSERT OR REPLACE INTO images (path, size, mtime, hash) VALUES (?, ?, ?, ?)',
+                                        (image_path, stat.st_size, stat.st_mtime, image_hash))
+        return image_hash
+
+    def make_params(self, params=None):
+        """
+        Serializes the request parameters so they can be part of the key of a result
+        :param params: A dict with the request parameters that change the API response
+        :return: The parameters as a string
+        """
+        return json.dumps(params or {}, sort_keys=True)
+
+    def get(self, image_hash, api, params=None):
+        """
+        Gets the checkpointed result of an image
+        :param image_hash: The content hash of the image
+        :param api: The name of the API that tagged the image
+        :param params: A dict with the request parameters used
+        :return: The stored value or None if the API did not tag the image yet
+        """
+        with self.lock:
+            row = self.connection.execute('SELECT value FROM results WHERE hash = ? AND api = ? AND params = ?',
+                                          (image_hash, api, self.make_params(params))).fetchone()
+        if not row:
+            return None
+        return json.loads(row[0])
+
+    def checkpoint(self, api, results, params=None):
+        """
+        Records the results of a batch in a single transaction, so a batch is either fully recorded or not at all
+        :param api: The name of the API that tagged the images
+        :param results: A list of tuples with the content hash of every image and any JSON serializable value
+        :param params: A dict with the request parameters used
+        """
+        params = self.make_params(params)
+        now = time.time()
+        rows = [(image_hash, api, params, json.dumps(value), now) for image_hash, value in results if image_hash]
+        if not rows:
+            return
+        with self.lock:
+            with self.connection:
+                self.connection.executemany('INSERT OR REPLACE INTO results (hash, api, params, value, completed) '
+                                            'VALUES (?, ?, ?, ?, ?)', rows)
+
+    def pending(self, image_paths, api, params=None):
+        """
+        Filters the images an API still has to tag
+        :param image_paths: A list with the full paths of the images
+        :param api: The name of the API
+        :param params: A dict with the request parameters used
+        :return: A list with the paths of the images without a result, in the same order
+        """
+        return [image_path for image_path in image_paths
+                if self.get(self.image_hash(image_path), api, params) is None]
+
+    def forget(self, api=None):
+        """
+        Removes the results of an API, so its images are tagged again in the next run
+        :param api: The name of the API, None removes the results of all of them
+        """
+        with self.lock:
+            with self.connection:
+                if api is None:
+                    self.connection.execute('DELETE FROM results')
+                else:
+                    self.connection.execute('DELETE FROM results WHERE api = ?', (api,))
+
+    def close(self):
+        """
+        Closes the underlying database connection
+        """
+        self.connection.close()
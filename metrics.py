@@ -0,0 +1,225 @@
+import json
+import time
+import bisect
+import threading
+import BaseHTTPServer
+
+
+class NullTimer(object):
+    """
+    A timer that measures nothing, shared by every stage when metrics are disabled
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+class NullMetrics(object):
+    """
+    Metrics that record nothing, the default of every class that can be instrumented. Timing a stage only
+    costs a method call returning a shared timer, so instrumented code runs as fast as it did without it
+    """
+    enabled = False
+    NULL_TIMER = NullTimer()
+
+    def timer(self, stage, api=None):
+        """
+        Times a stage with a with statement
+        :param stage: The name of the stage, like scan, read, encode, request, parse or data_frame
+        :param api: The name of the API, None for stages shared by all of them
+        :return: A context manager
+        """
+        return self.NULL_TIMER
+
+    def observe(self, stage, seconds, api=None):
+        """
+        Records the duration of a stage measured somewhere else
+        :param stage: The name of the stage
+        :param seconds: The seconds it took
+        :param api: The name of the API, None for stages shared by all of them
+        """
+        pass
+
+    def increment(self, counter, value=1, api=None):
+        """
+        Adds to a counter
+        :param counter: The name of the counter, like bytes_sent, bytes_received, retries or cache_hits
+        :param value: The amount to add
+        :param api: The name of the API, None for counters shared by all of them
+        """
+        pass
+
+
+# The metrics used when none are given
+NULL_METRICS = NullMetrics()
+
+
+class Timer(object):
+    """
+    Measures the time spent inside a with statement and records it when it ends, failed or not
+    """
+
+    def __init__(self, metrics, stage, api):
+        self.metrics = metrics
+        self.stage = stage
+        self.api = api
+        self.started = None
+
+    def __enter__(self):
+        self.started = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.metrics.observe(self.stage, time.time() - self.started, self.api)
+        return False
+
+
+class Metrics(NullMetrics):
+    """
+    Records the time spent in every stage and the counters of every API, in memory and thread safe.
+    Stage timings are kept as histograms, so they can be exposed in the Prometheus text format, and every
+    observation can also be written as a JSON line to a log
+    """
+    enabled = True
+    PREFIX = 'image_tagging'
+    # Upper bounds in seconds of the histogram buckets, like the default ones of the Prometheus clients
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, log=None, buckets=BUCKETS):
+        """
+        :param log: An optional file like object every observation is written to as a JSON line
+        :param buckets: The upper bounds of the histogram buckets, in seconds
+        """
+        self.log = log
+        self.buckets = tuple(sorted(buckets))
+        # Keyed by tuples of stage and API, values are lists of bucket counts, with the last one for the
+        # observations over every bound, followed by the count and the sum
+        self.timings = dict()
+        self.counters = dict()
+        self.lock = threading.Lock()
+
+    def timer(self, stage, api=None):
+        return Timer(self, stage, api)
+
+    def observe(self, stage, seconds, api=None):
+        key = (stage, api)
+        with self.lock:
+            timing = self.timings.get(key)
+            if timing is None:
+                timing = self.timings[key] = [0] * (len(self.buckets) + 1) + [0, 0.0]
+            timing[bisect.bisect_left(self.buckets, seconds)] += 1
+            timing[-2] += 1
+            timing[-1] += seconds
+        if self.log is not None:
+            self.write_log({'type': 'timer', 'stage': stage, 'api': api, 'seconds': seconds})
+
+    def increment(self, counter, value=1, api=None):
+        key = (counter, api)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+        if self.log is not None:
+            self.write_log({'type': 'counter', 'counter': counter, 'api': api, 'value': value})
+
+    def write_log(self, event):
+        """
+        Writes an event to the log as a JSON line
+        :param event: A dict with the fields of the event
+        """
+        event['time'] = time.time()
+        line = json.dumps(event, sort_keys=True) + '\n'
+        # Lines of different threads must not be mixed
+        with self.lock:
+            self.log.write(line)
+
+    def snapshot(self):
+        """
+        Gets the current values of all the metrics
+        :return: A dict with a list of timers, with their count, total and mean seconds, and a list of counters
+        """
+        with self.lock:
+            timings = sorted(self.timings.items(), key=lambda item: (item[0][0], item[0][1] or ''))
+            counters = sorted(self.counters.items(), key=lambda item: (item[0][0], item[0][1] or ''))
+            timers = [{'stage': stage, 'api': api, 'count': timing[-2], 'seconds': timing[-1],
+                       'mean': timing[-1] / timing[-2] if timing[-2] else 0.0}
+                      for (stage, api), timing in timings]
+            counters = [{'counter': counter, 'api': api, 'value': value} for (counter, api), value in counters]
+        return {'timers': timers, 'counters': counters}
+
+    def to_json(self):
+        """
+        Gets the current values of all the metrics as a JSON string
+        :return: The JSON of snapshot
+        """
+        return json.dumps(self.snapshot(), sort_keys=True)
+
+    def labels(self, **labels):
+        """
+        Formats the labels of a Prometheus sample, leaving out the ones without value
+        :param labels: The labels and their values
+        :return: The labels between braces, or an empty string if there are none
+        """
+        pairs = ['%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                 for name, value in sorted(labels.items()) if value is not None]
+        return '{%s}' % ','.join(pairs) if pairs else ''
+
+    def to_prometheus(self):
+        """
+        Formats all the metrics in the Prometheus text exposition format. Stage timings are a histogram
+        called image_tagging_stage_seconds, every counter is called image_tagging_<counter>_total
+        :return: The metrics as a string
+        """
+        with self.lock:
+            timings = sorted(self.timings.items(), key=lambda item: (item[0][0], item[0][1] or ''))
+            counters = sorted(self.counters.items(), key=lambda item: (item[0][0], item[0][1] or ''))
+        lines = list()
+        if timings:
+            name = '%s_stage_seconds' % self.PREFIX
+            lines.append('# HELP %s Seconds spent in every stage of tagging' % name)
+            lines.append('# TYPE %s histogram' % name)
+            for (stage, api), timing in timings:
+                cumulative = 0
+                for bound, count in zip(self.buckets + ('+Inf',), timing[:-2]):
+                    cumulative += count
+                    lines.append('%s_bucket%s %d' % (name, self.labels(stage=stage, api=api, le=bound), cumulative))
+                lines.append('%s_sum%s %r' % (name, self.labels(stage=stage, api=api), timing[-1]))
+                lines.append('%s_count%s %d' % (name, self.labels(stage=stage, api=api), timing[-2]))
+        for counter in sorted(set(counter for (counter, api), value in counters)):
+            name = '%s_%s_total' % (self.PREFIX, counter)
+            lines.append('# TYPE %s counter' % name)
+            for (other, api), value in counters:
+                if other == counter:
+                    lines.append('%s%s %r' % (name, self.labels(api=api), value))
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port, host=''):
+        """
+        Serves the metrics in the Prometheus text format at /metrics, from a daemon thread
+        :param port: The port to listen on, 0 takes a free one
+        :param host: The interface to listen on, all of them by default
+        :return: The HTTPServer, so the port can be read from server_address and it can be shut down
+        """
+        metrics = self
+
+        class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = metrics.to_prometheus()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = BaseHTTPServer.HTTPServer((host, port), MetricsHandler)
+        thread = threading.Thread(target=server.serve_forever, name='metrics')
+        thread.daemon = True
+        thread.start()
+        return server
@@ -0,0 +1,76 @@
+import time
+import threading
+
+
+class TokenBucket(object):
+    """
+    A thread safe token bucket. Tokens are refilled continuously at the given rate up to the bucket
+    capacity, and callers block until there are enough tokens for them
+    """
+
+    def __init__(self, rate_per_minute, capacity=None):
+        """
+        :param rate_per_minute: Number of tokens added to the bucket every minute
+        :param capacity: Maximum number of tokens the bucket can hold, by default a second worth of tokens
+        so there are no big bursts at the start of a minute
+        """
+        self.rate = rate_per_minute / 60.0
+        self.capacity = float(capacity or max(1.0, self.rate))
+        self.tokens = self.capacity
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def refill(self):
+        """
+        Adds the tokens generated since the last refill. Must be called with the lock held
+        """
+        now = time.time()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, tokens=1):
+        """
+        Takes the given number of tokens, waiting until they are available. Requests bigger than the
+        capacity wait for a full bucket and leave it in debt, so the following ones wait for the difference
+        :param tokens: The number of tokens to take
+        :return: The seconds spent waiting
+        """
+        waited = 0.0
+        with self.lock:
+            needed = min(tokens, self.capacity)
+            self.refill()
+            while self.tokens < needed:
+                delay = (needed - self.tokens) / self.rate
+                time.sleep(delay)
+                waited += delay
+                self.refill()
+            self.tokens -= tokens
+        return waited
+
+
+class RateLimiter(object):
+    """
+    Limits both the number of requests and the number of images sent per minute, as most tagging
+    APIs have quotas for both
+    """
+
+    def __init__(self, requests_per_minute=None, images_per_minute=None):
+        """
+        :param requests_per_minute: Maximum requests per minute, None means no limit
+        :param images_per_minute: Maximum images per minute, None means no limit
+        """
+        self.requests = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.images = TokenBucket(images_per_minute) if images_per_minute else None
+
+    def acquire(self, images=1):
+        """
+        Waits until a request with the given number of images can be sent
+        :param images: The number of images in the request
+        :return: The seconds spent waiting
+        """
+        waited = 0.0
+        if self.requests:
+            waited += self.requests.acquire(1)
+        if self.images:
+            waited += self.images.acquire(images)
+        return waited
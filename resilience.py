@@ -0,0 +1,305 @@
+import time
+import Queue
+import random
+import socket
+import threading
+from email.utils import parsedate_tz, mktime_tz
+from requests.exceptions import ConnectionError, Timeout
+from httplib2 import HttpLib2Error
+from metrics import NULL_METRICS
+
+
+class TransientError(Exception):
+    """
+    A failure that is likely to go away if the call is made again, like a throttled or an unavailable service
+    """
+
+    def __init__(self, message, retry_after=None):
+        """
+        :param message: The description of the failure
+        :param retry_after: The seconds the service asked to wait before trying again, if any
+        """
+        super(TransientError, self).__init__(message)
+        self.retry_after = retry_after
+
+
+class CircuitOpenError(Exception):
+    """
+    Raised instead of calling a service that failed too many times in a row, until it is given another chance
+    """
+    pass
+
+
+class CircuitBreaker(object):
+    """
+    Stops calling a service after a number of consecutive failures, so callers fail fast instead of waiting
+    for timeouts while it is down. Once the reset timeout passes a single trial call is let through, closing
+    the circuit again if it succeeds
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, failure_threshold=5, reset_timeout=60.0):
+        """
+        :param failure_threshold: The consecutive failures that open the circuit
+        :param reset_timeout: The seconds the circuit stays open before a trial call is allowed
+        """
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened = None
+        self.state = self.CLOSED
+        self.lock = threading.Lock()
+
+    def allow(self):
+        """
+        Checks if a call can be made now
+        :return: True if the circuit is closed, or if it is the trial call after the reset timeout
+        """
+        with self.lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.time() - self.opened >= self.reset_timeout:
+                # Only the first caller after the timeout gets to try
+                self.state = self.HALF_OPEN
+                return True
+            return False
+
+    def record_success(self):
+        """
+        Closes the circuit after a successful call
+        """
+        with self.lock:
+            self.failures = 0
+            self.state = self.CLOSED
+
+    def record_failure(self):
+        """
+        Counts a failed call, opening the circuit when there are too many in a row or when the trial call failed
+        """
+        with self.lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                self.state = self.OPEN
+                self.opened = time.time()
+
+
+class CallGuard(object):
+    """
+    Wraps the calls to a service with retries, a circuit breaker and optional hedged requests:
+    - Transient failures are retried with exponential backoff and full jitter, waiting what the service asks
+    for in Retry-After headers instead when there is one, up to the maximum backoff
+    - Every failed attempt counts for the circuit breaker, so a service that is down stops being called at all
+    - If hedge_after is set, a call that did not finish after that many seconds is sent a second time and the
+    first answer wins. Only for idempotent calls whose arguments can be used by two threads at the same time
+    Every attempt is timed as the request stage of the service, and retries are counted
+    """
+    # HTTP status codes worth another try, anything else is a problem with the request itself
+    TRANSIENT_STATUSES = (408, 429, 500, 502, 503, 504)
+
+    def __init__(self, name, retries=3, base_delay=1.0, max_delay=30.0, failure_threshold=5, reset_timeout=60.0,
+                 hedge_after=None, transient_errors=(), permanent_errors=(), metrics=NULL_METRICS):
+        """
+        :param name: The name of the service, used in messages
+        :param retries: The maximum number of retries after the first attempt
+        :param base_delay: The seconds of the first backoff, doubled on every retry
+        :param max_delay: The maximum seconds of a backoff
+        :param failure_threshold: The consecutive failures that open the circuit
+        :param reset_timeout: The seconds the circuit stays open before a trial call is allowed
+        :param hedge_after: The seconds after which a slow call is sent again, None disables hedging
+        :param transient_errors: A tuple with the exception types of the service that are worth retrying
+        :param permanent_errors: A tuple with exception types never retried, even if they are subclasses
+        of transient ones
+        :param metrics: The Metrics that record the requests and retries, nothing is recorded by default
+        """
+        self.name = name
+        self.retries = retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.hedge_after = hedge_after
+        self.transient_errors = (TransientError, ConnectionError, Timeout, HttpLib2Error, socket.error) + \
+            tuple(transient_errors)
+        self.permanent_errors = tuple(permanent_errors)
+        # Gets the status code of errors of clients that only tell it in their message
+        self.status_parser = None
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+        self.metrics = metrics
+
+    def add_errors(self, transient_errors=(), permanent_errors=(), status_parser=None):
+        """
+        Adds exception types of the service once they are known, like those of a client imported when it is configured
+        :param transient_errors: A tuple with exception types worth retrying
+        :param permanent_errors: A tuple with exception types never retried
+        :param status_parser: An optional function that gets the HTTP status code of an error of the client, or
+        None if it does not have one, for clients whose errors have no response attached
+        """
+        self.transient_errors += tuple(error for error in transient_errors if error not in self.transient_errors)
+        self.permanent_errors += tuple(error for error in permanent_errors if error not in self.permanent_errors)
+        if status_parser is not None:
+            self.status_parser = status_parser
+
+    def call(self, function, args=(), kwargs=None, hedge=True):
+        """
+        Calls a function, retrying it while it fails with transient errors
+        :param function: The function that calls the service. It is called again on every attempt, so it must
+        rewind any file it sends
+        :param args: The positional arguments of the function
+        :param kwargs: The keyword arguments of the function
+        :param hedge: False for calls that cannot be sent twice at the same time, like the ones sending open files
+        :return: What the function returns
+        :raise CircuitOpenError: If the circuit is open
+        :raise Exception: The last error of the function if it is permanent or there are no retries left
+        """
+        kwargs = kwargs or {}
+        for attempt in range(self.retries + 1):
+            if not self.breaker.allow():
+                raise CircuitOpenError('{0} failed too many times in a row, not calling it for now'.format(self.name))
+            try:
+                with self.metrics.timer('request', self.name):
+                    if self.hedge_after is None or not hedge:
+                        result = function(*args, **kwargs)
+                    else:
+                        result = self.call_hedged(function, args, kwargs)
+            except Exception as ex:
+                if not self.is_transient(ex):
+                    # The service answered, it is the request that is wrong
+                    self.breaker.record_success()
+                    raise
+                self.breaker.record_failure()
+                self.metrics.increment('errors', api=self.name)
+                if attempt == self.retries:
+                    raise
+                self.metrics.increment('retries', api=self.name)
+                delay = self.backoff(attempt, ex)
+                print('{0} failed (attempt {1} of {2}), retrying in {3:.1f} seconds. More info {4}'.format(
+                    self.name, attempt + 1, self.retries + 1, delay, str(ex)))
+                time.sleep(delay)
+            else:
+                self.breaker.record_success()
+                return result
+
+    def call_hedged(self, function, args, kwargs):
+        """
+        Calls a function and, if it did not finish after hedge_after seconds, calls it again in parallel
+        :param function: The function that calls the service
+        :param args: The positional arguments of the function
+        :param kwargs: The keyword arguments of the function
+        :return: What the first successful call returns
+        :raise Exception: The error of the last call to finish if both failed
+        """
+        answers = Queue.Queue()
+
+        def attempt():
+            try:
+                answers.put((True, function(*args, **kwargs)))
+            except Exception as ex:
+                answers.put((False, ex))
+
+        calls = 1
+        self.start(attempt)
+        try:
+            succeeded, answer = answers.get(timeout=self.hedge_after)
+        except Queue.Empty:
+            calls = 2
+            self.start(attempt)
+            succeeded, answer = answers.get()
+        if not succeeded and calls == 2:
+            # The hedge may still succeed
+            succeeded, answer = answers.get()
+        if not succeeded:
+            raise answer
+        return answer
+
+    def start(self, target):
+        """
+        Runs a function in a daemon thread, so a hedged call that loses the race does not keep the process alive
+        :param target: The function to run
+        """
+        thread = threading.Thread(target=target, name='hedge-%s' % self.name)
+        thread.daemon = True
+        thread.start()
+
+    def is_transient(self, exception):
+        """
+        Decides if an error is worth retrying. HTTP errors are decided by their status code
+        :param exception: The error raised by the call
+        :return: True if the call should be retried
+        """
+        if isinstance(exception, self.permanent_errors):
+            return False
+        status = self.status_code(exception)
+        if status is not None:
+            return status in self.TRANSIENT_STATUSES
+        return isinstance(exception, self.transient_errors)
+
+    def status_code(self, exception):
+        """
+        Gets the HTTP status code of an error, if it has one
+        :param exception: An HttpError of the Google client, an HTTPError of requests or an error the status
+        parser knows
+        :return: The status code as an int or None
+        """
+        response = self.response_of(exception)
+        status = getattr(response, 'status', None) or getattr(response, 'status_code', None)
+        if not status and self.status_parser is not None:
+            status = self.status_parser(exception)
+        return int(status) if status else None
+
+    def response_of(self, exception):
+        """
+        Gets the HTTP response attached to an error. Responses are not compared to None with or, a requests
+        response with an error status is false
+        :param exception: The error raised by the call
+        :return: The response or None
+        """
+        response = getattr(exception, 'resp', None)
+        if response is None:
+            response = getattr(exception, 'response', None)
+        return response
+
+    def retry_after(self, exception):
+        """
+        Gets the seconds a service asked to wait before trying again
+        :param exception: The error raised by the call
+        :return: The seconds to wait or None if the service did not say
+        """
+        if getattr(exception, 'retry_after', None) is not None:
+            return float(exception.retry_after)
+        # Clarifai tells how long to wait when it throttles
+        if getattr(exception, 'wait_seconds', None) is not None:
+            return float(exception.wait_seconds)
+        response = self.response_of(exception)
+        headers = getattr(response, 'headers', response)
+        if not hasattr(headers, 'get'):
+            return None
+        return self.parse_retry_after(headers.get('retry-after') or headers.get('Retry-After'))
+
+    def parse_retry_after(self, value):
+        """
+        Parses a Retry-After header, that can be a number of seconds or an HTTP date
+        :param value: The value of the header
+        :return: The seconds to wait or None if there is no valid value
+        """
+        if not value:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            date = parsedate_tz(value)
+            if date is None:
+                return None
+            return max(0.0, mktime_tz(date) - time.time())
+
+    def backoff(self, attempt, exception=None):
+        """
+        Calculates the seconds to wait before a retry
+        :param attempt: The number of the attempt that failed, starting at 0
+        :param exception: The error of the attempt
+        :return: The Retry-After of the error if there is one, otherwise a random delay up to the exponential backoff.
+        Never more than max_delay, a service cannot keep a worker waiting for as long as it likes
+        """
+        retry_after = self.retry_after(exception) if exception is not None else None
+        if retry_after is not None:
+            return min(retry_after, self.max_delay)
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
@@ -0,0 +1,192 @@
+import json
+import time
+import hashlib
+import sqlite3
+import threading
+
+
+def content_hash(file_path, chunk_size=65536):
+    """
+    Calculates the SHA1 of the contents of a file, reading it in chunks so big images are not fully loaded
+    :param file_path: The full path of the file
+    :param chunk_size: The number of bytes read on each step
+    :return: The hexadecimal digest of the file contents
+    """
+    digest = hashlib.sha1()
+    with open(file_path, 'rb') as content:
+        chunk = content.read(chunk_size)
+        while chunk:
+            digest.update(chunk)
+            chunk = content.read(chunk_size)
+    return digest.hexdigest()
+
+
+class ResultCache(object):
+    """
+    A persistent cache of tagging results stored in a SQLite database. Entries are keyed by the image
+    content hash, the API that produced them and the parameters used in the request, so the same bytes
+    sent with the same parameters never hit the network twice.
+    Entries expire after a time to live and the least recently used ones are evicted once the cache
+    holds more entries or bytes than allowed
+    """
+    DEFAULT_DB_PATH = 'tagging_cache.db'
+    DEFAULT_TTL = 7 * 24 * 60 * 60
+    DEFAULT_MAX_ENTRIES = 100000
+    # Number of the least recently used entries read on each step of an eviction
+    EVICTION_BATCH_SIZE = 100
+
+    def __init__(self, db_path=DEFAULT_DB_PATH, ttl=DEFAULT_TTL, max_entries=DEFAULT_MAX_ENTRIES, max_bytes=None):
+        """
+        :param db_path: The file path of the SQLite database, created if it does not exist
+        :param ttl: Seconds an entry is valid after being stored, None means entries never expire
+        :param max_entries: Maximum number of entries kept, None means no limit
+        :param max_bytes: Maximum number of bytes of stored values, None means no limit
+        """
+        self.db_path = db_path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        # The same cache is shared by APIs running in different threads
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(db_path, check_same_thread=False)
+        with self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS results ('
+                                    'key TEXT PRIMARY KEY, '
+                                    'value TEXT NOT NULL, '
+                                    'size INTEGER NOT NULL, '
+                                    'created REAL NOT NULL, '
+                                    'accessed REAL NOT NULL)')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS results_accessed ON results (accessed)')
+            # The totals live in the database, kept by triggers in the same transaction as every change, so
+            # they stay right when several caches, even in other processes, share the file
+            self.connection.execute('CREATE TABLE IF NOT EXISTS totals ('
+                                    'id INTEGER PRIMARY KEY CHECK (id = 0), '
+                                    'entries INTEGER NOT NULL, '
+                                    'size INTEGER NOT NULL)')
+            self.connection.execute('INSERT OR IGNORE INTO totals (id, entries, size) '
+                                    'SELECT 0, COUNT(*), COALESCE(SUM(size), 0) FROM results')
+            self.connection.execute('CREATE TRIGGER IF NOT EXISTS results_inserted AFTER INSERT ON results BEGIN '
+                                    'UPDATE totals SET entries = entries + 1, size = size + NEW.size; END')
+            self.connection.execute('CREATE TRIGGER IF NOT EXISTS results_deleted AFTER DELETE ON results BEGIN '
+                                    'UPDATE totals SET entries = entries - 1, size = size - OLD.size; END')
+            self.connection.execute('CREATE TRIGGER IF NOT EXISTS results_resized AFTER UPDATE OF size ON results '
+                                    'BEGIN UPDATE totals SET size = size - OLD.size + NEW.size; END')
+
+    def make_key(self, image_hash, api, params=None):
+        """
+        Builds the key of an entry
+        :param image_hash: The content hash of the image
+        :param api: The name of the API that tagged the image
+        :param params: A dict with the request parameters that change the API response
+        :return: The key as a string
+        """
+        params = json.dumps(params or {}, sort_keys=True)
+        return hashlib.sha1('{0}:{1}:{2}'.format(image_hash, api, params).encode('utf-8')).hexdigest()
+
+    def get(self, image_hash, api, params=None, ttl=None):
+        """
+        Gets a cached result
+        :param image_hash: The content hash of the image
+        :param api: The name of the API that tagged the image
+        :param params: A dict with the request parameters used
+        :param ttl: Overrides the time to live of the cache for this lookup
+        :return: The cached value or None if there is no valid entry
+        """
+        key = self.make_key(image_hash, api, params)
+        ttl = self.ttl if ttl is None else ttl
+        now = time.time()
+        with self.lock:
+            row = self.connection.execute('SELECT value, created FROM results WHERE key = ?', (key,)).fetchone()
+            if row and ttl is not None and now - row[1] > ttl:
+                with self.connection:
+                    self.connection.execute('DELETE FROM results WHERE key = ?', (key,))
+                row = None
+            if not row:
+                self.misses += 1
+                return None
+            with self.connection:
+                self.connection.execute('UPDATE results SET accessed = ? WHERE key = ?', (now, key))
+            self.hits += 1
+        return json.loads(row[0])
+
+    def set(self, image_hash, api, value, params=None):
+        """
+        Stores a result, evicting the least recently used entries if the cache grows over its limits
+        :param image_hash: The content hash of the image
+        :param api: The name of the API that tagged the image
+        :param value: Any JSON serializable value
+        :param params: A dict with the request parameters used
+        """
+        key = self.make_key(image_hash, api, params)
+        value = json.dumps(value)
+        now = time.time()
+        with self.lock:
+            with self.connection:
+                # Not replaced, the delete of a replace does not fire the triggers that keep the totals
+                updated = self.connection.execute('UPDATE results SET value = ?, size = ?, created = ?, accessed = ? '
+                                                  'WHERE key = ?', (value, len(value), now, now, key))
+                if not updated.rowcount:
+                    self.connection.execute('INSERT INTO results (key, value, size, created, accessed) '
+                                            'VALUES (?, ?, ?, ?, ?)', (key, value, len(value), now, now))
+                self.evict()
+
+    def totals(self):
+        """
+        Reads the totals of the cache, as stored by every cache using the same database
+        :return: A tuple with the number of entries and the number of bytes of stored values
+        """
+        return self.connection.execute('SELECT entries, size FROM totals').fetchone()
+
+    def exceeds_limits(self, entries, size):
+        """
+        Checks if the cache holds more entries or bytes than allowed
+        :param entries: The number of entries
+        :param size: The number of bytes of stored values
+        :return: True if any of the limits is exceeded
+        """
+        return ((self.max_entries is not None and entries > self.max_entries) or
+                (self.max_bytes is not None and size > self.max_bytes))
+
+    def evict(self):
+        """
+        Removes the least recently used entries until the cache is within its limits, reading them in
+        batches so only the entries to be removed are loaded. Must be called with the lock held, in the
+        transaction that stored the new entry, so the totals read are the ones of the database
+        """
+        entries, size = self.totals()
+        while self.exceeds_limits(entries, size):
+            # At least all the entries over the limit are read at once
+            batch_size = max(self.EVICTION_BATCH_SIZE, entries - (self.max_entries or entries))
+            rows = self.connection.execute('SELECT key, size FROM results ORDER BY accessed LIMIT ?',
+                                           (batch_size,)).fetchall()
+            if not rows:
+                break
+            evicted = list()
+            for key, entry_size in rows:
+                if not self.exceeds_limits(entries, size):
+                    break
+                evicted.append((key,))
+                entries -= 1
+                size -= entry_size
+            self.connection.executemany('DELETE FROM results WHERE key = ?', evicted)
+            entries, size = self.totals()
+
+    def clear(self):
+        """
+        Removes all the entries
+        """
+        with self.lock:
+            with self.connection:
+                self.connection.execute('DELETE FROM results')
+
+    def close(self):
+        """
+        Closes the underlying database connection
+        """
+        self.connection.close()
+
+    def __len__(self):
+        with self.lock:
+            return self.totals()[0]
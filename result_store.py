@@ -0,0 +1,286 @@
+import os
+import numpy
+
+
+class TagStore(object):
+    """
+    Stores tagging results in long format, one row per image, API and tag. Images, APIs and tags are
+    kept as integer codes into lists of unique names and scores as float32, so millions of images take
+    a fraction of the memory of DataFrames with lists of tuples in their cells, and can be filtered and
+    aggregated with numpy
+    """
+    # Rows the arrays start with, they double every time they are full
+    INITIAL_CAPACITY = 1024
+    PARQUET_EXTENSIONS = ('.parquet', '.pq')
+
+    def __init__(self, capacity=INITIAL_CAPACITY):
+        """
+        :param capacity: The number of rows reserved up front
+        """
+        self.images = list()
+        self.apis = list()
+        self.tags = list()
+        self.image_codes = dict()
+        self.api_codes = dict()
+        self.tag_codes = dict()
+        self.size = 0
+        capacity = max(1, capacity)
+        self.image_column = numpy.empty(capacity, dtype=numpy.int32)
+        self.api_column = numpy.empty(capacity, dtype=numpy.int8)
+        self.tag_column = numpy.empty(capacity, dtype=numpy.int32)
+        self.score_column = numpy.empty(capacity, dtype=numpy.float32)
+
+    def add(self, image_name, api, tags):
+        """
+        Adds the tags found by an API for an image
+        :param image_name: The name of the image
+        :param api: The name of the API that tagged the image
+        :param tags: A list of tuples with the tag and its score
+        """
+        if not tags:
+            return
+        self.reserve(self.size + len(tags))
+        image_code = self.encode(self.images, self.image_codes, image_name)
+        api_code = self.encode(self.apis, self.api_codes, api)
+        end = self.size + len(tags)
+        self.image_column[self.size:end] = image_code
+        self.api_column[self.size:end] = api_code
+        self.tag_column[self.size:end] = [self.encode(self.tags, self.tag_codes, tag) for tag, score in tags]
+        self.score_column[self.size:end] = [score for tag, score in tags]
+        self.size = end
+
+    def add_records(self, records):
+        """
+        Adds the records yielded by the iter_* methods of ImageTagger, as they come
+        :param records: An iterable of tuples with the image name, the API name and the list of tags
+        :return: The store itself
+        """
+        for image_name, api, tags in records:
+            self.add(image_name, api, tags)
+        return self
+
+    def add_data_frame(self, data_frame):
+        """
+        Adds the results of a DataFrame returned by use_all or a process_images_* method, with the
+        API names as columns and lists of tuples with the tags as cells
+        :param data_frame: The DataFrame to add
+        :return: The store itself
+        """
+        for api in data_frame.columns:
+            for image_name, tags in data_frame[api].iteritems():
+                # Images an API could not tag are NaN
+                if isinstance(tags, list):
+                    self.add(image_name, api, tags)
+        return self
+
+    def encode(self, names, codes, name):
+        """
+        Gets the code of a name, adding it if it is new
+        :param names: The list of names by code
+        :param codes: The dict with the code of every name
+        :param name: The name to encode
+        :return: The integer code
+        """
+        name = self.to_text(name)
+        code = codes.get(name)
+        if code is None:
+            code = len(names)
+            names.append(name)
+            codes[name] = code
+        return code
+
+    def to_text(self, name):
+        """
+        Makes sure a name is unicode, so it can be saved in a numpy array of strings
+        :param name: The name as unicode or UTF-8 bytes
+        :return: The name as unicode
+        """
+        if isinstance(name, bytes):
+            return name.decode('utf-8')
+        return name
+
+    def reserve(self, rows):
+        """
+        Grows the arrays so they can hold the given number of rows, doubling their size to keep appends cheap
+        :param rows: The number of rows needed
+        """
+        capacity = len(self.score_column)
+        if rows <= capacity:
+            return
+        while capacity < rows:
+            capacity *= 2
+        for name in ('image_column', 'api_column', 'tag_column', 'score_column'):
+            column = getattr(self, name)
+            grown = numpy.empty(capacity, dtype=column.dtype)
+            grown[:self.size] = column[:self.size]
+            setattr(self, name, grown)
+
+    def columns(self):
+        """
+        Returns the filled part of the arrays, without copying them
+        :return: A tuple with the image, API and tag codes and the scores
+        """
+        return (self.image_column[:self.size], self.api_column[:self.size],
+                self.tag_column[:self.size], self.score_column[:self.size])
+
+    def tags_for(self, image_name, api):
+        """
+        Gets the tags found by an API for an image
+        :param image_name: The name of the image
+        :param api: The name of the API
+        :return: A list of tuples with the tag and its score, empty if there are none
+        """
+        image_code = self.image_codes.get(self.to_text(image_name))
+        api_code = self.api_codes.get(self.to_text(api))
+        if image_code is None or api_code is None:
+            return []
+        image_column, api_column, tag_column, score_column = self.columns()
+        rows = numpy.flatnonzero((image_column == image_code) & (api_column == api_code))
+        return [(self.tags[tag_column[row]], float(score_column[row])) for row in rows]
+
+    def to_data_frame(self):
+        """
+        Builds a long format DataFrame with categorical image, API and tag columns and a float32 score column
+        :return: The DataFrame
+        """
+        import pandas
+        image_column, api_column, tag_column, score_column = self.columns()
+        return pandas.DataFrame({
+            'image': pandas.Categorical.from_codes(image_column, self.images),
+            'api': pandas.Categorical.from_codes(api_column, self.apis),
+            'tag': pandas.Categorical.from_codes(tag_column, self.tags),
+            'score': score_column
+        }, columns=['image', 'api', 'tag', 'score'])
+
+    def save(self, file_path):
+        """
+        Saves the store, as Parquet if the file extension is .parquet or .pq and as a compressed .npz otherwise
+        :param file_path: The path of the file to write
+        """
+        if os.path.splitext(file_path)[1].lower() in self.PARQUET_EXTENSIONS:
+            self.save_parquet(file_path)
+        else:
+            self.save_npz(file_path)
+
+    @classmethod
+    def load(cls, file_path):
+        """
+        Loads a store saved with save, choosing the format by the file extension
+        :param file_path: The path of the file to read
+        :return: The loaded store
+        """
+        if os.path.splitext(file_path)[1].lower() in cls.PARQUET_EXTENSIONS:
+            return cls.load_parquet(file_path)
+        return cls.load_npz(file_path)
+
+    def save_npz(self, file_path):
+        """
+        Saves the codes, the scores and the names in a compressed .npz file, without pickling anything
+        :param file_path: The path of the file to write. numpy adds the .npz extension if it is missing
+        """
+        image_column, api_column, tag_column, score_column = self.columns()
+        numpy.savez_compressed(file_path,
+                               image_codes=image_column, api_codes=api_column,
+                               tag_codes=tag_column, scores=score_column,
+                               images=numpy.array(self.images, dtype=numpy.unicode_),
+                               apis=numpy.array(self.apis, dtype=numpy.unicode_),
+                               tags=numpy.array(self.tags, dtype=numpy.unicode_))
+
+    @classmethod
+    def load_npz(cls, file_path):
+        """
+        Loads a store saved with save_npz
+        :param file_path: The path of the file to read
+        :return: The loaded store
+        """
+        with numpy.load(file_path) as arrays:
+            return cls.from_columns(arrays['images'].tolist(), arrays['apis'].tolist(), arrays['tags'].tolist(),
+                                    arrays['image_codes'], arrays['api_codes'], arrays['tag_codes'],
+                                    arrays['scores'])
+
+    def save_parquet(self, file_path):
+        """
+        Saves the store as a Parquet file with image, API, tag and score columns. Needs pyarrow
+        :param file_path: The path of the file to write
+        """
+        # Only needed by Parquet users, so it is not a requirement
+        import pyarrow
+        import pyarrow.parquet
+        image_column, api_column, tag_column, score_column = self.columns()
+        # Parquet dictionary encodes repeated strings, so the file stays as compact as the codes
+        table = pyarrow.Table.from_arrays([
+            pyarrow.array(numpy.array(self.images, dtype=object)[image_column]),
+            pyarrow.array(numpy.array(self.apis, dtype=object)[api_column]),
+            pyarrow.array(numpy.array(self.tags, dtype=object)[tag_column]),
+            pyarrow.array(score_column)
+        ], ['image', 'api', 'tag', 'score'])
+        pyarrow.parquet.write_table(table, file_path)
+
+    @classmethod
+    def load_parquet(cls, file_path):
+        """
+        Loads a Parquet file with image, API, tag and score columns, as written by save_parquet. Needs pyarrow
+        :param file_path: The path of the file to read
+        :return: The loaded store
+        """
+        import pandas
+        import pyarrow.parquet
+        data_frame = pyarrow.parquet.read_table(file_path).to_pandas()
+        store = cls(capacity=len(data_frame))
+        codes = list()
+        for column, names, codes_by_name in (('image', store.images, store.image_codes),
+                                             ('api', store.apis, store.api_codes),
+                                             ('tag', store.tags, store.tag_codes)):
+            categorical = pandas.Categorical(data_frame[column])
+            for name in categorical.categories:
+                store.encode(names, codes_by_name, name)
+            codes.append(categorical.codes)
+        store.fill(codes[0], codes[1], codes[2], data_frame['score'].values)
+        return store
+
+    @classmethod
+    def from_columns(cls, images, apis, tags, image_codes, api_codes, tag_codes, scores):
+        """
+        Builds a store from the names and the code and score arrays
+        :param images: The list of image names by code
+        :param apis: The list of API names by code
+        :param tags: The list of tags by code
+        :param image_codes: An array with the image code of every row
+        :param api_codes: An array with the API code of every row
+        :param tag_codes: An array with the tag code of every row
+        :param scores: An array with the score of every row
+        :return: The new store
+        """
+        store = cls(capacity=len(scores))
+        for names, codes, values in ((store.images, store.image_codes, images),
+                                     (store.apis, store.api_codes, apis),
+                                     (store.tags, store.tag_codes, tags)):
+            for name in values:
+                store.encode(names, codes, name)
+        store.fill(image_codes, api_codes, tag_codes, scores)
+        return store
+
+    def fill(self, image_codes, api_codes, tag_codes, scores):
+        """
+        Replaces the rows of the store with the given arrays, whose codes must match the names already added
+        :param image_codes: An array with the image code of every row
+        :param api_codes: An array with the API code of every row
+        :param tag_codes: An array with the tag code of every row
+        :param scores: An array with the score of every row
+        """
+        self.reserve(len(scores))
+        self.size = len(scores)
+        self.image_column[:self.size] = image_codes
+        self.api_column[:self.size] = api_codes
+        self.tag_column[:self.size] = tag_codes
+        self.score_column[:self.size] = scores
+
+    @property
+    def nbytes(self):
+        """
+        The bytes used by the filled part of the arrays, names not included
+        """
+        return sum(column.nbytes for column in self.columns())
+
+    def __len__(self):
+        return self.size
@@ -0,0 +1,68 @@
+import os
+from collections import namedtuple
+try:
+    # Python 3.5 and newer
+    from os import scandir
+except ImportError:
+    from scandir import scandir
+
+
+# An image found by the scanner. The name is the path relative to the scanned folder, with forward
+# slashes, so images with the same file name in different subfolders are told apart
+CatalogImage = namedtuple('CatalogImage', ['path', 'name', 'size', 'type'])
+
+
+class ImageScanner(object):
+    """
+    Finds the images of a folder and its subfolders in a single pass. It uses scandir, which gets the
+    file type of every entry from the directory listing itself, so the only stat call per image is the
+    one that gets its size. The catalog is built lazily, so huge trees can be processed as they are read
+    """
+    IMAGE_FILE_TYPES = ['png', 'jpg', 'jpeg', 'gif']
+
+    def __init__(self, file_types=IMAGE_FILE_TYPES, recursive=True):
+        """
+        :param file_types: The file extensions considered images, in lower case
+        :param recursive: If true subfolders are scanned too
+        """
+        self.file_types = set(file_types)
+        self.recursive = recursive
+
+    def iter_images(self, folder):
+        """
+        Scans a folder, yielding its images as they are found. Every folder is listed in name order, so
+        the catalog is the same from one run to the next. A folder that does not exist has no images
+        :param folder: The full path of the folder
+        :return: A generator of CatalogImage
+        """
+        if not os.path.isdir(folder):
+            return
+        # Folders still to be listed, with the prefix of the names of their images
+        pending = [(folder, '')]
+        while pending:
+            folder_path, prefix = pending.pop()
+            try:
+                entries = sorted(scandir(folder_path), key=lambda entry: entry.name)
+            except OSError as ex:
+                print('Could not scan {0}, skipping it. More info {1}'.format(folder_path, str(ex)))
+                continue
+            subfolders = list()
+            for entry in entries:
+                # Linked folders are not followed, they could lead back to a folder already scanned
+                if entry.is_dir(follow_symlinks=False):
+                    if self.recursive:
+                        subfolders.append((entry.path, prefix + entry.name + '/'))
+                    continue
+                file_type = entry.name.split('.')[-1].lower()
+                if file_type in self.file_types and entry.is_file():
+                    yield CatalogImage(entry.path, prefix + entry.name, entry.stat().st_size, file_type)
+            # Depth first, in name order
+            pending.extend(reversed(subfolders))
+
+    def scan(self, folder):
+        """
+        Scans a folder into a list, for catalogs that are consumed more than once
+        :param folder: The full path of the folder
+        :return: A list of CatalogImage
+        """
+        return list(self.iter_images(folder))
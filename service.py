@@ -0,0 +1,348 @@
+import os
+import sys
+import json
+import time
+import uuid
+import Queue
+import shutil
+import argparse
+import tempfile
+import threading
+import urlparse
+import SocketServer
+import BaseHTTPServer
+from multiprocessing import TimeoutError
+from multiprocessing.pool import ThreadPool
+
+from image_tagging import ImageTagger
+from imagga import ImaggaHelper
+from result_cache import ResultCache
+from scanner import CatalogImage
+from metrics import Metrics, NULL_METRICS
+from async_results import GatheredResult
+
+
+class MicroBatcher(object):
+    """
+    Groups items submitted one by one into batches. A batch is sent as soon as it is full, or when its first
+    item has waited max_wait seconds, so single requests are not delayed for longer than that. While batches
+    are being processed by the pool, the next one is already being filled
+    """
+
+    def __init__(self, name, process, max_batch_size, max_wait, concurrency=1, metrics=NULL_METRICS):
+        """
+        :param name: The name of the batcher, usually the API, used for the thread and the metrics
+        :param process: A function called with a list of items that returns a list with a value per item
+        :param max_batch_size: The maximum number of items of a batch
+        :param max_wait: The maximum seconds an item waits for the batch to fill
+        :param concurrency: The number of batches processed at the same time
+        :param metrics: The Metrics that count the batches and their items
+        """
+        self.name = name
+        self.process = process
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.metrics = metrics
+        self.queue = Queue.Queue()
+        self.pool = ThreadPool(processes=concurrency)
+        self.stopped = object()
+        self.thread = threading.Thread(target=self.collect, name='batcher-%s' % name)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, item, callback):
+        """
+        Adds an item to the next batch
+        :param item: The item
+        :param callback: A function called with a tuple with the name of the batcher, True and the value of
+        the item, or the name, False and the error of its batch, like the answers of GatheredResult.run
+        """
+        self.queue.put((item, callback))
+
+    def collect(self):
+        """
+        Fills batches from the queue and hands them to the pool, until the batcher is closed
+        """
+        running = True
+        while running:
+            entry = self.queue.get()
+            if entry is self.stopped:
+                break
+            batch = [entry]
+            deadline = time.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    entry = self.queue.get(timeout=remaining)
+                except Queue.Empty:
+                    break
+                if entry is self.stopped:
+                    # Send what was already submitted before stopping
+                    running = False
+                    break
+                batch.append(entry)
+            self.pool.apply_async(self.run_batch, (batch,))
+
+    def run_batch(self, batch):
+        """
+        Processes a batch and gives every item its value
+        :param batch: A list of tuples with the item and its callback
+        """
+        self.metrics.increment('batches', api=self.name)
+        self.metrics.increment('batched_images', len(batch), api=self.name)
+        try:
+            values = self.process([item for item, callback in batch])
+        except Exception as ex:
+            for item, callback in batch:
+                callback((self.name, False, ex))
+            return
+        for (item, callback), value in zip(batch, values):
+            callback((self.name, True, value))
+
+    def close(self):
+        """
+        Sends the items already submitted and waits for their batches to finish
+        """
+        self.queue.put(self.stopped)
+        self.thread.join()
+        self.pool.close()
+        self.pool.join()
+
+
+class TaggingService(object):
+    """
+    Tags single images with preconfigured clients that are kept for the lifetime of the service. Images of
+    concurrent requests are grouped in a micro-batch per API, so many small requests become a few batched
+    calls: a zip for Visual Recognition, a list for Clarifai tag_images and several entries in one Google
+    annotate request. Imagga has no batch call, its batches are tagged by its pool of workers
+    """
+    # Seconds an image waits for its batch to fill, and seconds a request waits for all its tags
+    MAX_WAIT = 0.05
+    REQUEST_TIMEOUT = 60
+    MAX_IMAGE_BYTES = 20 * 1024 * 1024
+    # Google batches are sent one after another by the tagger, the service can have several in flight
+    GOOGLE_VISION_CONCURRENCY = 4
+    CONTENT_TYPES = {'image/jpeg': 'jpg', 'image/jpg': 'jpg', 'image/png': 'png', 'image/gif': 'gif'}
+
+    def __init__(self, tagger, apis=None, max_wait=MAX_WAIT, batch_sizes=None, metrics=NULL_METRICS):
+        """
+        :param tagger: A configured ImageTagger, with an ImaggaHelper if Imagga is used
+        :param apis: An optional list with the names of the APIs to use, all the configured ones by default
+        :param max_wait: The maximum seconds an image waits for its batch to fill
+        :param batch_sizes: A dict with the API name as key and the maximum images of a batch as value, merged
+        with the limits of every API
+        :param metrics: The Metrics that count the batches, served at /metrics if enabled
+        """
+        self.tagger = tagger
+        self.metrics = metrics
+        iterators = tagger.api_iterators()
+        self.apis = [api for api in (apis or tagger.apis) if api in iterators]
+        # One batch of the service is one request of the API, and there are as many in flight as the tagger sends
+        limits = {'VisualRecognition': (tagger.VISUAL_RECOGNITION_ZIP_IMAGES,
+                                        tagger.VISUAL_RECOGNITION_CONCURRENCY),
+                  'Clarifai': (tagger.CLARIFAI_BATCH_SIZE, tagger.CLARIFAI_CONCURRENCY),
+                  'GoogleVision': (tagger.GOOGLE_VISION_BATCH_IMAGES, self.GOOGLE_VISION_CONCURRENCY)}
+        if 'Imagga' in iterators:
+            limits['Imagga'] = (tagger.imagga_helper.concurrency, 1)
+        batch_sizes = batch_sizes or dict()
+        self.batchers = dict()
+        for api in self.apis:
+            batch_size, concurrency = limits[api]
+            self.batchers[api] = MicroBatcher(api, self.make_process(api, iterators[api]),
+                                              batch_sizes.get(api, batch_size), max_wait, concurrency, metrics)
+        # Images are written here while they are tagged
+        self.folder = tempfile.mkdtemp(prefix='tagging-service-')
+
+    def make_process(self, api, iterate):
+        """
+        Creates the function that tags a batch with an API
+        :param api: The name of the API
+        :param iterate: The method of the tagger that tags a catalog image by image
+        :return: A function called with a list of CatalogImage that returns a list with the tags of every image
+        """
+        def process(images):
+            tags = dict((image.name, []) for image in images)
+            for image_name, api_name, image_tags in iterate(images):
+                tags[image_name] = image_tags
+            return [tags[image.name] for image in images]
+        return process
+
+    def tag(self, image_data, file_type, apis=None, timeout=REQUEST_TIMEOUT):
+        """
+        Tags an image with several APIs, adding it to the next batch of every one of them
+        :param image_data: The content of the image
+        :param file_type: The file extension of the image, like jpg
+        :param apis: An optional list with the names of the APIs to use, all the ones of the service by default
+        :param timeout: The maximum seconds to wait for the tags
+        :return: A dict with the tags found by every API, keyed by API name, and the errors of the APIs that
+        failed, if any
+        :raise TimeoutError: If some API did not answer in time
+        """
+        apis = [api for api in (apis or self.apis) if api in self.batchers]
+        name = '%s.%s' % (uuid.uuid4().hex, file_type)
+        image_path = os.path.join(self.folder, name)
+        with open(image_path, 'wb') as image_file:
+            image_file.write(image_data)
+        image = CatalogImage(image_path, name, len(image_data), file_type)
+
+        def combine(values, errors):
+            answer = {'tags': dict((api, [list(tag) for tag in tags]) for api, tags in values.iteritems())}
+            if errors:
+                answer['errors'] = dict((api, str(error)) for api, error in errors.iteritems())
+            return answer
+
+        def remove(answer):
+            # Only once every batch with the image finished, even if the request timed out before
+            os.remove(image_path)
+
+        result = GatheredResult(apis, combine, remove)
+        for api in apis:
+            self.batchers[api].submit(image, result.set_part)
+        return result.get(timeout)
+
+    def serve(self, port, host=''):
+        """
+        Serves the service over HTTP from a daemon thread. Images are posted to /tag with their content as
+        body and their type in the Content-Type header or the type parameter. The apis parameter, comma
+        separated, selects the APIs. /health tells the APIs available and /metrics shows the metrics
+        :param port: The port to listen on, 0 takes a free one
+        :param host: The interface to listen on, all of them by default
+        :return: The HTTPServer, so the port can be read from server_address and it can be shut down
+        """
+        server = ServiceHTTPServer((host, port), ServiceRequestHandler)
+        server.service = self
+        thread = threading.Thread(target=server.serve_forever, name='tagging-service')
+        thread.daemon = True
+        thread.start()
+        return server
+
+    def close(self):
+        """
+        Finishes the batches already submitted, stops the workers of Imagga and removes the folder of the images
+        """
+        for batcher in self.batchers.itervalues():
+            batcher.close()
+        if 'Imagga' in self.batchers:
+            self.tagger.imagga_helper.close()
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+
+class ServiceHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    An HTTP server that answers every request in its own thread, so requests wait for their batches together
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class ServiceRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Answers the requests of the tagging service with JSON
+    """
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately, without this delayed ACKs add 40 ms to every response
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        service = self.server.service
+        path = urlparse.urlparse(self.path).path
+        if path == '/health':
+            self.send_json(200, {'status': 'ok', 'apis': service.apis})
+        elif path == '/metrics' and service.metrics.enabled:
+            self.send_body(200, service.metrics.to_prometheus(), 'text/plain; version=0.0.4')
+        else:
+            self.send_json(404, {'error': 'Not found'})
+
+    def do_POST(self):
+        service = self.server.service
+        url = urlparse.urlparse(self.path)
+        if url.path != '/tag':
+            self.send_json(404, {'error': 'Not found'})
+            return
+        parameters = urlparse.parse_qs(url.query)
+        length = self.headers.getheader('Content-Length')
+        if not length:
+            self.send_json(411, {'error': 'The image must be sent with its Content-Length'})
+            return
+        length = int(length)
+        if length > service.MAX_IMAGE_BYTES:
+            self.send_json(413, {'error': 'Images can have up to %d bytes' % service.MAX_IMAGE_BYTES})
+            return
+        image_data = self.rfile.read(length)
+        file_type = parameters.get('type', [None])[0]
+        if not file_type:
+            content_type = (self.headers.getheader('Content-Type') or '').split(';')[0].strip().lower()
+            file_type = service.CONTENT_TYPES.get(content_type)
+        if file_type not in service.CONTENT_TYPES.values():
+            self.send_json(415, {'error': 'Send JPEG, PNG or GIF images'})
+            return
+        apis = None
+        if parameters.get('apis'):
+            apis = [api.strip() for api in parameters['apis'][0].split(',') if api.strip()]
+            unknown = [api for api in apis if api not in service.apis]
+            if unknown:
+                self.send_json(400, {'error': 'Unknown APIs %s, choose from %s' % (', '.join(unknown),
+                                                                                  ', '.join(service.apis))})
+                return
+        try:
+            answer = service.tag(image_data, file_type, apis)
+        except TimeoutError:
+            self.send_json(504, {'error': 'The APIs did not answer in time'})
+            return
+        self.send_json(200, answer)
+
+    def send_json(self, status, body):
+        self.send_body(status, json.dumps(body, sort_keys=True), 'application/json')
+
+    def send_body(self, status, body, content_type):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Every image is a request, the metrics count them instead
+        pass
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description='Serves single image tagging over HTTP, grouping the images of '
+                                                 'concurrent requests in batched calls to the APIs')
+    parser.add_argument('-c', '--config', default='config.yml', help='the YAML file with the API credentials')
+    parser.add_argument('--host', default='', help='the interface to listen on, all of them by default')
+    parser.add_argument('--port', type=int, default=8080, help='the port to listen on')
+    parser.add_argument('--apis', help='comma separated APIs to use, all the configured ones by default')
+    parser.add_argument('--max-wait-ms', type=float, default=TaggingService.MAX_WAIT * 1000,
+                        help='milliseconds an image waits for its batch to fill')
+    parser.add_argument('--cache-db', help='a result cache database, so the same image is never tagged twice')
+    options = parser.parse_args(arguments)
+    if not os.path.isfile(options.config):
+        parser.error('the config file %s does not exist' % options.config)
+
+    metrics = Metrics()
+    result_cache = ResultCache(options.cache_db) if options.cache_db else None
+    imagga_helper = ImaggaHelper(result_cache=result_cache, metrics=metrics)
+    imagga_helper.configure_imagga_helper(options.config)
+    tagger = ImageTagger(imagga_helper=imagga_helper, result_cache=result_cache, metrics=metrics)
+    tagger.configure_tagger(options.config)
+    apis = [api.strip() for api in options.apis.split(',') if api.strip()] if options.apis else None
+    service = TaggingService(tagger, apis, options.max_wait_ms / 1000.0, metrics=metrics)
+    server = ServiceHTTPServer((options.host, options.port), ServiceRequestHandler)
+    server.service = service
+    print >> sys.stderr, 'Tagging with {0} at port {1}'.format(', '.join(service.apis), server.server_address[1])
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+        tagger.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,220 @@
+import json
+import heapq
+import bisect
+import threading
+from consensus import TagConsensus, normalize_tag
+
+
+class TagIndex(object):
+    """
+    An inverted index of tagging results. Every normalized tag has a posting list of (score, image, API)
+    entries sorted by descending score, so thresholded queries stop reading a list at the first entry
+    under the threshold instead of scanning all the results.
+    Scores are scaled to the 0 to 1 range like in TagConsensus, so thresholds mean the same for every API.
+    The index can be updated while tagging is still running, tagging an image again with the same API
+    replaces its previous entries
+    """
+    SOLR_BATCH_SIZE = 500
+
+    def __init__(self, score_scales=None):
+        """
+        :param score_scales: A dict with the API name as key and the maximum score as value, merged with
+        TagConsensus.SCORE_SCALES
+        """
+        # Posting lists hold tuples of negated score, image and API, so the natural order is the best first
+        self.postings = dict()
+        # The normalized tags of every image and API, needed to replace them and to persist the index
+        self.documents = dict()
+        self.score_scales = dict(TagConsensus.SCORE_SCALES)
+        self.score_scales.update(score_scales or {})
+        self.lock = threading.Lock()
+
+    def add(self, image_name, api, tags):
+        """
+        Indexes the tags found by an API for an image, replacing the ones it had before
+        :param image_name: The name of the image
+        :param api: The name of the API that tagged the image
+        :param tags: A list of tuples with the tag and its score as returned by the API
+        """
+        scale = self.score_scales.get(api, 1.0)
+        best = dict()
+        for tag, score in tags:
+            tag = normalize_tag(tag)
+            best[tag] = max(best.get(tag, 0.0), min(1.0, float(score) / scale))
+        with self.lock:
+            self.remove_document(image_name, api)
+            if best:
+                self.documents.setdefault(image_name, dict())[api] = best
+            for tag, score in best.iteritems():
+                bisect.insort(self.postings.setdefault(tag, list()), (-score, image_name, api))
+
+    def add_records(self, records):
+        """
+        Indexes the records yielded by the iter_* methods of ImageTagger, as they come
+        :param records: An iterable of tuples with the image name, the API name and the list of tags
+        :return: The index itself
+        """
+        for image_name, api, tags in records:
+            self.add(image_name, api, tags)
+        return self
+
+    def add_data_frame(self, data_frame):
+        """
+        Indexes the results of a DataFrame returned by use_all
+        :param data_frame: The DataFrame with the API names as columns and lists of tuples with the tags as cells
+        :return: The index itself
+        """
+        for api in data_frame.columns:
+            for image_name, tags in data_frame[api].iteritems():
+                # Images an API could not tag are NaN
+                if isinstance(tags, list):
+                    self.add(image_name, api, tags)
+        return self
+
+    def remove_document(self, image_name, api):
+        """
+        Removes the entries of an image and API from the posting lists. Must be called with the lock held
+        :param image_name: The name of the image
+        :param api: The name of the API
+        """
+        apis = self.documents.get(image_name)
+        if not apis or api not in apis:
+            return
+        for tag, score in apis.pop(api).iteritems():
+            posting_list = self.postings[tag]
+            del posting_list[bisect.bisect_left(posting_list, (-score, image_name, api))]
+            if not posting_list:
+                del self.postings[tag]
+        if not apis:
+            del self.documents[image_name]
+
+    def matches(self, tag, min_score=0.0, min_apis=1, apis=None):
+        """
+        Finds the images with a tag
+        :param tag: The tag to look for
+        :param min_score: The minimum score an API must give the tag to count
+        :param min_apis: The minimum number of APIs that must find the tag with at least min_score
+        :param apis: An optional list with the names of the APIs taken into account, all of them by default
+        :return: A dict with the image name as key and the best score of the tag as value
+        """
+        apis_found = dict()
+        best = dict()
+        with self.lock:
+            for negated_score, image_name, api in self.postings.get(normalize_tag(tag), []):
+                # The list is sorted by score, nothing after this entry reaches the threshold
+                if -negated_score < min_score:
+                    break
+                if apis is not None and api not in apis:
+                    continue
+                apis_found[image_name] = apis_found.get(image_name, 0) + 1
+                best.setdefault(image_name, -negated_score)
+        return dict((image_name, score) for image_name, score in best.iteritems()
+                    if apis_found[image_name] >= min_apis)
+
+    def query(self, all_of=None, any_of=None, min_score=0.0, min_apis=1, apis=None, top_k=None):
+        """
+        Finds the images that have all the tags of all_of and at least one of the tags of any_of, ranked
+        by the sum of the best scores of the matching tags
+        :param all_of: A list of tags that must all be found
+        :param any_of: A list of tags of which at least one must be found
+        :param min_score: The minimum score an API must give a tag to count
+        :param min_apis: The minimum number of APIs that must find a tag with at least min_score
+        :param apis: An optional list with the names of the APIs taken into account, all of them by default
+        :param top_k: The maximum number of images returned, all of them by default
+        :return: A list of tuples with the image name and its score, the best first
+        """
+        if not all_of and not any_of:
+            return []
+        scores = None
+        # Start with the rarest tags, so the candidates shrink as soon as possible
+        for tag in sorted(all_of or [], key=lambda tag: len(self.postings.get(normalize_tag(tag), []))):
+            found = self.matches(tag, min_score, min_apis, apis)
+            if scores is None:
+                scores = found
+            else:
+                scores = dict((image_name, score + found[image_name])
+                              for image_name, score in scores.iteritems() if image_name in found)
+            if not scores:
+                return []
+        if any_of:
+            found_any = dict()
+            for tag in any_of:
+                for image_name, score in self.matches(tag, min_score, min_apis, apis).iteritems():
+                    if scores is None or image_name in scores:
+                        found_any[image_name] = found_any.get(image_name, 0.0) + score
+            scores = dict((image_name, score + (scores or {}).get(image_name, 0.0))
+                          for image_name, score in found_any.iteritems())
+        ranked = scores.iteritems()
+        if top_k is not None:
+            return heapq.nlargest(top_k, ranked, key=lambda item: (item[1], item[0]))
+        return sorted(ranked, key=lambda item: (item[1], item[0]), reverse=True)
+
+    def save(self, file_path):
+        """
+        Saves the index as a JSON file with the normalized tags of every image and API
+        :param file_path: The path of the file to write
+        """
+        with self.lock:
+            with open(file_path, 'w') as index_file:
+                json.dump({'score_scales': self.score_scales, 'documents': self.documents}, index_file)
+
+    @classmethod
+    def load(cls, file_path):
+        """
+        Loads an index saved with save, rebuilding its posting lists
+        :param file_path: The path of the file to read
+        :return: The loaded index
+        """
+        with open(file_path) as index_file:
+            saved = json.load(index_file)
+        index = cls(saved['score_scales'])
+        for image_name, apis in saved['documents'].iteritems():
+            index.documents[image_name] = apis
+            for api, tags in apis.iteritems():
+                for tag, score in tags.iteritems():
+                    index.postings.setdefault(tag, list()).append((-score, image_name, api))
+        for posting_list in index.postings.itervalues():
+            posting_list.sort()
+        return index
+
+    def solr_documents(self):
+        """
+        Builds a Solr document per image, using dynamic fields of the default Solr schema: the tags found
+        by any API in tags_ss, and the tags and scores of every API in <API>_tags_ss and <API>_scores_fs
+        :return: A generator of dicts, one per image
+        """
+        with self.lock:
+            documents = [(image_name, dict(apis)) for image_name, apis in self.documents.iteritems()]
+        for image_name, apis in documents:
+            document = {'id': image_name, 'tags_ss': sorted(set(tag for tags in apis.itervalues() for tag in tags))}
+            for api, tags in apis.iteritems():
+                ranked = sorted(tags.iteritems(), key=lambda item: item[1], reverse=True)
+                document['%s_tags_ss' % api] = [tag for tag, score in ranked]
+                document['%s_scores_fs' % api] = [score for tag, score in ranked]
+            yield document
+
+    def export_to_solr(self, solr_url, batch_size=SOLR_BATCH_SIZE):
+        """
+        Sends the documents of solr_documents to a Solr core, in batches
+        :param solr_url: The URL of the Solr core
+        :param batch_size: The number of documents sent on every request
+        :return: The number of documents sent
+        """
+        # Only needed when exporting, so the index works without it
+        import pysolr
+        solr = pysolr.Solr(solr_url)
+        sent = 0
+        batch = list()
+        for document in self.solr_documents():
+            batch.append(document)
+            if len(batch) == batch_size:
+                solr.add(batch)
+                sent += len(batch)
+                batch = list()
+        if batch:
+            solr.add(batch)
+            sent += len(batch)
+        return sent
+
+    def __len__(self):
+        return len(self.documents)
@@ -1,13 +1,39 @@
+import sys
 import json
 import unittest
+import subprocess
 import mock
 from mock import Mock, patch
 import yaml
 import os
+import time
+import zipfile
+import shutil
+import tempfile
+import threading
+import base64
+import numpy
 import pandas
 
 from image_tagging import ImageTagger
+from watson_developer_cloud import WatsonException
 from imagga import ImaggaHelper
+from result_cache import ResultCache, content_hash
+from result_store import TagStore
+from consensus import TagConsensus
+from tag_index import TagIndex
+from manifest import Manifest
+from scanner import ImageScanner
+from resilience import CallGuard, CircuitOpenError, TransientError
+from benchmark import Benchmark, GoogleVisionStandIn, make_images
+from metrics import Metrics, NULL_METRICS
+import cli
+from service import TaggingService
+from cascade import ProviderBudgets, TaggingCascade
+from rate_limiter import TokenBucket
+from dedup import BKTree, ImageDeduplicator, hamming_distance
+from image_preprocessor import ImagePreprocessor
+from PIL import Image
 
 
 class ImageTaggerTests(unittest.TestCase):
@@ -122,7 +148,7 @@ class ImageTaggerTests(unittest.TestCase):
         print 'Checking tagger queries visual recognition API'
         # Configure the mock to return a response with some dummy json response
         self.configure_tagger(config_file='config.yml', tagger=self.tagger)
-        with patch('image_tagging.VisualRecognitionV3.classify') as mock_get:
+        with patch('watson_developer_cloud.VisualRecognitionV3.classify') as mock_get:
             # Configure the mock to return a response with an OK status code.
             fd = open('fixtures/dummy_vr_result.json', 'r')
             dummy_response = json.load(fd)
@@ -156,7 +182,7 @@ class ImageTaggerTests(unittest.TestCase):
         self.assertIsNotNone(self.imagga_helper.IMAGGA_API_KEY)
         self.assertIsNotNone(self.imagga_helper.IMAGGA_API_SECRET)
 
-    @mock.patch('imagga.requests.post', side_effect=mocked_requests)
+    @mock.patch('imagga.requests.Session.post', side_effect=mocked_requests)
     def test_configured_imagga_wrapper_can_upload_image(self, mock_post):
         print 'Checking imagga helper can upload imaga to Imagga'
         # Configure the mock to return a response with some dummy json response
@@ -165,7 +191,7 @@ class ImageTaggerTests(unittest.TestCase):
         self.assertIsNotNone(response)
         self.assertEqual(response, u'4598e39043b2f7bbef85a44422fbd824')
 
-    @mock.patch('imagga.requests.get', side_effect=mocked_requests)
+    @mock.patch('imagga.requests.Session.get', side_effect=mocked_requests)
     def test_configured_imagga_wrapper_can_tag_image(self, mock_post):
         print 'Checking imagga helper can tag Image'
         # Configure the mock to return a response with some dummy json response
@@ -190,6 +216,45 @@ class ImageTaggerTests(unittest.TestCase):
             self.assertIsNotNone(response)
             self.assertEqual(25, len(response.keys()))
 
+    @mock.patch('imagga.requests.Session.get', side_effect=mocked_requests)
+    @mock.patch('imagga.requests.Session.post', side_effect=mocked_requests)
+    def test_configured_imagga_wrapper_tags_folder_concurrently(self, mock_post, mock_get):
+        print 'Checking imagga helper uploads and tags a folder with a pool of workers'
+        self.configure_imagga_helper(config_file='config.yml', imagga_helper=self.imagga_helper)
+        self.imagga_helper.concurrency = 8
+        response = self.imagga_helper.tag_folder(folder_path='sample_images')
+        self.assertEqual(25, len(response.keys()))
+        self.assertEqual(25, mock_post.call_count)
+        self.assertEqual(25, mock_get.call_count)
+        self.assertIn('results', response['sea-man-person-surfer.jpg'])
+
+    @mock.patch('imagga.requests.Session.get', side_effect=mocked_requests)
+    @mock.patch('imagga.requests.Session.post', side_effect=mocked_requests)
+    def test_configured_imagga_wrapper_reuses_content_ids(self, mock_post, mock_get):
+        print 'Checking imagga helper does not upload again an image Imagga already has'
+        self.configure_imagga_helper(config_file='config.yml', imagga_helper=self.imagga_helper)
+        self.imagga_helper.content_cache = ResultCache(db_path='dummy_cache.db')
+        for attempt in range(2):
+            image_path, response = self.imagga_helper.upload_and_tag_image('sample_images/sea-man-person-surfer.jpg')
+            self.assertIn('results', response)
+        self.assertEqual(1, mock_post.call_count)
+        self.assertEqual(2, mock_get.call_count)
+        self.assertEqual('4598e39043b2f7bbef85a44422fbd824', mock_get.call_args[1]['params']['content'])
+        self.imagga_helper.content_cache.close()
+        os.remove('dummy_cache.db')
+
+    @mock.patch('imagga.requests.Session.get', side_effect=mocked_requests)
+    @mock.patch('imagga.requests.Session.post', side_effect=mocked_requests)
+    def test_configured_imagga_wrapper_tags_served_folder_by_url(self, mock_post, mock_get):
+        print 'Checking imagga helper tags images served over HTTP without uploading them'
+        self.configure_imagga_helper(config_file='config.yml', imagga_helper=self.imagga_helper)
+        response = self.imagga_helper.tag_folder(folder_path='sample_images',
+                                                 base_url='http://images.example.com/sample/')
+        self.assertEqual(25, len(response.keys()))
+        self.assertFalse(mock_post.called)
+        urls = [call[1]['params']['content'] for call in mock_get.call_args_list]
+        self.assertIn('http://images.example.com/sample/sea-man-person-surfer.jpg', urls)
+
     def test_configured_imagga_wrapper_can_process_images(self):
         print 'Checking imagga helper can process images'
         # Configure the mock to return a response with some dummy json response
@@ -208,6 +273,27 @@ class ImageTaggerTests(unittest.TestCase):
             # Check returned DataFrame has 16 rows, as expected
             self.assertEqual(25, len(processed_images.index))
 
+    def test_configured_imagga_wrapper_stores_results_only_when_asked(self):
+        print 'Checking imagga helper parses the responses directly and stores them only when asked'
+        self.configure_imagga_helper(config_file='config.yml', imagga_helper=self.imagga_helper)
+        fd = open('fixtures/dummy_imagga_total_results.json', 'r')
+        dummy_response = json.load(fd)
+        fd.close()
+        results_file = 'imagga_tagging_results.json'
+        with patch('imagga.ImaggaHelper.tag_folder') as mock_get:
+            mock_get.return_value = dummy_response
+            processed_images = self.imagga_helper.process_images(folder_name='whatever')
+            self.assertEqual(25, len(processed_images.index))
+            self.assertFalse(os.path.exists(results_file))
+            processed_images = self.imagga_helper.process_images(folder_name='whatever', store_results=True)
+            self.assertEqual(25, len(processed_images.index))
+        try:
+            fd = open(results_file, 'r')
+            self.assertEqual(dummy_response, json.load(fd))
+            fd.close()
+        finally:
+            os.remove(results_file)
+
     # @mock.patch('googleapiclient.http.HttpRequest.execute', side_effect=google_mocked_list)
     @unittest.skipUnless(RUN_ALL_TESTS, "All tests flag is not True")
     def test_configured_google_service_can_process_images(self, mock_post):
@@ -261,7 +347,7 @@ class ImageTaggerTests(unittest.TestCase):
             self.assertEqual(25, len(data_frame_clarifai.index))
 
         # Get data from visual_recognition
-        with patch('image_tagging.VisualRecognitionV3.classify') as mock_get:
+        with patch('watson_developer_cloud.VisualRecognitionV3.classify') as mock_get:
             # Configure the mock to return a response with an OK status code.
             fd = open('fixtures/dummy_vr_result.json', 'r')
             dummy_response = json.load(fd)
@@ -279,5 +365,944 @@ class ImageTaggerTests(unittest.TestCase):
         self.assertEqual(4, len(merged_df.columns))
         self.assertEqual(25, len(merged_df.index))
 
+    def test_concurrent_use_all_returns_empty_column_for_slow_api(self):
+        print 'Checking a slow API does not block the others when running concurrently'
+        names = ['first.jpg', 'second.jpg']
+
+        def tagged_frame(api):
+            return pandas.DataFrame({api: [[(u'sea', 0.9)], [(u'beach', 0.8)]]}, index=names)
+
+        def slow_google_vision(folder):
+            time.sleep(2)
+            return tagged_frame('GoogleVision')
+
+        imagga_helper = Mock()
+        imagga_helper.process_images.return_value = tagged_frame('Imagga')
+        tagger = ImageTagger(imagga_helper=imagga_helper)
+        tagger.configured = True
+        with patch.object(tagger, 'process_images_visual_recognition', return_value=tagged_frame('VisualRecognition')), \
+                patch.object(tagger, 'process_images_clarifai', side_effect=ValueError('Clarifai is down')), \
+                patch.object(tagger, 'process_images_google_vision', side_effect=slow_google_vision):
+            started = time.time()
+            response = tagger.use_all('sample_images', concurrent=True, timeout={'GoogleVision': 0.5})
+            self.assertLess(time.time() - started, 2)
+        self.assertEqual(4, len(response.columns))
+        self.assertEqual(2, len(response.index))
+        self.assertTrue(response['GoogleVision'].isnull().all())
+        self.assertTrue(response['Clarifai'].isnull().all())
+        self.assertEqual([(u'sea', 0.9)], response['Imagga']['first.jpg'])
+
+    def test_result_cache_evicts_least_recently_used(self):
+        print 'Checking result cache evicts the least recently used entries'
+        cache = ResultCache(db_path='dummy_cache.db', max_entries=2)
+        cache.set('first', 'Clarifai', [[u'sea', 0.9]])
+        time.sleep(0.01)
+        cache.set('second', 'Clarifai', [[u'beach', 0.8]])
+        time.sleep(0.01)
+        # Reading the first entry makes the second one the least recently used
+        self.assertEqual([[u'sea', 0.9]], cache.get('first', 'Clarifai'))
+        # Same image with other request parameters is a different entry
+        self.assertIsNone(cache.get('first', 'Clarifai', {'model': 'food'}))
+        time.sleep(0.01)
+        cache.set('third', 'Clarifai', [[u'surf', 0.7]])
+        self.assertEqual(2, len(cache))
+        self.assertIsNone(cache.get('second', 'Clarifai'))
+        self.assertIsNotNone(cache.get('third', 'Clarifai'))
+        # Expired entries are not returned
+        self.assertIsNone(cache.get('third', 'Clarifai', ttl=0))
+        cache.close()
+        os.remove('dummy_cache.db')
+
+    def test_result_cache_evicts_by_size_without_scanning_the_table(self):
+        print 'Checking result cache keeps its totals and evicts entries until its size is within the limit'
+        cache = ResultCache(db_path='dummy_cache.db', max_entries=None, max_bytes=100)
+        cache.EVICTION_BATCH_SIZE = 2
+        for position in range(5):
+            cache.set('image-{0}'.format(position), 'Imagga', 'x' * 28)
+            time.sleep(0.01)
+        # Every value takes 30 bytes once encoded, so only the last three fit
+        self.assertEqual((3, 90), cache.totals())
+        self.assertIsNone(cache.get('image-1', 'Imagga'))
+        self.assertIsNotNone(cache.get('image-2', 'Imagga'))
+        # Replacing an entry does not count it twice
+        cache.set('image-2', 'Imagga', 'x' * 8)
+        self.assertEqual((3, 70), cache.totals())
+        cache.close()
+        cache = ResultCache(db_path='dummy_cache.db', max_entries=None, max_bytes=100)
+        self.assertEqual((3, 70), cache.totals())
+        cache.clear()
+        self.assertEqual((0, 0), cache.totals())
+        cache.close()
+        os.remove('dummy_cache.db')
+
+    def test_result_caches_sharing_a_database_keep_it_within_its_limits(self):
+        print 'Checking result caches sharing a database evict from the totals of the database'
+        first = ResultCache(db_path='dummy_cache.db', max_entries=5)
+        second = ResultCache(db_path='dummy_cache.db', max_entries=5)
+        try:
+            for position in range(10):
+                cache = first if position % 2 else second
+                cache.set('image-{0}'.format(position), 'Clarifai', [[u'sea', 0.9]])
+                time.sleep(0.01)
+            rows = first.connection.execute('SELECT COUNT(*), SUM(size) FROM results').fetchone()
+            self.assertEqual(5, rows[0])
+            self.assertEqual(rows, first.totals())
+            self.assertEqual(rows, second.totals())
+            # The least recently used entries were evicted, whichever cache stored them
+            self.assertIsNone(first.get('image-4', 'Clarifai'))
+            self.assertIsNotNone(first.get('image-5', 'Clarifai'))
+        finally:
+            first.close()
+            second.close()
+            os.remove('dummy_cache.db')
+
+    def test_cached_google_vision_results_skip_the_api(self):
+        print 'Checking cached results are not requested again to Google Vision'
+        cache = ResultCache(db_path='dummy_cache.db')
+        self.tagger.result_cache = cache
+        self.configure_tagger(config_file='config.yml', tagger=self.tagger)
+        with patch('googleapiclient.http.HttpRequest.execute', side_effect=ImageTaggerTests.google_mocked_list):
+            first_response = self.tagger.process_images_google_vision(folder_name='sample_images')
+        self.assertEqual(25, len(cache))
+        with patch('googleapiclient.http.HttpRequest.execute') as mock_execute:
+            second_response = self.tagger.process_images_google_vision(folder_name='sample_images')
+            self.assertFalse(mock_execute.called)
+        self.assertEqual(first_response['GoogleVision'].tolist(), second_response['GoogleVision'].tolist())
+        cache.close()
+        os.remove('dummy_cache.db')
+
+    def test_token_bucket_limits_rate(self):
+        print 'Checking token bucket waits for tokens once the bucket is empty'
+        # 10 tokens per second, only one available at a time
+        bucket = TokenBucket(rate_per_minute=600, capacity=1)
+        started = time.time()
+        for attempt in range(3):
+            bucket.acquire()
+        elapsed = time.time() - started
+        self.assertGreaterEqual(elapsed, 0.15)
+        self.assertLess(elapsed, 1)
+
+    def test_google_vision_batches_are_bounded_by_images_and_bytes(self):
+        print 'Checking Google Vision requests are bounded by number of images and payload bytes'
+        batches = []
+
+        def annotate(payload, images_names):
+            batches.append((len(payload['requests']), sum(len(request['image']['content'])
+                                                          for request in payload['requests'])))
+            return {'responses': [{name: {'labelAnnotations': [{'description': u'sea', 'score': 0.9}]}}
+                                  for name in images_names]}
+
+        self.tagger.GOOGLE_VISION_BATCH_BYTES = 1024 * 1024
+        self.tagger.GOOGLE_VISION_BATCH_IMAGES = 4
+        with patch.object(self.tagger, 'annotate_google_vision_batch', side_effect=annotate):
+            response = self.tagger.process_images_google_vision(folder_name='sample_images')
+        self.assertEqual(25, len(response.index))
+        self.assertEqual(25, sum(images for images, size in batches))
+        for images, size in batches:
+            self.assertLessEqual(images, 4)
+            self.assertLessEqual(size, 1024 * 1024)
+        self.assertEqual([(u'sea', 0.9)], response['GoogleVision']['sea-man-person-surfer.jpg'])
+
+    def test_google_vision_batch_is_reduced_to_tags(self):
+        print 'Checking a Google Vision batch is reduced to its tags once sent'
+        batches = []
+
+        def annotate(payload, images_names):
+            batches.append(payload)
+            return {'responses': [{name: {'labelAnnotations': [{'description': u'sea', 'score': 0.9}]}}
+                                  for name in images_names]}
+
+        with patch.object(self.tagger, 'annotate_google_vision_batch', side_effect=annotate):
+            tags = self.tagger.tag_google_vision_batch([('sample_images/sea-man-person-surfer.jpg',
+                                                         'sea-man-person-surfer.jpg', None)])
+        self.assertEqual({'sea-man-person-surfer.jpg': [(u'sea', 0.9)]}, tags)
+        self.assertEqual(1, len(batches[0]['requests']))
+
+    def test_google_vision_batch_leaves_failed_images_untagged(self):
+        print 'Checking images Google could not label are neither tagged nor checkpointed'
+
+        def annotate(payload, images_names):
+            return {'responses': [{'sea.jpg': {'labelAnnotations': [{'description': u'sea', 'score': 0.9}]}},
+                                  {'surfer.jpg': {'error': {'code': 4, 'message': 'Deadline exceeded'}}}]}
+
+        with patch.object(self.tagger, 'annotate_google_vision_batch', side_effect=annotate), \
+                patch.object(self.tagger, 'checkpoint') as checkpoint:
+            tags = self.tagger.tag_google_vision_batch([('sample_images/sea-man-person-surfer.jpg', 'sea.jpg', 'a'),
+                                                        ('sample_images/sea-man-person-surfer.jpg', 'surfer.jpg', 'b')])
+        self.assertEqual({'sea.jpg': [(u'sea', 0.9)]}, tags)
+        checkpoint.assert_called_once_with('GoogleVision', [('a', [(u'sea', 0.9)])])
+
+    def test_visual_recognition_sends_bounded_chunks_and_retries_failed_ones(self):
+        print 'Checking Visual Recognition sends chunks in parallel and retries only the failed ones'
+        chunks = []
+
+        def classify(images_file, threshold):
+            zip_name = os.path.basename(images_file.name)
+            names = zipfile.ZipFile(images_file).namelist()
+            chunks.append(names)
+            # The very first request fails
+            if len(chunks) == 1:
+                raise WatsonException('Service unavailable')
+            return {'images': [{'image': '%s/%s' % (zip_name, name),
+                                'classifiers': [{'classes': [{'class': u'sea', 'score': 0.5}]}]}
+                               for name in names]}
+
+        # Configured first, the errors of the client are only known once it is imported
+        self.configure_tagger(config_file='config.yml', tagger=self.tagger)
+        self.tagger.visual_recognition = Mock()
+        self.tagger.visual_recognition.classify.side_effect = classify
+        self.tagger.VISUAL_RECOGNITION_ZIP_IMAGES = 6
+        with patch('image_tagging.time.sleep'):
+            response = self.tagger.process_images_visual_recognition('sample_images')
+        # Five chunks plus the retry of the failed one
+        self.assertEqual(6, len(chunks))
+        self.assertTrue(all(len(names) <= 6 for names in chunks))
+        self.assertEqual(25, len(response.index))
+        self.assertFalse(response['VisualRecognition'].isnull().any())
+        self.assertFalse(os.path.exists('sample-images.zip'))
+
+    def test_visual_recognition_maps_subfolder_images_back_to_their_names(self):
+        print 'Checking Visual Recognition results of images in subfolders are matched to the images sent'
+        folder = tempfile.mkdtemp()
+        os.mkdir(os.path.join(folder, 'sub'))
+        shutil.copy('sample_images/sea-man-person-surfer.jpg', os.path.join(folder, 'a.jpg'))
+        shutil.copy('sample_images/pexels-photo_beach_1.jpg', os.path.join(folder, 'sub', 'a.jpg'))
+
+        def classify(images_file, threshold):
+            names = zipfile.ZipFile(images_file).namelist()
+            # Answered with the whole path of the uploaded file, and an image that was never sent
+            return {'images': [{'image': '%s/%s' % (images_file.name, name),
+                                'classifiers': [{'classes': [{'class': name, 'score': 0.5}]}]}
+                               for name in names + ['other.jpg']]}
+
+        self.tagger.visual_recognition = Mock()
+        self.tagger.visual_recognition.classify.side_effect = classify
+        try:
+            response = self.tagger.process_images_visual_recognition(ImageScanner().scan(folder))
+        finally:
+            shutil.rmtree(folder)
+        self.assertEqual(['a.jpg', 'sub/a.jpg'], sorted(response.index))
+        self.assertEqual([(u'a.jpg', 0.5)], response['VisualRecognition']['a.jpg'])
+        self.assertEqual([(u'sub/a.jpg', 0.5)], response['VisualRecognition']['sub/a.jpg'])
+
+    def test_clarifai_batches_map_results_by_name_and_close_files(self):
+        print 'Checking Clarifai sends batches, maps results by name and closes every file'
+        batches = []
+
+        def tag_images(open_files, local_ids=None):
+            batches.append(open_files)
+            self.assertTrue(all(not image_file.closed for image_file, image_name in open_files))
+            # Clarifai is asked to echo the name of every image as its local id
+            self.assertEqual([image_name for image_file, image_name in open_files], local_ids)
+            # Answer in reverse order, results must be matched by their local id
+            return {'results': [{'local_id': image_name,
+                                 'result': {'tag': {'classes': [image_name], 'probs': [0.9]}}}
+                                for image_file, image_name in reversed(open_files)]}
+
+        self.tagger.clarifai = Mock()
+        self.tagger.clarifai.tag_images.side_effect = tag_images
+        self.tagger.CLARIFAI_BATCH_SIZE = 10
+        response = self.tagger.process_images_clarifai(folder_name='sample_images')
+        self.assertEqual([10, 10, 5], sorted([len(open_files) for open_files in batches], reverse=True))
+        self.assertTrue(all(image_file.closed for open_files in batches for image_file, image_name in open_files))
+        self.assertEqual(25, len(response.index))
+        for image_name, tags in response['Clarifai'].iteritems():
+            self.assertEqual([(image_name, 0.9)], tags)
+
+    def test_preprocessor_reduces_images_once(self):
+        print 'Checking preprocessor reduces images and reuses the reduced copies'
+        cache_dir = tempfile.mkdtemp()
+        preprocessor = ImagePreprocessor(cache_dir=cache_dir, settings={'Imagga': (10000, 85)})
+        image_path = 'sample_images/sea-man-person-surfer.jpg'
+        reduced_path = preprocessor.prepare(image_path, 'GoogleVision')
+        self.assertNotEqual(image_path, reduced_path)
+        self.assertLessEqual(max(Image.open(reduced_path).size), 640)
+        self.assertLess(os.path.getsize(reduced_path), os.path.getsize(image_path))
+        self.assertEqual(reduced_path, preprocessor.prepare(image_path, 'GoogleVision'))
+        # Images already smaller than the maximum edge are sent as they are
+        self.assertEqual(image_path, preprocessor.prepare(image_path, 'Imagga'))
+        shutil.rmtree(cache_dir)
+
+    def test_google_vision_sends_preprocessed_images(self):
+        print 'Checking Google Vision sends the reduced images when there is a preprocessor'
+        cache_dir = tempfile.mkdtemp()
+        self.tagger.preprocessor = ImagePreprocessor(cache_dir=cache_dir)
+        sent_bytes = []
+
+        def annotate(payload, images_names):
+            sent_bytes.extend(len(base64.b64decode(request['image']['content'])) for request in payload['requests'])
+            return {'responses': [{name: {}} for name in images_names]}
+
+        with patch.object(self.tagger, 'annotate_google_vision_batch', side_effect=annotate):
+            response = self.tagger.process_images_google_vision(folder_name='sample_images')
+        self.assertEqual(25, len(response.index))
+        original_bytes = sum(os.path.getsize(os.path.join('sample_images', name)) for name in os.listdir('sample_images'))
+        self.assertLess(sum(sent_bytes), original_bytes / 2)
+        shutil.rmtree(cache_dir)
+
+    def test_iter_all_yields_results_before_slow_apis_finish(self):
+        print 'Checking streamed results of fast APIs arrive before slow APIs finish'
+
+        def classify(images_file, threshold):
+            time.sleep(1)
+            zip_name = os.path.basename(images_file.name)
+            return {'images': [{'image': '%s/%s' % (zip_name, name),
+                                'classifiers': [{'classes': [{'class': u'sea', 'score': 0.5}]}]}
+                               for name in zipfile.ZipFile(images_file).namelist()]}
+
+        def tag_images(open_files, local_ids=None):
+            return {'results': [{'local_id': image_name,
+                                 'result': {'tag': {'classes': [u'beach'], 'probs': [0.9]}}}
+                                for image_file, image_name in open_files]}
+
+        self.tagger.visual_recognition = Mock()
+        self.tagger.visual_recognition.classify.side_effect = classify
+        self.tagger.clarifai = Mock()
+        self.tagger.clarifai.tag_images.side_effect = tag_images
+        started = time.time()
+        records = self.tagger.iter_all('sample_images')
+        image_name, api, tags = next(records)
+        self.assertLess(time.time() - started, 1)
+        self.assertEqual('Clarifai', api)
+        self.assertEqual([(u'beach', 0.9)], tags)
+        remaining = list(records)
+        self.assertEqual(49, len(remaining))
+        self.assertEqual(25, len([record for record in remaining if record[1] == 'VisualRecognition']))
+
+    def test_iter_all_stops_calling_the_apis_when_the_consumer_stops(self):
+        print 'Checking the APIs stop being called once the consumer of iter_all stops early'
+
+        def tag_images(open_files, local_ids=None):
+            time.sleep(0.05)
+            return {'results': [{'local_id': image_name,
+                                 'result': {'tag': {'classes': [u'beach'], 'probs': [0.9]}}}
+                                for image_file, image_name in open_files]}
+
+        self.tagger.clarifai = Mock()
+        self.tagger.clarifai.tag_images.side_effect = tag_images
+        self.tagger.CLARIFAI_BATCH_SIZE = 1
+        self.tagger.CLARIFAI_CONCURRENCY = 2
+        self.tagger.ITER_ALL_BUFFER = 1
+        records = self.tagger.iter_all('sample_images', ['Clarifai'])
+        next(records)
+        records.close()
+        time.sleep(0.5)
+        calls = self.tagger.clarifai.tag_images.call_count
+        time.sleep(0.3)
+        # Only the batches already sent when the consumer stopped, out of 25
+        self.assertLess(calls, 10)
+        self.assertEqual(calls, self.tagger.clarifai.tag_images.call_count)
+
+    def test_tag_store_keeps_long_coded_results(self):
+        print 'Checking tag store holds coded results and survives a npz round trip'
+        data_frame = pandas.DataFrame({'Clarifai': [[(u'beach', 0.9), (u'sea', 0.5)], float('nan')],
+                                       'Imagga': [[(u'sea', 40.0)], [(u'cat', 80.0)]]},
+                                      index=['one.jpg', 'two.jpg'])
+        store = TagStore(capacity=1).add_data_frame(data_frame)
+        store.add_records([('three.jpg', 'GoogleVision', [(u'sea', 0.7)])])
+        self.assertEqual(5, len(store))
+        self.assertEqual([u'beach', u'sea', u'cat'], store.tags)
+        self.assertEqual([(u'beach', 0.9), (u'sea', 0.5)],
+                         [(tag, round(score, 5)) for tag, score in store.tags_for('one.jpg', 'Clarifai')])
+        self.assertEqual([], store.tags_for('two.jpg', 'Clarifai'))
+        long_frame = store.to_data_frame()
+        self.assertEqual('float32', str(long_frame['score'].dtype))
+        self.assertEqual('category', str(long_frame['tag'].dtype))
+        self.assertEqual(3, len(long_frame[long_frame['tag'] == u'sea']))
+
+        folder = tempfile.mkdtemp()
+        try:
+            store.save(os.path.join(folder, 'tags.npz'))
+            loaded = TagStore.load(os.path.join(folder, 'tags.npz'))
+        finally:
+            shutil.rmtree(folder)
+        self.assertEqual(store.images, loaded.images)
+        self.assertEqual(store.apis, loaded.apis)
+        self.assertEqual(store.tags, loaded.tags)
+        for original, restored in zip(store.columns(), loaded.columns()):
+            self.assertEqual(original.dtype, restored.dtype)
+            self.assertEqual(original.tolist(), restored.tolist())
+
+    def test_consensus_combines_normalized_tags_of_all_apis(self):
+        print 'Checking consensus normalizes tags and scores across APIs'
+        data_frame = pandas.DataFrame({'Clarifai': [[(u'Sea', 0.5), (u'beach', 0.2)], [(u'pet', 0.6)]],
+                                       'Imagga': [[(u'sea', 40.0), (u'SEA', 60.0), (u'sand', 90.0)], [(u'cat', 80.0)]]},
+                                      index=['one.jpg', 'two.jpg'])
+        consensus = TagConsensus.from_data_frame(data_frame, synonyms={u'Pet': u'cat'})
+        results = consensus.to_data_frame()
+        sea = results[(results['image'] == 'one.jpg') & (results['tag'] == u'sea')].iloc[0]
+        # Imagga keeps its best score for the repeated tag, 60 out of 100
+        self.assertAlmostEqual(0.55, sea['consensus'], places=5)
+        self.assertEqual(1.0, sea['agreement'])
+        self.assertEqual(2, sea['votes'])
+        cat = results[results['image'] == 'two.jpg']
+        self.assertEqual([u'cat'], list(cat['tag']))
+        self.assertAlmostEqual(0.7, cat['consensus'].iloc[0], places=5)
+
+        top = consensus.top_tags(k=2)
+        self.assertEqual([(u'one.jpg', u'sea', 1), (u'one.jpg', u'sand', 2), (u'two.jpg', u'cat', 1)],
+                         zip(top['image'], top['tag'], top['rank']))
+        self.assertEqual([u'sea'], list(consensus.top_tags(k=2, min_agreement=1.0)['tag'])[:1])
+
+    def test_tag_index_answers_thresholded_queries(self):
+        print 'Checking tag index AND / OR queries with thresholds, updates and persistence'
+        index = TagIndex()
+        index.add_records([('one.jpg', 'Clarifai', [(u'sea', 0.9), (u'beach', 0.7)]),
+                           ('one.jpg', 'Imagga', [(u'Sea', 85.0)]),
+                           ('two.jpg', 'Clarifai', [(u'sea', 0.95), (u'cat', 0.6)]),
+                           ('three.jpg', 'GoogleVision', [(u'beach', 0.8), (u'sea', 0.5)])])
+        self.assertEqual([u'one.jpg'], [name for name, score in index.query(all_of=['sea'], min_score=0.8, min_apis=2)])
+        self.assertEqual([u'two.jpg', u'one.jpg'], [name for name, score in index.query(all_of=['sea'], min_score=0.8)])
+        self.assertEqual(['one.jpg', 'three.jpg'], sorted(name for name, score in index.query(all_of=['sea', 'beach'])))
+        self.assertEqual(['one.jpg', 'three.jpg'],
+                         sorted(name for name, score in index.query(any_of=['cat', 'beach'], min_score=0.65)))
+        self.assertEqual(['one.jpg', 'three.jpg'],
+                         sorted(name for name, score in index.query(all_of=['beach'], any_of=['sea'], apis=['Clarifai', 'GoogleVision'])))
+        self.assertEqual(1, len(index.query(any_of=['sea'], top_k=1)))
+        # Tagging again replaces the previous results of the API
+        index.add('two.jpg', 'Clarifai', [(u'dog', 0.9)])
+        self.assertEqual([], index.query(all_of=['cat']))
+
+        folder = tempfile.mkdtemp()
+        try:
+            index.save(os.path.join(folder, 'index.json'))
+            loaded = TagIndex.load(os.path.join(folder, 'index.json'))
+        finally:
+            shutil.rmtree(folder)
+        self.assertEqual(index.query(any_of=['sea', 'dog']), loaded.query(any_of=['sea', 'dog']))
+        loaded.add('one.jpg', 'Imagga', [])
+        self.assertEqual([u'one.jpg'], [name for name, score in loaded.query(all_of=['sea'], min_score=0.8)])
+        documents = dict((document['id'], document) for document in loaded.solr_documents())
+        self.assertEqual([u'beach', u'sea'], documents['one.jpg']['tags_ss'])
+        self.assertEqual([0.9, 0.7], documents['one.jpg']['Clarifai_scores_fs'])
+
+    def test_manifest_resumes_interrupted_runs_and_skips_unchanged_images(self):
+        print 'Checking the manifest resumes after a failed batch and only sends new or changed images'
+        folder = tempfile.mkdtemp()
+        for image_name in sorted(os.listdir('sample_images'))[:6]:
+            shutil.copy(os.path.join('sample_images', image_name), folder)
+        sent = []
+
+        def tag_images(open_files, local_ids=None):
+            sent.append([image_name for image_file, image_name in open_files])
+            if len(sent) == 1:
+                raise Exception('Connection lost')
+            return {'results': [{'local_id': image_name,
+                                 'result': {'tag': {'classes': [u'sea'], 'probs': [0.9]}}}
+                                for image_file, image_name in open_files]}
+
+        manifest = Manifest(db_path=os.path.join(folder, 'manifest.db'))
+        try:
+            for run in range(3):
+                tagger = ImageTagger(manifest=manifest)
+                tagger.clarifai = Mock()
+                tagger.clarifai.tag_images.side_effect = tag_images
+                tagger.CLARIFAI_BATCH_SIZE = 3
+                tagger.CLARIFAI_CONCURRENCY = 1
+                if run == 2:
+                    # Only the changed image is sent again
+                    with open(os.path.join(folder, sent[0][0]), 'ab') as image_file:
+                        image_file.write('changed')
+                response = tagger.process_images_clarifai(folder_name=folder)
+                if run == 0:
+                    self.assertEqual(3, response['Clarifai'].count())
+            self.assertEqual([3, 3, 3, 1], [len(names) for names in sent])
+            # The failed batch is the only one sent again
+            self.assertEqual(sent[0], sent[2])
+            self.assertEqual(6, response['Clarifai'].count())
+            self.assertEqual([], manifest.pending([os.path.join(folder, name) for name in sent[0]], 'Clarifai'))
+        finally:
+            manifest.close()
+            shutil.rmtree(folder)
+
+    def test_scanner_builds_one_recursive_catalog_for_all_apis(self):
+        print 'Checking the scanner finds images in subfolders once and every API gets the same catalog'
+        folder = tempfile.mkdtemp()
+        os.makedirs(os.path.join(folder, 'sub', 'deeper'))
+        for image_name in ['a.jpg', 'sub/a.JPG', 'sub/b.gif', 'sub/deeper/c.png', 'notes.txt']:
+            shutil.copy('sample_images/sea-man-person-surfer.jpg', os.path.join(folder, image_name))
+        try:
+            catalog = ImageScanner().scan(folder)
+            self.assertEqual(['a.jpg', 'sub/a.JPG', 'sub/b.gif', 'sub/deeper/c.png'], [image.name for image in catalog])
+            self.assertEqual(['jpg', 'jpg', 'gif', 'png'], [image.type for image in catalog])
+            self.assertEqual(os.path.join(folder, 'sub', 'deeper', 'c.png'), catalog[-1].path)
+            self.assertEqual(os.path.getsize('sample_images/sea-man-person-surfer.jpg'), catalog[0].size)
+            self.assertEqual(['a.jpg'], [image.name for image in ImageScanner(recursive=False).scan(folder)])
+            self.assertEqual([], ImageScanner().scan(os.path.join(folder, 'missing')))
+
+            def classify(images_file, threshold):
+                return {'images': [{'image': 'images.zip/%s' % name,
+                                    'classifiers': [{'classes': [{'class': u'sea', 'score': 0.5}]}]}
+                                   for name in zipfile.ZipFile(images_file).namelist()]}
+
+            self.tagger.visual_recognition = Mock()
+            self.tagger.visual_recognition.classify.side_effect = classify
+            with patch('image_tagging.ImageScanner.iter_images') as mock_scan:
+                response = self.tagger.process_images_visual_recognition(catalog)
+                self.assertFalse(mock_scan.called)
+            # GIF images are not sent to Visual Recognition, but they are still part of the results
+            self.assertEqual([image.name for image in catalog], list(response.index))
+            self.assertEqual([u'sea'], [tag for tag, score in response['VisualRecognition']['sub/a.JPG']])
+            self.assertTrue(pandas.isnull(response['VisualRecognition']['sub/b.gif']))
+        finally:
+            shutil.rmtree(folder)
+
+    def test_call_guard_retries_honors_retry_after_and_opens_the_circuit(self):
+        print 'Checking calls are retried with backoff, wait what the service asks and fail fast when it is down'
+        guard = CallGuard('Dummy', retries=2, failure_threshold=3, reset_timeout=60)
+        answers = [TransientError('Throttled', retry_after=7), TransientError('Unavailable'), 'tags']
+        call = Mock(side_effect=answers)
+        with patch('resilience.time.sleep') as mock_sleep:
+            self.assertEqual('tags', guard.call(call))
+            self.assertEqual(7, mock_sleep.call_args_list[0][0][0])
+            self.assertLessEqual(mock_sleep.call_args_list[1][0][0], 2)
+            # Errors that are not transient are not retried
+            call = Mock(side_effect=ValueError('Bad request'))
+            self.assertRaises(ValueError, guard.call, call)
+            self.assertEqual(1, call.call_count)
+            call = Mock(side_effect=TransientError('Down'))
+            self.assertRaises(TransientError, guard.call, call)
+            self.assertEqual(3, call.call_count)
+            # The circuit is open now, the service is not called at all
+            self.assertRaises(CircuitOpenError, guard.call, call)
+            self.assertEqual(3, call.call_count)
+        self.assertEqual(12, guard.parse_retry_after('12'))
+        # A service cannot make a worker wait longer than the maximum backoff
+        self.assertEqual(guard.max_delay, guard.backoff(0, TransientError('Throttled', retry_after=3600)))
+
+    def test_visual_recognition_retries_only_throttling_and_server_errors(self):
+        print 'Checking Visual Recognition errors are retried or not by the status code in their message'
+        self.configure_tagger(config_file='config.yml', tagger=self.tagger)
+        guard = self.tagger.visual_recognition_guard
+        for message, calls in [('Error: Too many requests, Code: 429', 3),
+                               ('Error: Internal error, Code: 503', 3),
+                               ('Error: Invalid image, Code: 400', 1),
+                               ('Unauthorized: Access is denied due to invalid credentials', 1),
+                               ('Service unavailable', 3)]:
+            guard.breaker.record_success()
+            # The first attempt and VISUAL_RECOGNITION_RETRIES more for the transient ones
+            call = Mock(side_effect=WatsonException(message))
+            with patch('resilience.time.sleep'):
+                self.assertRaises(WatsonException, guard.call, call)
+            self.assertEqual(calls, call.call_count, message)
+
+    def test_call_guard_hedges_slow_calls(self):
+        print 'Checking a slow call is sent again and the first answer wins'
+        guard = CallGuard('Dummy', hedge_after=0.05)
+        calls = []
+
+        def slow_first_time():
+            calls.append(time.time())
+            if len(calls) == 1:
+                time.sleep(1)
+                return 'slow'
+            return 'fast'
+
+        started = time.time()
+        self.assertEqual('fast', guard.call(slow_first_time))
+        self.assertLess(time.time() - started, 0.5)
+        self.assertEqual(2, len(calls))
+        calls = []
+        self.assertEqual('slow', guard.call(slow_first_time, hedge=False))
+
+    def test_imagga_retries_throttled_and_invalid_responses(self):
+        print 'Checking Imagga retries throttled requests and gives up on invalid responses without stopping'
+
+        class MockResponse(object):
+            def __init__(self, status_code, json_data=None, headers=None):
+                self.status_code = status_code
+                self.json_data = json_data
+                self.headers = headers or {}
+
+            def json(self):
+                if self.json_data is None:
+                    raise ValueError('No JSON object could be decoded')
+                return self.json_data
+
+        uploaded = {'status': 'success', 'uploaded': [{'id': 'content-id', 'filename': 'image.jpg'}]}
+        with patch('imagga.requests.Session.post') as mock_post, patch('resilience.time.sleep') as mock_sleep:
+            mock_post.side_effect = [MockResponse(429, headers={'Retry-After': '3'}), MockResponse(200, uploaded)]
+            self.assertEqual('content-id', self.imagga_helper.upload_image('sample_images/sea-man-person-surfer.jpg'))
+            mock_sleep.assert_called_once_with(3.0)
+            mock_post.side_effect = [MockResponse(502)] * 4
+            self.assertIsNone(self.imagga_helper.upload_image('sample_images/sea-man-person-surfer.jpg'))
+            self.assertEqual(6, mock_post.call_count)
+
+    def test_benchmark_tags_synthetic_images_with_local_stand_ins(self):
+        print 'Checking the benchmark tags synthetic images with the local stand-ins of every API'
+        folder = tempfile.mkdtemp()
+        benchmark = Benchmark(latency=0.01).start()
+        try:
+            make_images(folder, 4, 64, 48)
+            results = benchmark.run(folder, ['use_all', 'google_vision'])
+        finally:
+            benchmark.stop()
+            shutil.rmtree(folder)
+        self.assertEqual(['use_all', 'google_vision'], [result['path'] for result in results])
+        for result in results:
+            self.assertEqual(4, result['images'])
+            self.assertEqual(4, result['tagged'])
+            self.assertGreater(result['images_per_second'], 0)
+            self.assertGreaterEqual(result['p99'], result['p50'])
+            self.assertGreaterEqual(result['p50'], 0.01)
+            self.assertGreater(result['peak_rss_mb'], 0)
+        # Every API got requests in the use_all run, only Google in the other one
+        self.assertTrue(all(stats['requests'] > 0 for stats in results[0]['stand_ins'].values()))
+        self.assertEqual(0, results[1]['stand_ins']['Imagga']['requests'])
+        self.assertEqual(1, results[1]['stand_ins']['GoogleVision']['requests'])
+
+    def test_clarifai_stand_in_echoes_the_local_ids(self):
+        print 'Checking the Clarifai stand-in answers with the local ids it was sent'
+        benchmark = Benchmark().start()
+        try:
+            tagger = benchmark.make_tagger()
+            names = ['sea-man-person-surfer.jpg', 'pexels-photo_beach_1.jpg']
+            image_files = [open(os.path.join('sample_images', name), 'rb') for name in names]
+            try:
+                response = tagger.clarifai.tag_images(image_files, local_ids=names)
+            finally:
+                for image_file in image_files:
+                    image_file.close()
+            tags = tagger.tag_clarifai_batch([(os.path.join('sample_images', name), name, None) for name in names])
+        finally:
+            benchmark.stop()
+        self.assertEqual(names, [result['local_id'] for result in response['results']])
+        self.assertEqual(sorted(names), sorted(tags))
+
+    def test_metrics_time_stages_and_count_retries_and_cache_hits(self):
+        print 'Checking metrics record stages, retries and cache hits as Prometheus text and JSON logs'
+        from StringIO import StringIO
+        log = StringIO()
+        metrics = Metrics(log=log)
+        guard = CallGuard('Dummy', metrics=metrics)
+        call = Mock(side_effect=[TransientError('Throttled', retry_after=0), 'tags'])
+        with patch('resilience.time.sleep'):
+            self.assertEqual('tags', guard.call(call))
+        cache_folder = tempfile.mkdtemp()
+        try:
+            tagger = ImageTagger(result_cache=ResultCache(os.path.join(cache_folder, 'cache.db')), metrics=metrics)
+            image_path = 'sample_images/sea-man-person-surfer.jpg'
+            image_hash, tags = tagger.get_cached_tags('Clarifai', image_path)
+            self.assertIsNone(tags)
+            tagger.checkpoint('Clarifai', [(image_hash, [('sea', 0.9)])])
+            self.assertEqual([('sea', 0.9)], tagger.get_cached_tags('Clarifai', image_path)[1])
+            self.assertEqual(25, len(tagger.scan('sample_images')))
+        finally:
+            shutil.rmtree(cache_folder)
+
+        counters = dict(((counter['counter'], counter['api']), counter['value'])
+                        for counter in metrics.snapshot()['counters'])
+        self.assertEqual(1, counters[('retries', 'Dummy')])
+        self.assertEqual(1, counters[('cache_hits', 'Clarifai')])
+        self.assertEqual(1, counters[('cache_misses', 'Clarifai')])
+        self.assertEqual(1, counters[('images', 'Clarifai')])
+        timers = dict(((timer['stage'], timer['api']), timer['count']) for timer in metrics.snapshot()['timers'])
+        self.assertEqual(2, timers[('request', 'Dummy')])
+        self.assertEqual(1, timers[('scan', None)])
+
+        exposition = metrics.to_prometheus()
+        self.assertIn('# TYPE image_tagging_stage_seconds histogram', exposition)
+        self.assertIn('image_tagging_stage_seconds_count{api="Dummy",stage="request"} 2', exposition)
+        self.assertIn('image_tagging_stage_seconds_bucket{api="Dummy",le="+Inf",stage="request"} 2', exposition)
+        self.assertIn('image_tagging_retries_total{api="Dummy"} 1', exposition)
+        events = [json.loads(line) for line in log.getvalue().splitlines()]
+        self.assertIn({'type': 'counter', 'counter': 'retries', 'api': 'Dummy', 'value': 1},
+                      [dict((key, value) for key, value in event.items() if key != 'time') for event in events])
+        # Disabled metrics record nothing and share a single timer
+        self.assertFalse(NULL_METRICS.enabled)
+        self.assertIs(NULL_METRICS.timer('scan'), NULL_METRICS.timer('parse', 'Imagga'))
+
+    def test_cli_tags_a_manifest_with_worker_processes(self):
+        print 'Checking the CLI shards a JSONL manifest across workers and streams the results'
+        folder = tempfile.mkdtemp()
+        benchmark = Benchmark().start()
+        try:
+            paths = make_images(os.path.join(folder, 'images'), 5, 64, 48)
+            manifest_path = os.path.join(folder, 'manifest.jsonl')
+            with open(manifest_path, 'w') as manifest_file:
+                manifest_file.write(json.dumps(paths[0]) + '\n')
+                for image_path in paths[1:]:
+                    manifest_file.write(json.dumps({'path': image_path, 'name': os.path.basename(image_path)}) + '\n')
+                manifest_file.write('\n' + json.dumps({'path': os.path.join(folder, 'missing.jpg')}) + '\n')
+            output_path = os.path.join(folder, 'tags.jsonl')
+            self.assertEqual(0, cli.main([manifest_path, '-o', output_path, '-c', benchmark.config_file,
+                                          '-w', '2', '--chunk-size', '2', '--apis', 'Clarifai,GoogleVision',
+                                          '--quiet']))
+            with open(output_path) as output:
+                results = dict((result['path'], result) for result in map(json.loads, output))
+        finally:
+            benchmark.stop()
+            shutil.rmtree(folder)
+        self.assertEqual(6, len(results))
+        self.assertIn('error', results[os.path.join(folder, 'missing.jpg')])
+        self.assertEqual(paths[0], results[paths[0]]['image'])
+        self.assertEqual('image-00001.jpg', results[paths[1]]['image'])
+        for image_path in paths:
+            self.assertEqual(['Clarifai', 'GoogleVision'], sorted(results[image_path]['tags'].keys()))
+        self.assertEqual(0, benchmark.stand_ins['Imagga'].stats()['requests'])
+
+    def test_async_callbacks_may_wait_for_other_async_results(self):
+        print 'Checking callbacks of the async methods do not block the results of the pool'
+        tagger = ImageTagger()
+        released = threading.Event()
+        called = threading.Event()
+        waited = []
+
+        def callback(value):
+            # Waits for a result handed out by the same pool
+            released.set()
+            waited.append((value, clarifai.get(5)))
+            called.set()
+
+        try:
+            with patch.object(tagger, 'process_images_clarifai', side_effect=lambda folder: released.wait(5)), \
+                    patch.object(tagger, 'process_images_google_vision', return_value='google'):
+                clarifai = tagger.process_images_clarifai_async('sample_images')
+                tagger.process_images_google_vision_async('sample_images', callback=callback)
+                called.wait(10)
+        finally:
+            tagger.close()
+        self.assertEqual([('google', True)], waited)
+
+    def test_async_methods_share_a_pool_and_merge_all_apis(self):
+        print 'Checking the async counterparts tag a folder without blocking the caller'
+        folder = tempfile.mkdtemp()
+        benchmark = Benchmark(latency=0.05).start()
+        tagger = benchmark.make_tagger()
+        try:
+            make_images(folder, 3, 64, 48)
+            merged = []
+            gathered = tagger.use_all_async(folder, callback=merged.append)
+            google = tagger.process_images_google_vision_async(folder)
+            imagga = tagger.process_images_imagga_async(folder)
+            # Nothing had time to answer yet
+            self.assertFalse(gathered.ready())
+            data_frame = gathered.get(30)
+            self.assertTrue(gathered.successful())
+            self.assertEqual(['VisualRecognition', 'Clarifai', 'Imagga', 'GoogleVision'], list(data_frame.columns))
+            self.assertEqual(3, len(data_frame))
+            self.assertFalse(data_frame.isnull().any().any())
+            self.assertIs(data_frame, merged[0])
+            self.assertEqual(3, len(google.get(30)))
+            self.assertEqual(3, len(imagga.get(30)))
+            # The options of the blocking methods are passed through
+            with patch.object(tagger, 'process_images_visual_recognition') as visual_recognition, \
+                    patch.object(tagger.imagga_helper, 'process_images') as imagga_process:
+                tagger.process_images_visual_recognition_async(folder, store_results=True).get(30)
+                tagger.process_images_imagga_async(folder, base_url='http://localhost/', store_results=True).get(30)
+            visual_recognition.assert_called_once_with(folder, True)
+            imagga_process.assert_called_once_with(folder, 'http://localhost/', True)
+            self.assertIs(tagger.async_pool, tagger.get_async_pool())
+            self.assertIsNone(tagger.use_all_async(os.path.join(folder, 'missing')).get(1))
+        finally:
+            tagger.close()
+            benchmark.stop()
+            shutil.rmtree(folder)
+        self.assertIsNone(tagger.async_pool)
+
+    def test_importing_the_tagger_does_not_load_the_api_clients(self):
+        print 'Checking the clients of the APIs and pandas are only imported when they are needed'
+        loaded = subprocess.check_output([sys.executable, '-c', 'import sys, image_tagging; print sorted(set(['
+                                          '"pandas", "watson_developer_cloud", "clarifai.client", "googleapiclient"])'
+                                          ' & set(sys.modules))'], cwd=os.path.dirname(os.path.abspath(__file__)))
+        self.assertEqual('[]', loaded.strip())
+
+    def test_google_vision_discovery_document_is_downloaded_once(self):
+        print 'Checking the Google Vision discovery document is cached in a file and read from it afterwards'
+        cache_folder = tempfile.mkdtemp()
+        config_handle, config_file = tempfile.mkstemp(suffix='.yml')
+        stand_in = GoogleVisionStandIn().start()
+        try:
+            config = {'visual-recognition': {'api-key': ''}, 'clarifai': {'client-id': '', 'client-secret': ''},
+                      'google-vision': {'api-key': 'dummy-google-key', 'discovery-url': stand_in.discovery_url,
+                                        'discovery-cache': cache_folder}}
+            with os.fdopen(config_handle, 'w') as fd:
+                yaml.safe_dump(config, fd)
+            self.tagger.configure_tagger(config_file)
+            self.assertIsNotNone(self.tagger.google_vision_service)
+            self.assertIsNone(self.tagger.visual_recognition)
+            self.assertEqual(1, len(os.listdir(cache_folder)))
+            # The stand-in is gone, the document must come from the cache
+            stand_in.stop()
+            tagger = ImageTagger()
+            tagger.configure_tagger(config_file)
+            self.assertIsNotNone(tagger.google_vision_service)
+        finally:
+            stand_in.stop()
+            os.remove(config_file)
+            shutil.rmtree(cache_folder)
+
+    def test_deduplicator_tags_one_image_of_every_group_of_near_duplicates(self):
+        print 'Checking near duplicates are tagged once and get the tags of the image tagged in their place'
+        folder = tempfile.mkdtemp()
+        original = Image.open('sample_images/sea-man-person-surfer.jpg')
+        original.save(os.path.join(folder, 'a-original.jpg'), 'JPEG', quality=90)
+        original.resize((original.size[0] / 2, original.size[1] / 2), Image.ANTIALIAS).save(
+            os.path.join(folder, 'b-resized.jpg'), 'JPEG', quality=90)
+        original.save(os.path.join(folder, 'c-encoded-again.jpg'), 'JPEG', quality=40)
+        shutil.copy('sample_images/pexels-photo_beach_1.jpg', os.path.join(folder, 'd-other.jpg'))
+        metrics = Metrics()
+        benchmark = Benchmark().start()
+        tagger = benchmark.make_tagger(metrics)
+        tagger.deduplicator = ImageDeduplicator()
+        try:
+            catalog, duplicates = ImageDeduplicator().deduplicate(ImageScanner().scan(folder))
+            self.assertEqual(['a-original.jpg', 'd-other.jpg'], [image.name for image in catalog])
+            self.assertEqual({'b-resized.jpg': 'a-original.jpg', 'c-encoded-again.jpg': 'a-original.jpg'},
+                             duplicates)
+            data_frame = tagger.use_all(folder)
+            async_data_frame = tagger.use_all_async(folder).get(30)
+            records = sorted(tagger.iter_all(folder, ['Clarifai']))
+        finally:
+            tagger.close()
+            benchmark.stop()
+            shutil.rmtree(folder)
+        self.assertEqual(['a-original.jpg', 'b-resized.jpg', 'c-encoded-again.jpg', 'd-other.jpg'],
+                         list(data_frame.index))
+        self.assertEqual(data_frame.loc['a-original.jpg'].tolist(), data_frame.loc['b-resized.jpg'].tolist())
+        self.assertEqual(list(data_frame.index), sorted(async_data_frame.index))
+        self.assertEqual(async_data_frame.loc['a-original.jpg'].tolist(),
+                         async_data_frame.loc['c-encoded-again.jpg'].tolist())
+        self.assertEqual(4, len(records))
+        counters = dict(((counter['counter'], counter['api']), counter['value'])
+                        for counter in metrics.snapshot()['counters'])
+        # Two representatives tagged by use_all and use_all_async, duplicates found by the three calls
+        self.assertEqual(4, counters[('images', 'Imagga')])
+        self.assertEqual(6, counters[('duplicates', None)])
+
+    def test_bk_tree_finds_the_same_hashes_as_comparing_all_of_them(self):
+        print 'Checking the BK-tree finds every hash within a distance'
+        random_state = numpy.random.RandomState(0)
+        hashes = [int(value) for value in random_state.randint(0, 2 ** 16, 500)]
+        tree = BKTree()
+        for position, item_hash in enumerate(hashes):
+            tree.add(item_hash, position)
+        self.assertEqual(500, len(tree))
+        for item_hash in hashes[:20]:
+            expected = sorted(position for position, other in enumerate(hashes)
+                              if hamming_distance(item_hash, other) <= 3)
+            self.assertEqual(expected, sorted(position for distance, position in tree.search(item_hash, 3)))
+
+    def test_service_sends_concurrent_requests_as_one_batch_per_api(self):
+        print 'Checking the service groups the images of concurrent requests in one batched call per API'
+        import requests
+        benchmark = Benchmark().start()
+        service = None
+        server = None
+        try:
+            tagger = benchmark.make_tagger()
+            service = TaggingService(tagger, max_wait=5, batch_sizes={'VisualRecognition': 4, 'Clarifai': 4,
+                                                                      'GoogleVision': 4, 'Imagga': 4})
+            server = service.serve(0, '127.0.0.1')
+            url = 'http://127.0.0.1:%d' % server.server_address[1]
+            self.assertEqual(4, len(requests.get(url + '/health').json()['apis']))
+            names = sorted(os.listdir('sample_images'))[:4]
+            answers = dict()
+
+            def post(name):
+                with open(os.path.join('sample_images', name), 'rb') as image_file:
+                    answers[name] = requests.post(url + '/tag', data=image_file.read(),
+                                                  headers={'Content-Type': 'image/jpeg'})
+
+            threads = [threading.Thread(target=post, args=(name,)) for name in names]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            # Later batches of Imagga reuse the same workers
+            imagga_pool = tagger.imagga_helper.pool
+            with open(os.path.join('sample_images', names[0]), 'rb') as image_file:
+                imagga_answer = requests.post(url + '/tag?apis=Imagga', data=image_file.read(),
+                                              headers={'Content-Type': 'image/jpeg'})
+            self.assertEqual(['Imagga'], imagga_answer.json()['tags'].keys())
+            self.assertIsNotNone(imagga_pool)
+            self.assertIs(imagga_pool, tagger.imagga_helper.pool)
+            unsupported = requests.post(url + '/tag', data='text', headers={'Content-Type': 'text/plain'})
+        finally:
+            if server is not None:
+                server.shutdown()
+                server.server_close()
+            if service is not None:
+                service.close()
+            benchmark.stop()
+        self.assertIsNone(tagger.imagga_helper.pool)
+        for name in names:
+            self.assertEqual(200, answers[name].status_code)
+            tags = answers[name].json()['tags']
+            self.assertEqual(sorted(['VisualRecognition', 'Clarifai', 'Imagga', 'GoogleVision']), sorted(tags))
+            self.assertTrue(all(tags.values()))
+        self.assertEqual(415, unsupported.status_code)
+        # Four images, a single request to each API that takes batches
+        for api in ['VisualRecognition', 'Clarifai', 'GoogleVision']:
+            self.assertEqual(1, benchmark.stand_ins[api].stats()['requests'])
+
+    def test_cascade_escalates_weak_results_and_respects_budgets(self):
+        print 'Checking the cascade only calls the next API for weak results and skips APIs out of budget'
+        catalog = ImageScanner().scan('sample_images')[:6]
+        sent = dict()
+
+        def fake_api(api, tags_for):
+            def iterate(images):
+                sent.setdefault(api, list()).extend(image.name for image in images)
+                for image in images:
+                    yield image.name, api, tags_for(image.name)
+            return iterate
+
+        strong = [(u'sea', 0.95), (u'beach', 0.9), (u'sky', 0.8)]
+        self.tagger.api_iterators = lambda: {
+            # Clarifai is only sure of the first two images
+            'Clarifai': fake_api('Clarifai', lambda name: strong if name in [image.name for image in catalog[:2]]
+                                 else [(u'thing', 0.4)]),
+            'GoogleVision': fake_api('GoogleVision', lambda name: strong),
+            'Imagga': fake_api('Imagga', lambda name: [(u'sea', 95.0), (u'beach', 90.0), (u'sky', 80.0)])
+        }
+        budgets = ProviderBudgets({'GoogleVision': {'calls': 5, 'spend': 3.0, 'cost': 1.5}}, db_path=':memory:')
+        cascade = TaggingCascade(self.tagger, order=['Clarifai', 'GoogleVision', 'Imagga'], budgets=budgets)
+        data_frame = cascade.use_cascade(catalog)
+        self.assertEqual(6, len(sent['Clarifai']))
+        # The spend allows two calls, the other images go on to Imagga
+        self.assertEqual([image.name for image in catalog[2:4]], sent['GoogleVision'])
+        self.assertEqual([image.name for image in catalog[4:]], sent['Imagga'])
+        self.assertEqual((2, 3.0), budgets.usage('GoogleVision'))
+        self.assertEqual(['Clarifai'] * 2 + ['GoogleVision'] * 2 + ['Imagga'] * 2,
+                         [cascade.resolved[image.name] for image in catalog])
+        self.assertEqual(6, len(data_frame.index))
+        self.assertEqual(2, data_frame['GoogleVision'].notnull().sum())
+        # Google has no budget left today, everything weak goes to Imagga
+        sent.clear()
+        cascade.use_cascade(catalog)
+        self.assertNotIn('GoogleVision', sent)
+        self.assertEqual(4, len(sent['Imagga']))
+        budgets.close()
+
+    def test_cascade_only_charges_the_calls_that_are_made(self):
+        print 'Checking cached images and failed calls do not take budget of the cascade'
+        catalog = ImageScanner().scan('sample_images')[:3]
+        strong = [(u'sea', 0.95), (u'beach', 0.9), (u'sky', 0.8)]
+        sent = list()
+
+        def iterate(images):
+            sent.extend(image.name for image in images)
+            # The call of the last image fails, so it gets no answer
+            for image in images[:-1]:
+                yield image.name, 'GoogleVision', strong
+
+        self.tagger.api_iterators = lambda: {'GoogleVision': iterate}
+        self.tagger.result_cache = ResultCache(db_path='dummy_cache.db')
+        self.tagger.set_cached_tags('GoogleVision', content_hash(catalog[0].path), strong)
+        budgets = ProviderBudgets({'GoogleVision': {'calls': 5, 'cost': 1.5}}, db_path=':memory:')
+        cascade = TaggingCascade(self.tagger, order=['GoogleVision'], budgets=budgets)
+        try:
+            records = list(cascade.iter_cascade(catalog))
+            self.assertEqual([image.name for image in catalog[1:]], sent)
+            self.assertEqual([image.name for image in catalog[:2]], [record[0] for record in records])
+            self.assertEqual((1, 1.5), budgets.usage('GoogleVision'))
+            self.assertEqual(4, budgets.available('GoogleVision'))
+        finally:
+            budgets.close()
+            self.tagger.result_cache.close()
+            self.tagger.result_cache = None
+            os.remove('dummy_cache.db')
+
 if __name__ == "__main__":
     unittest.main()